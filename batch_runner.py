@@ -0,0 +1,197 @@
+"""
+Run process_merge over many manifests in a local process pool, for backfills on a
+large host instead of one Lambda invocation per manifest.
+
+Manifests are keys in the input bucket. An argument ending in '/' is a directory
+(prefix) of manifests: every .json, .jsonl and .ndjson key under it is merged.
+--manifest-list reads more manifest keys from a file, one per line. Each manifest
+is merged into <output-prefix><manifest name>.pdf in the output bucket.
+
+Storage is S3 by default. With --local-root, buckets are directories under that
+root and no AWS access is needed (STORAGE_BACKEND=local). At the end, aggregate
+throughput is printed in PDFs/s and MB/s of source PDFs read.
+
+Usage:
+    python batch_runner.py --local-root /data --input-bucket statements \
+        --output-bucket merged manifests/2024/
+    python batch_runner.py --input-bucket my-bucket --output-bucket my-bucket \
+        --output-prefix merged/ --manifest-list backfill.txt --workers 32
+"""
+import argparse
+import contextlib
+import json
+import os
+import posixpath
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import lambda_function
+
+MANIFEST_SUFFIXES = ('.json',) + lambda_function.JSON_LINES_SUFFIXES
+
+
+def list_manifests(input_bucket, arguments, manifest_list=None):
+    """
+    Expand the manifest arguments into manifest keys.
+
+    Args:
+        input_bucket (str): Bucket holding the manifests
+        arguments (list): Manifest keys, and prefixes ending in '/' to list
+        manifest_list (str): Path of a file with more manifest keys, one per line
+
+    Returns:
+        list: Manifest keys, in argument order and key order within a prefix
+    """
+    keys = []
+    for argument in arguments:
+        if argument.endswith('/'):
+            paginator = lambda_function.get_s3_client().get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=input_bucket, Prefix=argument):
+                keys.extend(item['Key'] for item in page.get('Contents', [])
+                            if item['Key'].endswith(MANIFEST_SUFFIXES))
+        else:
+            keys.append(argument)
+    if manifest_list:
+        with open(manifest_list) as file:
+            keys.extend(line.strip() for line in file if line.strip() and not line.startswith('#'))
+    return keys
+
+
+def output_key_for(manifest_key, output_prefix):
+    """Output key of a manifest: its file name with a .pdf extension, under output_prefix."""
+    return output_prefix + posixpath.splitext(posixpath.basename(manifest_key))[0] + '.pdf'
+
+
+def merge_manifest(job):
+    """
+    Worker: merge one manifest with process_merge and measure it.
+
+    The merge's log goes to <log_dir>/<output name>.log, or is discarded without a log_dir.
+
+    Returns:
+        dict: manifest, output_key, status, error, seconds, and the documents,
+              input_bytes and output_bytes the job metrics counted
+    """
+    result = {'manifest': job['manifest'], 'output_key': job['output_key'], 'status': 'succeeded', 'error': None}
+    log_path = (os.path.join(job['log_dir'], posixpath.basename(job['output_key']) + '.log')
+                if job['log_dir'] else os.devnull)
+    start = time.perf_counter()
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+        # Record into our own job, so its counters can be read back
+        token = lambda_function.start_job_metrics(input_file_key=job['manifest'], output_file_key=job['output_key'])
+        metrics = lambda_function.job_metrics.get()
+        error = None
+        try:
+            lambda_function.process_merge(job['input_bucket'], job['manifest'], job['output_bucket'],
+                                          job['output_key'], job['optimize_pdf'], **job['merge_options'])
+        except Exception as e:
+            error = e
+            result.update(status='failed', error=str(e))
+        finally:
+            lambda_function.finish_job_metrics(token, error)
+    result['seconds'] = time.perf_counter() - start
+    counters = metrics.counters if metrics is not None else {}
+    for name in ('documents', 'input_bytes', 'output_bytes'):
+        result[name] = counters.get(name, 0)
+    return result
+
+
+def run_batch(input_bucket, output_bucket, manifests, output_prefix='', optimize_pdf=False, merge_options=None,
+              workers=None, log_dir=None):
+    """
+    Merge manifests in a process pool and report aggregate throughput.
+
+    Args:
+        input_bucket (str): Bucket with the manifests and source PDFs
+        output_bucket (str): Bucket for the merged PDFs
+        manifests (list): Manifest keys
+        output_prefix (str): Key prefix of the merged PDFs
+        optimize_pdf (bool): Optimize every merged PDF
+        merge_options (dict): Extra process_merge options, as in a payload
+        workers (int): Worker processes, defaults to one per CPU
+        log_dir (str): Directory for one merge log per manifest
+
+    Returns:
+        dict: results (one per manifest, in completion order), and totals: manifests,
+              failed, documents, input_bytes, output_bytes, seconds, pdfs_per_second,
+              mb_per_second
+    """
+    workers = workers or os.cpu_count() or 1
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    jobs = [{'manifest': manifest, 'output_key': output_key_for(manifest, output_prefix),
+             'input_bucket': input_bucket, 'output_bucket': output_bucket, 'optimize_pdf': optimize_pdf,
+             'merge_options': merge_options or {}, 'log_dir': log_dir} for manifest in manifests]
+    if len({job['output_key'] for job in jobs}) < len(jobs):
+        raise Exception("Several manifests map to the same output key, give them distinct file names")
+
+    print(f"Merging {len(jobs)} manifests with {workers} worker processes", file=sys.stderr)
+    results = []
+    start = time.perf_counter()
+    # Each worker builds its own storage client instead of inheriting this process's
+    with ProcessPoolExecutor(max_workers=workers, initializer=lambda_function.set_s3_client,
+                             initargs=(None,)) as executor:
+        for future in as_completed([executor.submit(merge_manifest, job) for job in jobs]):
+            result = future.result()
+            results.append(result)
+            print(f"{result['status']}: {result['manifest']} -> {result['output_key']}, {result['documents']} PDFs, "
+                  f"{result['input_bytes'] / 1e6:.1f} MB in {result['seconds']:.2f} s"
+                  + (f" ({result['error']})" if result['error'] else ''), file=sys.stderr)
+    seconds = time.perf_counter() - start
+
+    totals = {
+        'manifests': len(results),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'documents': sum(result['documents'] for result in results),
+        'input_bytes': sum(result['input_bytes'] for result in results),
+        'output_bytes': sum(result['output_bytes'] for result in results),
+        'seconds': seconds,
+    }
+    totals['pdfs_per_second'] = totals['documents'] / seconds if seconds else 0
+    totals['mb_per_second'] = totals['input_bytes'] / 1e6 / seconds if seconds else 0
+    return {'results': results, 'totals': totals}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('manifests', nargs='*', help="Manifest keys, or prefixes ending in '/' to merge every manifest under")
+    parser.add_argument('--manifest-list', help='File with more manifest keys, one per line')
+    parser.add_argument('--input-bucket', required=True, help='Bucket with the manifests and source PDFs')
+    parser.add_argument('--output-bucket', required=True, help='Bucket for the merged PDFs')
+    parser.add_argument('--output-prefix', default='', help='Key prefix of the merged PDFs')
+    parser.add_argument('--local-root', help='Use the local storage backend with buckets under this directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes (default: one per CPU)')
+    parser.add_argument('--optimize', action='store_true', help='Optimize the merged PDFs')
+    parser.add_argument('--options', default='{}',
+                        help='JSON object of extra process_merge options, e.g. \'{"upload_mode": "stream"}\'')
+    parser.add_argument('--log-dir', help='Write one merge log per manifest into this directory')
+    parser.add_argument('--output', help='Write the results JSON to this file')
+    args = parser.parse_args()
+
+    if args.local_root:
+        os.environ['STORAGE_BACKEND'] = 'local'
+        os.environ['LOCAL_STORAGE_ROOT'] = os.path.abspath(args.local_root)
+    # The /tmp PDF cache is built for one process per execution environment, not a pool
+    os.environ.setdefault('PDF_CACHE_MAX_BYTES', '0')
+    os.environ['MERGE_METRICS'] = 'true'
+
+    manifests = list_manifests(args.input_bucket, args.manifests, args.manifest_list)
+    if not manifests:
+        parser.error('no manifests given or found')
+    batch = run_batch(args.input_bucket, args.output_bucket, manifests, args.output_prefix, args.optimize,
+                      json.loads(args.options), args.workers, args.log_dir)
+
+    totals = batch['totals']
+    print(f"Merged {totals['manifests'] - totals['failed']} of {totals['manifests']} manifests: "
+          f"{totals['documents']} PDFs, {totals['input_bytes'] / 1e6:.1f} MB in, "
+          f"{totals['output_bytes'] / 1e6:.1f} MB out, in {totals['seconds']:.1f} s")
+    print(f"Throughput: {totals['pdfs_per_second']:.1f} PDFs/s, {totals['mb_per_second']:.1f} MB/s")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(batch, file, indent=2)
+    sys.exit(1 if totals['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
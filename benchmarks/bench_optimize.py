@@ -0,0 +1,62 @@
+"""
+Compare the optimize_pdf strategies of merge_pdfs on a synthetic corpus.
+
+Runs merge_pdfs with optimize_pdf off, with the single garbage=4 pass and with
+parallel per-source optimization, and prints wall time and output size for each.
+
+Usage:
+    python benchmarks/bench_optimize.py --documents 200 --pages 5 --workers 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import lambda_function
+from corpus import make_corpus
+from local_s3 import LocalS3
+
+
+def run(corpus, optimize_pdf, optimize_mode):
+    output_file = os.path.join(tempfile.gettempdir(), f"bench-optimize-{os.getpid()}.pdf")
+    start = time.perf_counter()
+    lambda_function.merge_pdfs("bench-bucket", list(corpus), output_file, optimize_pdf,
+                               use_cache=False, optimize_mode=optimize_mode)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(output_file)
+    os.remove(output_file)
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    os.environ['OPTIMIZE_WORKERS'] = str(args.workers)
+    corpus = make_corpus(args.documents, args.pages)
+    s3 = LocalS3(tempfile.mkdtemp(prefix='bench-s3-'))
+    for key, data in corpus.items():
+        s3.put("bench-bucket", key, data)
+    lambda_function.set_s3_client(s3)
+    print(f"{args.documents} documents x {args.pages} pages, {sum(map(len, corpus.values()))} input bytes, "
+          f"{args.workers} workers", file=sys.stderr)
+
+    rows = [
+        ('no optimization', run(corpus, False, 'single')),
+        ('single garbage=4 pass', run(corpus, True, 'single')),
+        ('parallel per source', run(corpus, True, 'parallel')),
+    ]
+    s3.clear()
+    print("| mode | wall time (s) | output bytes |")
+    print("|---|---|---|")
+    for name, (elapsed, size) in rows:
+        print(f"| {name} | {elapsed:.2f} | {size} |")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Cold-start profile of lambda_function.
+
+Every measurement runs in a fresh interpreter:
+
+* Import profile: python -X importtime while importing lambda_function as Lambda
+  does (AWS_LAMBDA_FUNCTION_NAME set, so the init preload runs), with the time
+  summed per top-level package, plus the init preload steps.
+* Latency: init (import) time, the first (cold) invocation and the median of the
+  following (warm) invocations of lambda_handler for a small merge, served from
+  the local S3 stand-in, with and without the init preload.
+
+Usage:
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --documents 2 --warm-runs 10 --output cold-start.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+INPUT_BUCKET = 'bench-input'
+OUTPUT_BUCKET = 'bench-output'
+MANIFEST_KEY = 'manifest.json'
+
+# Lambda-like environment. Credentials are placeholders: the S3 client is built but
+# requests go to the local stand-in.
+LAMBDA_ENVIRONMENT = {
+    'AWS_LAMBDA_FUNCTION_NAME': 'cold-start-bench',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench',
+    'PDF_CACHE_MAX_BYTES': '0',
+}
+
+
+def child_environment(preload):
+    return dict(os.environ, **LAMBDA_ENVIRONMENT, INIT_PRELOAD='true' if preload else 'false',
+                PYTHONPATH=os.pathsep.join([REPO_DIR, BENCHMARKS_DIR]))
+
+
+def profile_imports(top=10):
+    """
+    Import lambda_function with -X importtime and the init preload on.
+
+    Returns:
+        dict: packages (top-level package -> import ms, largest first) and init_ms
+              (preload step -> ms)
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import json, lambda_function; print(json.dumps(lambda_function.init_timings))'],
+        env=child_environment(True), cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    packages = Counter()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(self_us) / 1000
+    return {
+        'packages': dict(packages.most_common(top)),
+        'init_ms': json.loads(result.stdout.strip().splitlines()[-1]),
+    }
+
+
+def prepare(root, documents, pages):
+    """Put a small corpus and its manifest into the local S3 directory."""
+    from corpus import make_corpus
+    from local_s3 import LocalS3
+
+    s3 = LocalS3(root)
+    corpus = make_corpus(documents, pages)
+    for key, data in corpus.items():
+        s3.put(INPUT_BUCKET, key, data)
+    s3.put(INPUT_BUCKET, MANIFEST_KEY, json.dumps({'pdfs': list(corpus)}).encode('utf-8'))
+
+
+def measure_latency(root, preload, warm_runs):
+    """Run one fresh interpreter through init and 1 + warm_runs invocations."""
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', json.dumps({
+        'root': root, 'warm_runs': warm_runs,
+    })], env=child_environment(preload), cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_one(job):
+    """Subprocess entry point: time the import and the invocations."""
+    start = time.perf_counter()
+    import lambda_function
+    init_ms = (time.perf_counter() - start) * 1000
+
+    from local_s3 import LocalS3
+    local_s3 = LocalS3(job['root'])
+    # Requests go to the local stand-in, but whoever builds the client first still pays
+    # for the real one: the init preload, or else the first invocation
+    create_s3_client = lambda_function.create_s3_client
+    def create_local_s3_client():
+        create_s3_client()
+        return local_s3
+    lambda_function.create_s3_client = create_local_s3_client
+    if lambda_function.s3_client is not None:
+        lambda_function.set_s3_client(local_s3)
+
+    event = {'input_bucket': INPUT_BUCKET, 'input_file_key': MANIFEST_KEY,
+             'output_bucket': OUTPUT_BUCKET, 'output_file_key': 'merged.pdf'}
+    invocations_ms = []
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for _ in range(1 + job['warm_runs']):
+                start = time.perf_counter()
+                response = lambda_function.lambda_handler(event, None)
+                invocations_ms.append((time.perf_counter() - start) * 1000)
+                if response['statusCode'] != 200:
+                    raise Exception(f"Merge failed: {response}")
+        finally:
+            sys.stdout = stdout
+    print(json.dumps({
+        'init_ms': init_ms,
+        'cold_ms': invocations_ms[0],
+        'warm_ms': statistics.median(invocations_ms[1:]) if invocations_ms[1:] else None,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--documents', type=int, default=3, help='Source PDFs per merge')
+    parser.add_argument('--pages', type=int, default=2, help='Pages per source PDF')
+    parser.add_argument('--warm-runs', type=int, default=5, help='Warm invocations after the cold one')
+    parser.add_argument('--repeat', type=int, default=3, help='Fresh interpreters per variant, the median is reported')
+    parser.add_argument('--output', help='Write results JSON to this file')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(json.loads(args.run_one))
+        return
+
+    profile = profile_imports()
+    print("| package | import (ms) |")
+    print("|---|---|")
+    for package, ms in profile['packages'].items():
+        print(f"| {package} | {ms:.0f} |")
+    print("\nlambda_function's own time is its module body, including the init preload:")
+    print("Init preload: " + ", ".join(f"{step} {ms:.0f} ms" for step, ms in profile['init_ms'].items()))
+
+    results = {'documents': args.documents, 'pages': args.pages, 'imports': profile, 'latency': {}}
+    with tempfile.TemporaryDirectory(prefix='bench-s3-') as root:
+        prepare(root, args.documents, args.pages)
+        for preload in (True, False):
+            runs = [measure_latency(root, preload, args.warm_runs) for _ in range(args.repeat)]
+            results['latency']['preload' if preload else 'lazy'] = {
+                name: statistics.median(run[name] for run in runs) for name in ('init_ms', 'cold_ms', 'warm_ms')
+            }
+
+    print(f"\n{args.documents} documents of {args.pages} pages, median of {args.repeat} cold starts")
+    print("| init | init (ms) | cold invocation (ms) | init + cold (ms) | warm invocation (ms) |")
+    print("|---|---|---|---|---|")
+    for name, latency in results['latency'].items():
+        print(f"| {name} | {latency['init_ms']:.0f} | {latency['cold_ms']:.0f} | "
+              f"{latency['init_ms'] + latency['cold_ms']:.0f} | {latency['warm_ms']:.1f} |")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
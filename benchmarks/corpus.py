@@ -0,0 +1,71 @@
+"""
+Synthetic PDF corpora for the benchmarks.
+
+Every corpus is generated from a seed, so the same arguments always produce the
+same bytes and results stay comparable across runs and machines.
+"""
+import random
+
+import fitz
+
+PAGE_SIZES = {
+    'letter': (612, 792),
+    'a4': (595, 842),
+    'tabloid': (792, 1224),
+}
+CONTENT_TYPES = ('text', 'image', 'mixed')
+
+STATEMENT_LINE = "Statement line with account details and a running balance. " * 6 + "\n"
+
+
+def make_corpus(documents, pages, content='text', page_size='letter', duplicate_resources=False,
+                image_size=256, seed=0):
+    """
+    Build a corpus of synthetic PDFs.
+
+    Args:
+        documents (int): Number of source PDFs
+        pages (int): Pages per source PDF
+        content (str): 'text' (uncompressed text, like our statement sources before
+                       optimization), 'image' (one large image per page) or 'mixed'
+        page_size (str): Key of PAGE_SIZES
+        duplicate_resources (bool): Every source embeds the same logo image and font file,
+                                    like the shared letterhead of our statements. Otherwise
+                                    each source has its own logo and uses a non-embedded font
+        image_size (int): Width and height in pixels of the page images
+        seed (int): Seed for the image noise
+
+    Returns:
+        dict: S3 key -> PDF bytes, keys in manifest order
+    """
+    if content not in CONTENT_TYPES:
+        raise ValueError(f"Unknown content: {content}. Expected one of {', '.join(CONTENT_TYPES)}")
+    width, height = PAGE_SIZES[page_size]
+    rng = random.Random(seed)
+    logo = make_pixmap(rng, 96) if duplicate_resources else None
+    font_buffer = fitz.Font('helv').buffer if duplicate_resources else None
+    text = STATEMENT_LINE * int(height / 20)
+
+    corpus = {}
+    for index in range(documents):
+        document = fitz.open()
+        # Without shared resources each source gets its own logo
+        document_logo = logo or make_pixmap(rng, 96)
+        for _ in range(pages):
+            page = document.new_page(width=width, height=height)
+            page.insert_image(fitz.Rect(36, 36, 132, 132), pixmap=document_logo)
+            if content in ('text', 'mixed'):
+                if font_buffer:
+                    page.insert_font(fontname='shared', fontbuffer=font_buffer)
+                page.insert_text((36, 150), text, fontsize=6, fontname='shared' if font_buffer else 'helv')
+            if content in ('image', 'mixed'):
+                page.insert_image(fitz.Rect(36, height / 2, width - 36, height - 36),
+                                  pixmap=make_pixmap(rng, image_size))
+        corpus[f"source-{index:05d}.pdf"] = document.tobytes(no_new_id=True)
+        document.close()
+    return corpus
+
+
+def make_pixmap(rng, size):
+    """An RGB pixmap of random noise, which does not compress, like a scanned page."""
+    return fitz.Pixmap(fitz.csRGB, size, size, rng.randbytes(size * size * 3), False)
@@ -0,0 +1,15 @@
+"""
+Local S3 stand-in for the benchmarks.
+
+This is lambda_function's local storage backend (LocalStorageClient), which
+serves the S3 client calls from a directory (<root>/<bucket>/<key>), so a merge
+can run end to end without network access. Inject it with
+lambda_function.set_s3_client(LocalS3(root)).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lambda_function import LocalStorageClient as LocalS3  # noqa: E402
+
+__all__ = ['LocalS3']
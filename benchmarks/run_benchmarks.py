@@ -0,0 +1,272 @@
+"""
+End-to-end merge benchmarks on synthetic corpora served from a local S3 stand-in.
+
+Each scenario's corpus is generated once into a local S3 directory (see corpus.py
+and local_s3.py). process_merge then runs in a fresh subprocess, with and without
+optimize_pdf, or once per --save-profile, so peak RSS is measured per run. The
+results record wall time, per-phase time, peak RSS and output size, and are
+written as JSON. Pass --baseline to compare against an earlier results file; the
+run exits with status 1 when a metric regresses past its threshold.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json --output new.json
+    python benchmarks/run_benchmarks.py --scenario text-small --repeat 5
+    python benchmarks/run_benchmarks.py --save-profile fast --save-profile archive
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+from lambda_function import SAVE_PROFILES  # noqa: E402
+
+INPUT_BUCKET = 'bench-input'
+OUTPUT_BUCKET = 'bench-output'
+MANIFEST_KEY = 'manifest.json'
+
+# name -> make_corpus arguments
+SCENARIOS = {
+    'text-small': {'documents': 50, 'pages': 4, 'content': 'text'},
+    'text-large': {'documents': 400, 'pages': 2, 'content': 'text'},
+    'image-heavy': {'documents': 40, 'pages': 3, 'content': 'image', 'page_size': 'a4', 'image_size': 512},
+    'shared-resources': {'documents': 100, 'pages': 2, 'content': 'mixed', 'duplicate_resources': True},
+}
+
+# Default regression thresholds, as the allowed relative increase over the baseline
+THRESHOLDS = {
+    'wall_s': 0.25,
+    'peak_rss_bytes': 0.15,
+    'output_bytes': 0.05,
+}
+
+# Smallest absolute increase that counts as a regression. Run-to-run noise on the
+# sub-second scenarios can exceed the relative wall time threshold.
+MIN_CHANGES = {
+    'wall_s': 0.2,
+}
+
+# Job metrics spans reported per run (see JobMetrics in lambda_function)
+PHASES = ('manifest', 'download', 'open', 'insert', 'save', 'upload')
+
+
+def prepare_scenario(root, scenario):
+    """Generate the scenario corpus and its manifest into the local S3 directory."""
+    from corpus import make_corpus
+    from local_s3 import LocalS3
+
+    s3 = LocalS3(root)
+    corpus = make_corpus(**SCENARIOS[scenario])
+    for key, data in corpus.items():
+        s3.put(INPUT_BUCKET, key, data)
+    s3.put(INPUT_BUCKET, MANIFEST_KEY, json.dumps({'pdfs': list(corpus)}).encode('utf-8'))
+    return {'documents': len(corpus), 'input_bytes': sum(map(len, corpus.values()))}
+
+
+def run_in_subprocess(root, scenario, optimize_pdf, merge_options):
+    """Run one merge in a fresh interpreter and return its measurements."""
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as result_file:
+        result_path = result_file.name
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', json.dumps({
+            'root': root, 'scenario': scenario, 'optimize_pdf': optimize_pdf,
+            'merge_options': merge_options, 'result_path': result_path,
+        })], check=True)
+        with open(result_path) as file:
+            return json.load(file)
+    finally:
+        os.remove(result_path)
+
+
+def run_one(job):
+    """
+    Subprocess entry point: merge the scenario corpus with process_merge.
+
+    Phase times come from the job metrics line process_merge logs. Downloads run
+    in threads alongside the merge, so 'download' is their summed time, not wall time.
+    """
+    from local_s3 import LocalS3
+    import lambda_function
+
+    s3 = LocalS3(job['root'])
+    lambda_function.set_s3_client(s3)
+    # Every run starts cold, like a new execution environment
+    os.environ['PDF_CACHE_MAX_BYTES'] = '0'
+    os.environ['MERGE_METRICS'] = 'true'
+
+    output_key = f"merged-{job['scenario']}-{int(job['optimize_pdf'])}-{job['merge_options'].get('save_profile')}.pdf"
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        lambda_function.process_merge(INPUT_BUCKET, MANIFEST_KEY, OUTPUT_BUCKET, output_key,
+                                      job['optimize_pdf'], **job['merge_options'])
+    wall = time.perf_counter() - start
+
+    metrics = next(json.loads(line) for line in log.getvalue().splitlines() if line.startswith('{"_aws"'))
+    result = {
+        'wall_s': wall,
+        'phases': {phase: metrics.get(f"{phase.title()}Time", 0) / 1000 for phase in PHASES},
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'output_bytes': s3.head_object(Bucket=OUTPUT_BUCKET, Key=output_key)['ContentLength'],
+        'pages': metrics.get('Pages'),
+    }
+    with open(job['result_path'], 'w') as file:
+        json.dump(result, file)
+
+
+def summarize(runs):
+    """Median of each measurement over repeated runs."""
+    return {
+        'wall_s': statistics.median(run['wall_s'] for run in runs),
+        'phases': {phase: statistics.median(run['phases'][phase] for run in runs) for phase in PHASES},
+        'peak_rss_bytes': int(statistics.median(run['peak_rss_bytes'] for run in runs)),
+        'output_bytes': runs[0]['output_bytes'],
+        'pages': runs[0]['pages'],
+        'runs': len(runs),
+    }
+
+
+def compare(results, baseline, thresholds, min_changes=None):
+    """
+    Compare results against a baseline results file.
+
+    A metric regresses when it grows past its relative threshold and by at least
+    its minimum absolute change, if it has one.
+
+    Args:
+        results (dict): Results of this run
+        baseline (dict): Results loaded from the baseline file
+        thresholds (dict): Metric -> allowed relative increase
+        min_changes (dict): Metric -> smallest absolute increase that counts, defaults to MIN_CHANGES
+
+    Returns:
+        tuple: (rows, regressions), each row is (name, metric, baseline, current, change)
+    """
+    if min_changes is None:
+        min_changes = MIN_CHANGES
+    baseline_runs = {run['name']: run for run in baseline['results']}
+    rows = []
+    regressions = []
+    for run in results['results']:
+        previous = baseline_runs.get(run['name'])
+        if previous is None:
+            continue
+        for metric, threshold in thresholds.items():
+            if not previous[metric]:
+                continue
+            change = run[metric] / previous[metric] - 1
+            row = (run['name'], metric, previous[metric], run[metric], change)
+            rows.append(row)
+            if change > threshold and run[metric] - previous[metric] >= min_changes.get(metric, 0):
+                regressions.append(row)
+    return rows, regressions
+
+
+def environment():
+    import fitz
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'pymupdf': fitz.VersionBind,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def format_metric(value):
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+def print_results(results):
+    print("| run | wall (s) | manifest | download (sum) | open | insert | save | upload | peak RSS (MB) | output bytes |")
+    print("|---|---|---|---|---|---|---|---|---|---|")
+    for run in results['results']:
+        phases = run['phases']
+        print(f"| {run['name']} | {run['wall_s']:.2f} | " +
+              " | ".join(f"{phases[phase]:.2f}" for phase in PHASES) +
+              f" | {run['peak_rss_bytes'] / (1024 * 1024):.0f} | {run['output_bytes']} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, may be repeated (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario, the median is reported')
+    parser.add_argument('--options', default='{}',
+                        help='JSON object of extra process_merge options, e.g. \'{"upload_mode": "stream"}\'')
+    parser.add_argument('--save-profile', action='append', choices=list(SAVE_PROFILES),
+                        help='Run each scenario with this save profile instead of with and without '
+                             'optimize_pdf, may be repeated')
+    parser.add_argument('--output', help='Write results JSON to this file')
+    parser.add_argument('--baseline', help='Compare against this results JSON')
+    for metric, threshold in THRESHOLDS.items():
+        parser.add_argument(f"--max-{metric.replace('_', '-')}-regression", type=float, default=threshold,
+                            dest=f"threshold_{metric}", help=f"Allowed relative increase of {metric}")
+    for metric, min_change in MIN_CHANGES.items():
+        parser.add_argument(f"--min-{metric.replace('_', '-')}-change", type=float, default=min_change,
+                            dest=f"min_change_{metric}",
+                            help=f"Smallest absolute increase of {metric} that counts as a regression")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(json.loads(args.run_one))
+        return
+
+    merge_options = json.loads(args.options)
+    # (name suffix, optimize_pdf, save_profile) per run of a scenario
+    variants = ([(f" {profile}", False, profile) for profile in args.save_profile] if args.save_profile
+                else [('', False, None), (' optimized', True, None)])
+    results = {'environment': environment(), 'options': merge_options, 'results': []}
+    with tempfile.TemporaryDirectory(prefix='bench-s3-') as root:
+        for scenario in args.scenario or SCENARIOS:
+            corpus = prepare_scenario(root, scenario)
+            for suffix, optimize_pdf, save_profile in variants:
+                name = f"{scenario}{suffix}"
+                print(f"Running {name}: {corpus['documents']} documents, {corpus['input_bytes']} input bytes",
+                      file=sys.stderr)
+                run_options = dict(merge_options, save_profile=save_profile) if save_profile else merge_options
+                runs = [run_in_subprocess(root, scenario, optimize_pdf, run_options) for _ in range(args.repeat)]
+                results['results'].append({'name': name, 'scenario': scenario, 'optimize_pdf': optimize_pdf,
+                                           'save_profile': save_profile, **corpus, **summarize(runs)})
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        thresholds = {metric: getattr(args, f"threshold_{metric}") for metric in THRESHOLDS}
+        min_changes = {metric: getattr(args, f"min_change_{metric}") for metric in MIN_CHANGES}
+        rows, regressions = compare(results, baseline, thresholds, min_changes)
+        print(f"\nCompared with {args.baseline} (commit {baseline['environment'].get('commit')})")
+        print("| run | metric | baseline | current | change |")
+        print("|---|---|---|---|---|")
+        for name, metric, previous, current, change in rows:
+            flag = ' REGRESSION' if (name, metric, previous, current, change) in regressions else ''
+            print(f"| {name} | {metric} | {format_metric(previous)} | {format_metric(current)} | {change:+.1%}{flag} |")
+        if regressions:
+            print(f"\n{len(regressions)} regressions over threshold", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,261 @@
-import boto3
 import os
 import json
 import uuid
-import fitz
 import traceback
+import tempfile
+import sys
+import re
+import time
+import threading
+import hashlib
+import shutil
+import codecs
+import io
+import contextlib
+import contextvars
+import functools
+import itertools
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+# Read-ahead defaults for merge_pdfs. Override with the DOWNLOAD_CONCURRENCY and
+# DOWNLOAD_MAX_BYTES_IN_FLIGHT environment variables, or per request in the payload.
+DEFAULT_DOWNLOAD_CONCURRENCY = 8
+DEFAULT_MAX_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+
+# Sources of DOWNLOAD_TO_FILE_MIN_BYTES or more are downloaded into a /tmp file with parallel
+# ranged GETs of DOWNLOAD_PART_SIZE, DOWNLOAD_PART_CONCURRENCY at a time, and opened by file
+# name, so they are never held in memory. 0 keeps every source in memory.
+DEFAULT_DOWNLOAD_TO_FILE_MIN_BYTES = 64 * 1024 * 1024
+DEFAULT_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_DOWNLOAD_PART_CONCURRENCY = 8
+DOWNLOAD_READ_SIZE = 1024 * 1024
+
+# Upload defaults for process_merge. upload_mode 'file' saves to /tmp and uploads with a
+# single put_object; 'stream' saves into a spooled buffer and uploads it with parallel
+# multipart upload. Override with UPLOAD_MODE, UPLOAD_SPOOL_MAX_MEMORY, UPLOAD_PART_SIZE
+# and UPLOAD_CONCURRENCY.
+DEFAULT_UPLOAD_MODE = 'file'
+UPLOAD_MODES = ('file', 'stream')
+DEFAULT_UPLOAD_SPOOL_MAX_MEMORY = 256 * 1024 * 1024
+DEFAULT_UPLOAD_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 8
+# S3 multipart limits
+MIN_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+MAX_UPLOAD_PARTS = 10000
+
+# Shared S3 client settings. Override with S3_MAX_POOL_CONNECTIONS, S3_RETRY_MODE,
+# S3_MAX_ATTEMPTS, S3_CONNECT_TIMEOUT and S3_READ_TIMEOUT. S3_ENDPOINT_URL points the
+# client at a local S3 stand-in. The pool must cover download plus upload concurrency.
+DEFAULT_S3_MAX_POOL_CONNECTIONS = 64
+DEFAULT_S3_RETRY_MODE = 'adaptive'
+DEFAULT_S3_MAX_ATTEMPTS = 5
+DEFAULT_S3_CONNECT_TIMEOUT = 5
+DEFAULT_S3_READ_TIMEOUT = 60
+
+# Storage backend for manifests, source PDFs and outputs. 's3' uses the S3 client; 'local'
+# serves the same calls from the filesystem, bucket/key being LOCAL_STORAGE_ROOT/<bucket>/<key>,
+# for backfills on a large host (see batch_runner.py). Override with STORAGE_BACKEND and LOCAL_STORAGE_ROOT.
+DEFAULT_STORAGE_BACKEND = 's3'
+STORAGE_BACKENDS = ('s3', 'local')
+# User metadata of a local object is kept in a sidecar file next to it
+LOCAL_METADATA_SUFFIX = '.meta'
+
+# What merge_pdfs does with a source that can't be opened, fails validation or fails to
+# insert: 'fail' the job, 'skip' the entry, or insert a 'placeholder' page naming it.
+# Quarantined sources are listed in a JSON report next to the output. Override with
+# SOURCE_ERROR_POLICY or per request with on_source_error.
+DEFAULT_SOURCE_ERROR_POLICY = 'fail'
+SOURCE_ERROR_POLICIES = ('fail', 'skip', 'placeholder')
+SOURCE_ERROR_REPORT_SUFFIX = '.errors.json'
+
+# Memory budget for merge_pdfs in MB (0 disables flushing). Override with
+# MERGE_MEMORY_BUDGET_MB or per request with memory_budget_mb.
+DEFAULT_MEMORY_BUDGET_MB = 0
+
+# optimize_pdf strategy. 'single' runs one deflate/garbage=4/clean pass over the merged
+# document; 'parallel' cleans and deflates each source in worker processes and finishes
+# with a garbage=4 save that skips the costly clean and deflate steps. Override with OPTIMIZE_MODE and OPTIMIZE_WORKERS
+# (default: one per CPU), or per request with optimize_mode.
+DEFAULT_OPTIMIZE_MODE = 'single'
+OPTIMIZE_MODES = ('single', 'parallel')
+
+# Save profiles: the Document.save options of the merged PDF, from 'fast' (a plain save, no
+# rewrite of the objects) to 'archive' (every unused and duplicate object dropped, streams,
+# fonts and images deflated at maximum effort and small objects packed in object streams).
+# 'optimize' is what optimize_pdf saves with. Select one with SAVE_PROFILE or per request
+# with save_profile, which replaces optimize_pdf's save options. Time and size cost per
+# corpus are in the README.
+SAVE_PROFILES = {
+    'fast': {},
+    'compact': {'garbage': 3, 'use_objstms': 1},
+    'optimize': {'garbage': 4, 'deflate': True, 'clean': True},
+    'archive': {'garbage': 4, 'deflate': True, 'clean': True, 'deflate_images': True, 'deflate_fonts': True,
+                'use_objstms': 1, 'compression_effort': 100},
+}
+
+# Image recompression profiles: images above dpi_threshold are downsampled toward dpi_target
+# (MuPDF subsamples by powers of two) and re-encoded as JPEG at quality, source by source
+# in worker processes (OPTIMIZE_WORKERS). Select one with IMAGE_PROFILE or per request with image_profile.
+# image_profile_mode 'auto' rewrites only sources over IMAGE_PROFILE_MIN_BYTES_PER_PAGE,
+# 'always' rewrites every source. Override the mode with IMAGE_PROFILE_MODE.
+IMAGE_PROFILES = {
+    'screen': {'dpi_threshold': 120, 'dpi_target': 96, 'quality': 60},
+    'ebook': {'dpi_threshold': 200, 'dpi_target': 150, 'quality': 75},
+    'print': {'dpi_threshold': 400, 'dpi_target': 300, 'quality': 85},
+}
+DEFAULT_IMAGE_PROFILE_MODE = 'auto'
+IMAGE_PROFILE_MODES = ('auto', 'always')
+DEFAULT_IMAGE_PROFILE_MIN_BYTES_PER_PAGE = 256 * 1024
+
+# Cross-document dedupe of identical font and image streams during the merge, so the
+# shared logos and fonts of our statements are written once without a garbage=4 pass.
+# Enable with DEDUPE_RESOURCES or per request with dedupe_resources.
+FONT_FILE_KEYS = ('FontFile', 'FontFile2', 'FontFile3')
+INDIRECT_REFERENCE = re.compile(r'\b(\d+) 0 R\b')
+
+# Source PDF cache in /tmp, keyed by bucket/key/ETag and kept across warm invocations. Off by
+# default: /tmp also holds the file-mode output, spooled stream output and large downloads.
+# Enable with PDF_CACHE_MAX_BYTES (and ephemeral storage sized for it); use_cache: false
+# skips an enabled cache for one request. The directory is PDF_CACHE_DIR. A PDF is only
+# cached while at least PDF_CACHE_MIN_FREE_BYTES would stay free in /tmp afterwards.
+DEFAULT_PDF_CACHE_DIR = '/tmp/pdf-cache'
+DEFAULT_PDF_CACHE_MAX_BYTES = 0
+DEFAULT_PDF_CACHE_MIN_FREE_BYTES = 256 * 1024 * 1024
+
+# Idempotent merges store a fingerprint of the manifest, source ETags and options as
+# user metadata on the output, and skip the job when it already matches. Enable with
+# MERGE_IDEMPOTENCY or per request with idempotent; force in the payload always merges.
+MERGE_FINGERPRINT_METADATA_KEY = 'merge-fingerprint'
+# Parallel HEAD requests for source PDFs. Override with HEAD_CONCURRENCY.
+DEFAULT_HEAD_CONCURRENCY = 32
+
+# Pre-flight sweep (MERGE_PREFLIGHT or per request with preflight): HEAD every source before
+# the merge, fail on missing keys and route the job by its total source bytes. 'memory' jobs
+# spool the output in memory (upload_mode stream), 'disk' jobs flush the merge to /tmp within
+# PREFLIGHT_MEMORY_BUDGET_MB and save to /tmp (upload_mode file), 'chunked' jobs fan out.
+# Override the limits with PREFLIGHT_MEMORY_MAX_BYTES and PREFLIGHT_DISK_MAX_BYTES. Settings
+# given in the request or environment are kept.
+DEFAULT_PREFLIGHT_MEMORY_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_PREFLIGHT_DISK_MAX_BYTES = 4 * 1024 * 1024 * 1024
+DEFAULT_PREFLIGHT_MEMORY_BUDGET_MB = 1024
+MERGE_ROUTES = ('memory', 'disk', 'chunked')
+
+# Append mode (append: true in the payload) records the number and a digest of the merged
+# manifest entries under this key of the output PDF's Info dictionary.
+MERGED_ENTRIES_INFO_KEY = 'PdfMergeEntries'
+
+# Deadline-aware merges, off by default: with MERGE_CHECKPOINTS=true or checkpoint in the
+# request, a merge in Lambda that gets within the checkpoint reserve of the timeout stops
+# after the current manifest entry, uploads the partial merged PDF to
+# <output_file_key>.checkpoint and enqueues a continuation that resumes after the merged
+# entries. The reserve is MERGE_CHECKPOINT_RESERVE_MS, at most a quarter of the time the
+# invocation started with. Continuations are sent to CONTINUATION_QUEUE_URL (SQS) or
+# invoke CONTINUATION_FUNCTION_NAME asynchronously; with neither set, merges don't checkpoint.
+DEFAULT_CHECKPOINT_RESERVE_MS = 60 * 1000
+CHECKPOINT_RESERVE_MAX_FRACTION = 0.25
+CHECKPOINT_KEY_SUFFIX = '.checkpoint'
+
+# Multi-output manifests (multi_output: true in the payload) name several outputs, each with
+# its own entries: {"outputs": [{"key": "acme.pdf", "pdfs": [...]}, ...]}, the keys being
+# relative to output_file_key. Each distinct source is downloaded and opened once for all
+# outputs. Finished outputs are uploaded by MULTI_OUTPUT_UPLOAD_CONCURRENCY threads while
+# the merge goes on.
+DEFAULT_MULTI_OUTPUT_UPLOAD_CONCURRENCY = 4
+# process_merge options a multi-output merge supports
+MULTI_OUTPUT_MERGE_OPTIONS = ('download_concurrency', 'max_bytes_in_flight', 'use_cache')
+
+# Map-reduce fan-out for very large manifests (fanout: true in the payload). Chunks
+# follow byte and page budgets; override with FANOUT_MAX_CHUNK_BYTES, FANOUT_MAX_CHUNK_PAGES,
+# FANOUT_DISPATCHER ('lambda' or 'local'), FANOUT_FUNCTION_NAME and FANOUT_CONCURRENCY.
+# The reduce, which concatenates the chunk PDFs, runs as a job of its own: the 'lambda'
+# dispatcher invokes the sub-jobs asynchronously and the last one to finish starts the
+# reduce, like a continuation (CONTINUATION_QUEUE_URL or an asynchronous invoke). The
+# sub-job that creates FANOUT_REDUCE_CLAIM_SUFFIX under the work prefix starts it.
+FANOUT_REDUCE_CLAIM_SUFFIX = 'reduce.claim'
+DEFAULT_FANOUT_MAX_CHUNK_BYTES = 1024 * 1024 * 1024
+DEFAULT_FANOUT_MAX_CHUNK_PAGES = 0
+DEFAULT_FANOUT_DISPATCHER = 'lambda'
+DEFAULT_FANOUT_CONCURRENCY = 16
+
+# Job metrics: timing spans per phase and per source document, counters, and one
+# structured JSON log line per job in CloudWatch Embedded Metric Format. Turn off with
+# MERGE_METRICS=false; METRICS_NAMESPACE sets the CloudWatch namespace.
+DEFAULT_METRICS_NAMESPACE = 'PdfMerge'
+# Slowest source documents listed in the job log line
+METRICS_SLOWEST_SOURCES = 5
+
+# Manifests are read in chunks and parsed as they arrive, so downloads start before the
+# whole manifest is read. A manifest key ending in '/' is an S3 prefix whose PDFs are
+# merged in key order; .jsonl / .ndjson manifests hold one key per line.
+MANIFEST_READ_SIZE = 64 * 1024
+JSON_LINES_SUFFIXES = ('.jsonl', '.ndjson')
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Text that may still be the rest of a number cut off by the end of a chunk
+JSON_NUMBER_CONTINUATION = re.compile(r'[0-9.eE+-]*')
+# A page or page range in the pages of a manifest entry: "3", "2-5" or "4-"
+PAGE_RANGE = re.compile(r'^\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?$')
+
+# SQS records merged at the same time within one batch. Override with SQS_RECORD_CONCURRENCY.
+# Above 1, each record runs in a process of its own (see run_sqs_records_in_processes), so
+# the function's memory has to hold that many merges; memory budgets apply per record.
+DEFAULT_SQS_RECORD_CONCURRENCY = 1
+
+# Records of one SQS batch that write the same output are coalesced: only the winner runs,
+# the others succeed as superseded. The winner has the highest sequence (payload, a number
+# such as a counter or epoch milliseconds), then the latest SentTimestamp, then the last
+# position in the batch. Turn off with SQS_COALESCE=false.
+SQS_SEQUENCE_KEY = 'sequence'
+
+# Optional payload keys passed through to process_merge / merge_pdfs
+MERGE_OPTION_KEYS = ('download_concurrency', 'max_bytes_in_flight', 'upload_mode', 'memory_budget_mb',
+                     'use_cache', 'idempotent', 'force', 'manifest_bucket', 'fanout', 'fanout_dispatcher',
+                     'fanout_max_chunk_bytes', 'fanout_max_chunk_pages', 'optimize_mode',
+                     'dedupe_resources', 'append', 'image_profile', 'image_profile_mode',
+                     'checkpoint', 'resume', 'preflight', 'multi_output', 'on_source_error', 'save_profile',
+                     'fanout_work_prefix', 'fanout_reduce_key')
+
+
+# Cold starts: fitz, boto3/botocore and multiprocessing are imported in the functions
+# that use them, so invocations that fail validation or never merge don't load them.
+# In Lambda they are preloaded during the init phase instead (see init_preload).
+init_timings = {}
+
+# One S3 client per execution environment, reused across warm invocations
+s3_client = None
+s3_client_lock = threading.Lock()
+
+# PDF cache index: (bucket, key) -> (etag, path, size), least recently used first
+pdf_cache_index = None
+pdf_cache_lock = threading.Lock()
+
+# JobMetrics of the merge job running in this context, None when metrics are off
+job_metrics = contextvars.ContextVar('job_metrics', default=None)
+
+# Lambda context of the running invocation, for its remaining time
+invocation_context = contextvars.ContextVar('invocation_context', default=None)
+
+# Remaining time of the running invocation when it started, for the checkpoint reserve
+invocation_time_ms = contextvars.ContextVar('invocation_time_ms', default=None)
 
 def lambda_handler(event, context):
+    context_token = invocation_context.set(context)
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    time_token = invocation_time_ms.set(get_remaining_time() if get_remaining_time is not None else None)
     try:
         print('start merge pdf')
         print('event:', event)
         
-        handle(event)
+        result = handle(event)
         
-        return {
+        response = {
             'statusCode': 200,
             'body': json.dumps({'message': 'PDF merge completed successfully'})
         }
+        # SQS partial batch response (ReportBatchItemFailures): only these messages are retried
+        if isinstance(result, dict) and 'batchItemFailures' in result:
+            response['batchItemFailures'] = result['batchItemFailures']
+        return response
     except Exception as e:
         error_message = str(e)
         stack_trace = traceback.format_exc()
@@ -27,6 +266,9 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': json.dumps({'error': error_message})
         }
+    finally:
+        invocation_time_ms.reset(time_token)
+        invocation_context.reset(context_token)
 
 def handle(event):
     try:
@@ -37,28 +279,16 @@ def handle(event):
             optimize_pdf = event.get('optimize_pdf', False)
             print(f'optimize_pdf: {optimize_pdf}')
             process_merge(event['input_bucket'], event['input_file_key'], 
-                         event['output_bucket'], event['output_file_key'], optimize_pdf)
+                         event['output_bucket'], event['output_file_key'], optimize_pdf,
+                         **get_merge_options(event))
         elif 'Records' in event:
             print('SQS')
             for rec in event['Records']:
-                # get input from SQS events
-                if 'messageId' in rec:
-                    print('SQS')
-                    message = json.loads(rec['body'])
-                    if 'input_bucket' in message:
-                        # Check for optimize_pdf in SQS message, default to false
-                        optimize_pdf = message.get('optimize_pdf', False)
-                        print(f'optimize_pdf: {optimize_pdf}')
-                        process_merge(message['input_bucket'], message['input_file_key'], 
-                                     message['output_bucket'], message['output_file_key'], optimize_pdf)
-                    else:
-                        error_msg = 'SQS JSON has an unrecognized format. Missing key for input_bucket or input_string.'
-                        print(error_msg)
-                        raise Exception(error_msg)
-                else:
+                if 'messageId' not in rec:
                     error_msg = 'Records JSON has an unrecognized format. Missing key for input_bucket or input_string.'
                     print(error_msg)
                     raise Exception(error_msg)
+            return process_sqs_records(event['Records'])
         else:
             error_msg = 'JSON has an unrecognized format. NOT a CLI or SQS.'
             print(error_msg)
@@ -66,169 +296,3267 @@ def handle(event):
     except Exception as e:
         print(f"Error in handle: {str(e)}")
         raise
+
+def process_sqs_records(records, record_concurrency=None):
+    """
+    Process SQS records and report the ones that failed.
+    
+    Each record is merged on its own, so one bad record no longer fails the
+    batch. The result is a ReportBatchItemFailures response: SQS retries only
+    the listed message IDs. The event source mapping must have
+    ReportBatchItemFailures enabled.
+    
+    Records that write the same output are coalesced first (see
+    coalesce_sqs_records); superseded records count as handled.
+    
+    Records run one at a time in this process unless record_concurrency is raised,
+    in which case each one runs in a child process (see run_sqs_records_in_processes).
+    
+    Args:
+        records (list): SQS records from the Lambda event
+        record_concurrency (int): Records processed at once, defaults to SQS_RECORD_CONCURRENCY env
+    
+    Returns:
+        dict: {'batchItemFailures': [{'itemIdentifier': messageId}, ...]}
+    """
+    record_concurrency = max(1, record_concurrency or get_env_int('SQS_RECORD_CONCURRENCY', DEFAULT_SQS_RECORD_CONCURRENCY))
+    print(f"Processing {len(records)} SQS records, record_concurrency: {record_concurrency}")
+    superseded = []
+    if get_env_bool('SQS_COALESCE', True):
+        records, superseded = coalesce_sqs_records(records)
+    
+    if record_concurrency == 1 or len(records) < 2:
+        results = [process_sqs_record(rec) for rec in records]
+    else:
+        results = run_sqs_records_in_processes(records, record_concurrency)
+    
+    failures = [{'itemIdentifier': result['messageId']} for result in results if result['status'] == 'failed']
+    print(f"SQS batch done: {len(records) - len(failures)} succeeded, {len(failures)} failed, "
+          f"{len(superseded)} superseded")
+    return {'batchItemFailures': failures}
+
+def run_sqs_records_in_processes(records, record_concurrency):
+    """
+    Process SQS records in child processes, up to record_concurrency at a time.
+    
+    Each record gets a process of its own, forked from this one, that runs
+    process_sqs_record and sends the result back over a pipe. Records share no
+    MuPDF state, RSS-based memory budgets measure a single record, and the worker
+    processes of parallel_map are forked from the record's process. Record
+    processes are not daemonic, so they can start those workers. A record whose
+    process exits without a result, e.g. killed for running out of memory, fails.
+    
+    Args:
+        records (list): SQS records to process
+        record_concurrency (int): Record processes running at once
+    
+    Returns:
+        list: Record results from process_sqs_record, in the order of records
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait as wait_for_connections
+    pending = deque(enumerate(records))
+    results = [None] * len(records)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < record_concurrency:
+                index, rec = pending.popleft()
+                reader, writer = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=sqs_record_worker, args=(writer, rec))
+                process.start()
+                writer.close()
+                running[reader] = (index, process)
+            
+            for reader in wait_for_connections(list(running)):
+                index, process = running.pop(reader)
+                try:
+                    results[index] = reader.recv()
+                except EOFError:
+                    pass
+                reader.close()
+                process.join()
+                if results[index] is None:
+                    results[index] = {'messageId': records[index]['messageId'], 'status': 'failed',
+                                      'error': f"Record process exited with code {process.exitcode}"}
+                    print(f"SQS record result: {json.dumps(results[index])}")
+    finally:
+        for reader, (_, process) in running.items():
+            reader.close()
+            process.terminate()
+            process.join()
+    return results
+
+def sqs_record_worker(conn, rec):
+    """Record process of run_sqs_records_in_processes: process one SQS record and send its result."""
+    # The S3 client's pooled connections were inherited from the parent, the record opens its own
+    if hasattr(s3_client, 'close'):
+        s3_client.close()
+    conn.send(process_sqs_record(rec))
+    conn.close()
+
+def coalesce_sqs_records(records):
+    """
+    Keep one record per output of an SQS batch, the one that takes effect.
+    
+    Records are grouped by output bucket and key. In each group the winner has the
+    highest payload sequence, then the latest SentTimestamp, then the last position
+    in the batch; records with a sequence win over those without. Records that can't
+    be parsed, multi_output records (whose output key is a prefix), continuations
+    (resume) and fan-out sub-jobs and reduces (fanout_reduce_key, fanout_work_prefix),
+    which other jobs wait on or clean up after, are never coalesced.
+    
+    Args:
+        records (list): SQS records from the Lambda event
+    
+    Returns:
+        tuple: (records to run in batch order, results of the superseded records)
+    """
+    groups = OrderedDict()
+    ungrouped = []
+    for position, rec in enumerate(records):
+        try:
+            message = json.loads(rec['body'])
+            output = (message['output_bucket'], message['output_file_key'])
+        except (KeyError, TypeError, ValueError):
+            ungrouped.append(rec)
+            continue
+        sequence = message.get(SQS_SEQUENCE_KEY)
+        if message.get('multi_output') or message.get('resume') or message.get('fanout_reduce_key') or \
+                message.get('fanout_work_prefix') or isinstance(sequence, bool) or \
+                (sequence is not None and not isinstance(sequence, (int, float))):
+            ungrouped.append(rec)
+            continue
+        try:
+            sent_timestamp = int(rec.get('attributes', {}).get('SentTimestamp', 0))
+        except ValueError:
+            sent_timestamp = 0
+        rank = (sequence is not None, sequence or 0, sent_timestamp, position)
+        groups.setdefault(output, []).append((rank, rec))
+    
+    winners = set(id(rec) for rec in ungrouped)
+    superseded = []
+    for (output_bucket, output_file_key), group in groups.items():
+        _, winner = max(group, key=lambda item: item[0])
+        winners.add(id(winner))
+        if len(group) == 1:
+            continue
+        losers = [rec for _, rec in group if rec is not winner]
+        print(f"SQS coalesce: {len(group)} records for s3://{output_bucket}/{output_file_key}, running "
+              f"{winner['messageId']}, superseded: {', '.join(rec['messageId'] for rec in losers)}")
+        for rec in losers:
+            result = {'messageId': rec['messageId'], 'status': 'superseded', 'superseded_by': winner['messageId'],
+                      'duplicate': rec['body'] == winner['body'], 'duration_ms': 0}
+            print(f"SQS record result: {json.dumps(result)}")
+            superseded.append(result)
+    return [rec for rec in records if id(rec) in winners], superseded
+
+def process_sqs_record(rec):
+    """
+    Run the merge for one SQS record, catching its errors.
+    
+    Args:
+        rec (dict): SQS record with messageId and a JSON body
+    
+    Returns:
+        dict: Record result with messageId, status ('succeeded' or 'failed'), duration_ms and error
+    """
+    start = time.perf_counter()
+    result = {'messageId': rec['messageId'], 'status': 'succeeded'}
+    try:
+        # get input from SQS events
+        message = json.loads(rec['body'])
+        if 'input_bucket' in message:
+            # Check for optimize_pdf in SQS message, default to false
+            optimize_pdf = message.get('optimize_pdf', False)
+            print(f'optimize_pdf: {optimize_pdf}')
+            process_merge(message['input_bucket'], message['input_file_key'], 
+                         message['output_bucket'], message['output_file_key'], optimize_pdf,
+                         **get_merge_options(message))
+        else:
+            error_msg = 'SQS JSON has an unrecognized format. Missing key for input_bucket or input_string.'
+            print(error_msg)
+            raise Exception(error_msg)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    result['duration_ms'] = round((time.perf_counter() - start) * 1000)
+    print(f"SQS record result: {json.dumps(result)}")
+    return result
+
+def get_merge_options(payload):
+    """
+    Collect the optional merge settings present in a CLI or SQS payload.
+    
+    Args:
+        payload (dict): CLI event or decoded SQS message body
+    
+    Returns:
+        dict: Keyword arguments for process_merge, only for keys present in the payload
+    """
+    return {key: payload[key] for key in MERGE_OPTION_KEYS if key in payload}
+
+def get_env_bool(name, default):
+    """
+    Read a true/false setting from an environment variable.
+    
+    Args:
+        name (str): Environment variable name
+        default (bool): Value used when the variable is unset or empty
+    
+    Returns:
+        bool: True for 1/true/yes/on, False otherwise
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def get_env_int(name, default):
+    """
+    Read an integer setting from an environment variable.
+    
+    Args:
+        name (str): Environment variable name
+        default (int): Value used when the variable is unset or empty
+    
+    Returns:
+        int: The configured value
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise Exception(f"Environment variable {name} must be an integer, got: {value}")
+  
+def get_save_profile(save_profile=None):
+    """
+    Resolve the save profile of a merge.
+    
+    Args:
+        save_profile (str): Key of SAVE_PROFILES from the request, defaults to SAVE_PROFILE env
+    
+    Returns:
+        str: The profile name, or None when neither the request nor the environment selects one
+    """
+    save_profile = save_profile or os.environ.get('SAVE_PROFILE') or None
+    if save_profile is not None and save_profile not in SAVE_PROFILES:
+        raise Exception(f"Unknown save_profile: {save_profile}. Expected one of {', '.join(SAVE_PROFILES)}")
+    return save_profile
   
-def process_merge(input_bucket, input_file_key, output_bucket, output_file_key, optimize_pdf=False):
+def process_merge(input_bucket, input_file_key, output_bucket, output_file_key, optimize_pdf=False,
+                  upload_mode=None, idempotent=None, force=False, manifest_bucket=None, fanout=False,
+                  fanout_dispatcher=None, fanout_max_chunk_bytes=None, fanout_max_chunk_pages=None,
+                  append=False, checkpoint=None, resume=None, preflight=None, multi_output=False,
+                  fanout_work_prefix=None, fanout_reduce_key=None, **merge_options):
+    metrics_token = start_job_metrics(input_bucket=input_bucket, input_file_key=input_file_key,
+                                      output_bucket=output_bucket, output_file_key=output_file_key)
+    error = None
+    # A checkpointed fan-out reduce keeps its work prefix, the continuation still reads it;
+    # a failed one keeps it for its retry, or for the lifecycle rule on .fanout/ keys
+    checkpointed = False
     try:
+        if fanout:
+            return process_fanout_merge(input_bucket, input_file_key, output_bucket, output_file_key, optimize_pdf,
+                                        dispatcher=fanout_dispatcher, max_chunk_bytes=fanout_max_chunk_bytes,
+                                        max_chunk_pages=fanout_max_chunk_pages, manifest_bucket=manifest_bucket,
+                                        upload_mode=upload_mode, **merge_options)
+        if multi_output:
+            if append or resume:
+                raise Exception("multi_output can't be combined with append or resume")
+            return process_multi_output_merge(input_bucket, input_file_key, output_bucket, output_file_key,
+                                              optimize_pdf, upload_mode=upload_mode, manifest_bucket=manifest_bucket,
+                                              **merge_options)
+
+        print(f"Processing PDFs from manifest: s3://{manifest_bucket or input_bucket}/{input_file_key}")
+        # Keys are read from the manifest as the merge needs them, unless the pre-flight sweep needs them all
+        pdf_keys = iter_pdf_s3_keys(manifest_bucket or input_bucket, input_file_key)
+        
+        # Check every source and pick the merge strategy before downloading anything
+        if preflight is None:
+            preflight = get_env_bool('MERGE_PREFLIGHT', False)
+        source_heads = None
+        if preflight and not resume:
+            pdf_keys = list(pdf_keys)
+            source_heads = preflight_sources(input_bucket, pdf_keys)
+            total_bytes = sum(head['size'] for head in source_heads.values())
+            route = choose_merge_route(total_bytes)
+            if route == 'chunked' and append:
+                # Append mode updates the output in place, so it can't be split
+                route = 'disk'
+            print(f"Pre-flight: {len(source_heads)} sources, {total_bytes} bytes, route: {route}")
+            count_metric('preflight_bytes', total_bytes)
+            count_metric(f"route_{route}")
+            if route == 'chunked':
+                return process_fanout_merge(input_bucket, input_file_key, output_bucket, output_file_key, optimize_pdf,
+                                            dispatcher=fanout_dispatcher, max_chunk_bytes=fanout_max_chunk_bytes,
+                                            max_chunk_pages=fanout_max_chunk_pages, manifest_bucket=manifest_bucket,
+                                            source_heads=source_heads,
+                                            upload_mode=upload_mode or os.environ.get('UPLOAD_MODE') or 'stream',
+                                            **merge_options)
+            upload_mode = upload_mode or os.environ.get('UPLOAD_MODE') or ('stream' if route == 'memory' else 'file')
+            if route == 'disk' and 'memory_budget_mb' not in merge_options and not os.environ.get('MERGE_MEMORY_BUDGET_MB'):
+                merge_options['memory_budget_mb'] = get_env_int('PREFLIGHT_MEMORY_BUDGET_MB',
+                                                                DEFAULT_PREFLIGHT_MEMORY_BUDGET_MB)
+        
+        if idempotent is None:
+            idempotent = get_env_bool('MERGE_IDEMPOTENCY', False)
+        source_error_policy = (merge_options.get('on_source_error') or os.environ.get('SOURCE_ERROR_POLICY') or
+                               DEFAULT_SOURCE_ERROR_POLICY)
+        upload_mode = upload_mode or os.environ.get('UPLOAD_MODE') or DEFAULT_UPLOAD_MODE
+        if upload_mode not in UPLOAD_MODES:
+            raise Exception(f"Unknown upload_mode: {upload_mode}. Expected one of {', '.join(UPLOAD_MODES)}")
+
         print('input_bucket:',input_bucket)
         print('input_file_key:',input_file_key)
         print('output_bucket:',output_bucket)
         print('output_file_key:', output_file_key)
         print('optimize_pdf:', optimize_pdf)
-
-        # final output file name
-        guid = str(uuid.uuid4())
-        local_output_file = f'/tmp/{guid}.pdf'
-
-        print(f"Processing PDFs from JSON file: s3://{input_bucket}/{input_file_key}")
-        pdf_keys = get_pdf_s3_keys(input_bucket, input_file_key)
+        print('upload_mode:', upload_mode)
+        print('idempotent:', idempotent, 'force:', force)
+        if append:
+            print('append:', append)
+        if resume:
+            print('resume:', resume)
+        if merge_options:
+            print('merge_options:', merge_options)
         
-        print(f"Downloading and merging PDFs from S3")
-        merge_pdfs(input_bucket, pdf_keys, local_output_file, optimize_pdf)
+        # Skip the job when the output already holds this exact merge
+        metadata = None
+        if idempotent:
+            pdf_keys = list(pdf_keys)
+            source_heads = source_heads or head_pdf_objects(input_bucket,
+                                                            [parse_manifest_entry(entry)[0] for entry in pdf_keys])
+            options = {'optimize_pdf': bool(optimize_pdf)}
+            image_profile = merge_options.get('image_profile') or os.environ.get('IMAGE_PROFILE')
+            if image_profile:
+                # Image profiles change the output, merges without one keep their fingerprint
+                options['image_profile'] = image_profile
+                options['image_profile_mode'] = (merge_options.get('image_profile_mode') or
+                                                 os.environ.get('IMAGE_PROFILE_MODE') or DEFAULT_IMAGE_PROFILE_MODE)
+            if source_error_policy != 'fail':
+                options['on_source_error'] = source_error_policy
+            save_profile = get_save_profile(merge_options.get('save_profile'))
+            if save_profile:
+                options['save_profile'] = save_profile
+            fingerprint = compute_merge_fingerprint(input_bucket, pdf_keys, source_heads, options)
+            metadata = {MERGE_FINGERPRINT_METADATA_KEY: fingerprint}
+            if force:
+                print(f"force is set, merging even if the output matches fingerprint {fingerprint}")
+            elif get_output_fingerprint(output_bucket, output_file_key) == fingerprint:
+                print(f"s3://{output_bucket}/{output_file_key} already matches fingerprint {fingerprint}, skipping merge")
+                count_metric('skipped')
+                return
         
-        print(f"Uploading merged PDF to S3: s3://{output_bucket}/{output_file_key}")
-        upload_file_to_s3(output_bucket, output_file_key, local_output_file)
+        if append:
+            # force rebuilds the output from scratch
+            stats = process_append_merge(input_bucket, pdf_keys, output_bucket, output_file_key, optimize_pdf,
+                                         upload_mode=upload_mode, metadata=metadata, rebuild=force, **merge_options)
+            if stats is not None:
+                write_source_error_report(output_bucket, output_file_key, source_error_policy, stats['quarantined'])
+            return
+        
+        # Checkpoints need the remaining time of a Lambda invocation and somewhere to send the continuation
+        if checkpoint is None:
+            checkpoint = get_env_bool('MERGE_CHECKPOINTS', False)
+        checkpoint = bool(checkpoint) and invocation_context.get() is not None
+        if checkpoint and not continuation_target_configured():
+            print("Checkpoints need CONTINUATION_QUEUE_URL or CONTINUATION_FUNCTION_NAME, merging without them")
+            checkpoint = False
+        checkpoint_key = f"{output_file_key}{CHECKPOINT_KEY_SUFFIX}"
+        # Manifest entries already in the checkpoint, and those read by this invocation
+        checkpoint_entries = []
+        read_entries = []
+        resume_file = None
+        if resume:
+            pdf_keys, checkpoint_entries, resume_file = resume_from_checkpoint(output_bucket, pdf_keys, resume)
+        if checkpoint:
+            pdf_keys = record_entries(pdf_keys, read_entries)
+        
+        if upload_mode == 'stream':
+            # Save into memory, spilling to /tmp only for large outputs, and upload in parts
+            spool_max_memory = get_env_int('UPLOAD_SPOOL_MAX_MEMORY', DEFAULT_UPLOAD_SPOOL_MAX_MEMORY)
+            with SpooledOutput(spool_max_memory) as output_buffer:
+                print(f"Downloading and merging PDFs from S3")
+                stats = merge_pdfs(input_bucket, pdf_keys, output_buffer, optimize_pdf, resume_from=resume_file,
+                                   stop_at_deadline=checkpoint, **merge_options)
+                print(f"Merged PDF is {output_buffer.size()} bytes, spooled to {'/tmp' if output_buffer.rolled else 'memory'}")
+                
+                # An interrupted merge goes to the checkpoint, without the output's metadata
+                if checkpoint and stats['interrupted']:
+                    checkpoint_entries += read_entries[:stats['entries']]
+                    upload_checkpoint(output_bucket, checkpoint_key, output_buffer, checkpoint_entries)
+                else:
+                    print(f"Uploading merged PDF to S3: s3://{output_bucket}/{output_file_key}")
+                    with metrics_span('upload'):
+                        upload_fileobj_to_s3(output_bucket, output_file_key, output_buffer, metadata=metadata)
+        else:
+            # final output file name
+            guid = str(uuid.uuid4())
+            local_output_file = f'/tmp/{guid}.pdf'
+
+            print(f"Downloading and merging PDFs from S3")
+            stats = merge_pdfs(input_bucket, pdf_keys, local_output_file, optimize_pdf, resume_from=resume_file,
+                               stop_at_deadline=checkpoint, **merge_options)
             
-        # clean up temp files
-        if os.path.isfile(local_output_file):
-            os.remove(local_output_file)
+            if checkpoint and stats['interrupted']:
+                checkpoint_entries += read_entries[:stats['entries']]
+                upload_checkpoint(output_bucket, checkpoint_key, local_output_file, checkpoint_entries)
+            else:
+                print(f"Uploading merged PDF to S3: s3://{output_bucket}/{output_file_key}")
+                with metrics_span('upload'):
+                    upload_file_to_s3(output_bucket, output_file_key, local_output_file, metadata=metadata)
+                
+            # clean up temp files
+            if os.path.isfile(local_output_file):
+                os.remove(local_output_file)
+        
+        # Sources quarantined by earlier invocations of a checkpointed job come with its continuation
+        quarantined = (resume or {}).get('quarantined', []) + stats['quarantined']
+        if checkpoint and stats['interrupted']:
+            # The continuation is this job again, resuming after the checkpointed entries
+            payload = {'input_bucket': input_bucket, 'input_file_key': input_file_key,
+                       'output_bucket': output_bucket, 'output_file_key': output_file_key,
+                       'optimize_pdf': optimize_pdf, 'upload_mode': upload_mode, 'idempotent': idempotent,
+                       'force': force, 'manifest_bucket': manifest_bucket,
+                       'fanout_work_prefix': fanout_work_prefix, **merge_options,
+                       'resume': {'checkpoint_key': checkpoint_key, 'entries': len(checkpoint_entries),
+                                  'digest': merged_entries_digest(checkpoint_entries), 'quarantined': quarantined}}
+            enqueue_continuation({key: value for key, value in payload.items() if value is not None})
+            checkpointed = True
+            count_metric('checkpoints')
+            print(f"Checkpointed {len(checkpoint_entries)} merged manifest entries to "
+                  f"s3://{output_bucket}/{checkpoint_key}, a continuation merges the rest")
+        else:
+            if resume_file is not None:
+                get_s3_client().delete_objects(Bucket=output_bucket,
+                                               Delete={'Objects': [{'Key': checkpoint_key}], 'Quiet': True})
+            write_source_error_report(output_bucket, output_file_key, source_error_policy, quarantined)
+            if fanout_reduce_key:
+                complete_fanout_chunk(output_bucket, fanout_reduce_key)
     except Exception as e:
+        error = e
         print(f"Error in process_merge: {str(e)}")
         raise
+    finally:
+        if fanout_work_prefix and not checkpointed and error is None:
+            # The reduce of a fan-out is done with the chunk manifests and PDFs
+            delete_s3_prefix(output_bucket, fanout_work_prefix)
+        finish_job_metrics(metrics_token, error)
 
-def get_pdf_s3_keys(input_bucket, input_file_key):
+def process_append_merge(input_bucket, pdf_keys, output_bucket, output_file_key, optimize_pdf=False,
+                         upload_mode=None, metadata=None, rebuild=False, **merge_options):
     """
-    Read a JSON file from S3 containing PDF filenames and extract the PDF list.
+    Bring a growing merged PDF up to date by appending the manifest's new entries.
+    
+    The output records how many manifest entries it holds and a digest of them
+    (see record_merged_entries). When the manifest still starts with exactly those
+    entries, the output is downloaded, only the entries after them are merged into
+    it, and it is written back with an incremental save. The merge and save work
+    then follows the new entries, not the whole document. Otherwise, with no output
+    yet, no record, a changed earlier entry, a PDF that cannot be saved incrementally
+    or rebuild set, the output is merged from scratch.
     
     Args:
-        input_bucket (str): S3 bucket containing the JSON file
-        input_file_key (str): S3 object key for the JSON file
+        input_bucket (str): S3 bucket containing the source PDFs
+        pdf_keys (iterable): Manifest entries in merge order
+        output_bucket (str): S3 bucket for the merged PDF
+        output_file_key (str): S3 object key for the merged PDF
+        optimize_pdf (bool): Optimize full rebuilds; appends are never optimized
+        upload_mode (str): 'file' or 'stream'
+        metadata (dict): S3 user metadata to store on the output
+        rebuild (bool): Merge from scratch even if the output could be appended to
+        **merge_options: Options passed to merge_pdfs, save_profile only for full rebuilds
     
     Returns:
-        list: Array of PDF filenames
+        dict: Merge statistics from merge_pdfs, or None if the output was up to date
     """
+    pdf_keys = list(pdf_keys)
+    # Like optimize_pdf, a save profile rewrites the whole file and only applies to full rebuilds
+    append_options = {key: value for key, value in merge_options.items() if key != 'save_profile'}
+    local_output_file = f'/tmp/{uuid.uuid4()}.pdf'
     try:
-        print(f"Retrieving JSON file from S3: s3://{input_bucket}/{input_file_key}")
-        # Create S3 client
-        s3 = boto3.client('s3')
-        
-        # Get the JSON file directly from S3
-        response = s3.get_object(Bucket=input_bucket, Key=input_file_key)
-        
-        # Read the JSON content from the response
-        json_content = response['Body'].read().decode('utf-8')
-        
-        # Parse the JSON data
-        json_data = json.loads(json_content)
+        new_entries = None
+        if rebuild:
+            print("Rebuilding the output from scratch")
+        elif download_s3_object_to_file(output_bucket, output_file_key, local_output_file):
+            merged_count = get_appendable_entry_count(local_output_file, pdf_keys)
+            if merged_count is not None:
+                new_entries = pdf_keys[merged_count:]
+        else:
+            print(f"s3://{output_bucket}/{output_file_key} does not exist yet")
         
-        # Extract the array of PDF filenames
-        pdf_files = json_data.get('pdfs', [])
+        if new_entries == []:
+            print(f"s3://{output_bucket}/{output_file_key} already holds all {len(pdf_keys)} manifest entries")
+            count_metric('skipped')
+            return None
         
-        if not pdf_files:
-            print("Warning: No PDF files found in JSON")
-            return []
+        if new_entries is None:
+            print(f"Merging all {len(pdf_keys)} manifest entries")
+            stats = merge_pdfs(input_bucket, pdf_keys, local_output_file, optimize_pdf, **merge_options)
+        else:
+            print(f"Appending {len(new_entries)} new manifest entries after the {len(pdf_keys) - len(new_entries)} "
+                  f"already merged{' (optimize_pdf only applies to full rebuilds)' if optimize_pdf else ''}")
+            count_metric('appended_entries', len(new_entries))
+            stats = merge_pdfs(input_bucket, new_entries, local_output_file, append_to=local_output_file,
+                               **append_options)
+        record_merged_entries(local_output_file, pdf_keys)
         
-        print(f"Found {len(pdf_files)} PDFs to process")
-        return pdf_files
+        print(f"Uploading merged PDF to S3: s3://{output_bucket}/{output_file_key}")
+        with metrics_span('upload'):
+            if upload_mode == 'stream':
+                with open(local_output_file, 'rb') as output:
+                    upload_fileobj_to_s3(output_bucket, output_file_key, output, metadata=metadata)
+            else:
+                upload_file_to_s3(output_bucket, output_file_key, local_output_file, metadata=metadata)
+        return stats
+    finally:
+        if os.path.isfile(local_output_file):
+            os.remove(local_output_file)
+
+def get_appendable_entry_count(local_file, pdf_keys):
+    """
+    Check whether an existing merged PDF can be appended to for this manifest.
     
-    except json.JSONDecodeError as e:
-        error_msg = f"Error parsing JSON data from S3: {e}"
-        print(error_msg)
-        raise Exception(error_msg)
+    Args:
+        local_file (str): Path of the existing merged PDF
+        pdf_keys (list): Manifest entries in merge order
+    
+    Returns:
+        int: Number of leading manifest entries the PDF already holds, or None if it
+             has to be rebuilt
+    """
+    import fitz
+    try:
+        document = fitz.open(local_file)
     except Exception as e:
-        error_msg = f"Error retrieving or processing S3 object: {e}"
-        print(error_msg)
-        raise Exception(error_msg)
+        print(f"Existing output cannot be opened ({e}), rebuilding it")
+        return None
+    try:
+        if not document.is_pdf or document.needs_pass or not document.can_save_incrementally():
+            print("Existing output cannot be saved incrementally, rebuilding it")
+            return None
+        record = read_merged_entries(document)
+    finally:
+        document.close()
+    
+    if record is None:
+        print("Existing output has no record of its merged entries, rebuilding it")
+        return None
+    merged_count, digest = record
+    if merged_count > len(pdf_keys) or merged_entries_digest(pdf_keys[:merged_count]) != digest:
+        print(f"The manifest no longer starts with the {merged_count} merged entries, rebuilding the output")
+        return None
+    return merged_count
+
+def merged_entries_digest(pdf_keys):
+    """SHA-256 of a list of manifest entries."""
+    return hashlib.sha256(json.dumps(pdf_keys, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def read_merged_entries(document):
+    """
+    Read the merged entries record from a PDF's Info dictionary.
     
-def download_pdf_from_s3(s3_bucket, s3_key):
+    Returns:
+        tuple: (entry count, digest), or None if the PDF has no record
     """
-    Download a PDF file from S3 and return its binary content.
+    info_type, info = document.xref_get_key(-1, 'Info')
+    if info_type != 'xref':
+        return None
+    record_type, record = document.xref_get_key(int(info.split()[0]), MERGED_ENTRIES_INFO_KEY)
+    if record_type != 'string' or not re.fullmatch(r'\d+ [0-9a-f]{64}', record):
+        return None
+    merged_count, digest = record.split()
+    return int(merged_count), digest
+
+def clear_merged_entries(document):
+    """Remove the merged entries record from an open PDF's Info dictionary, if it has one."""
+    info_type, info = document.xref_get_key(-1, 'Info')
+    if info_type == 'xref':
+        document.xref_set_key(int(info.split()[0]), MERGED_ENTRIES_INFO_KEY, 'null')
+
+def record_merged_entries(local_file, pdf_keys):
+    """Store the number and digest of the merged manifest entries in a PDF's Info dictionary, incrementally."""
+    import fitz
+    document = fitz.open(local_file)
+    try:
+        info_type, info = document.xref_get_key(-1, 'Info')
+        if info_type == 'xref':
+            info_xref = int(info.split()[0])
+        else:
+            info_xref = document.get_new_xref()
+            document.update_object(info_xref, '<<>>')
+            document.xref_set_key(-1, 'Info', f"{info_xref} 0 R")
+        document.xref_set_key(info_xref, MERGED_ENTRIES_INFO_KEY,
+                              f"({len(pdf_keys)} {merged_entries_digest(pdf_keys)})")
+        document.saveIncr()
+    finally:
+        document.close()
+
+def write_source_error_report(output_bucket, output_file_key, policy, quarantined):
+    """
+    Write the report of quarantined sources next to the output, or remove an earlier one.
+    
+    The report is <output_file_key>.errors.json. Nothing is written or removed
+    under the 'fail' policy, where a bad source fails the job.
     
     Args:
-        s3_key (str): S3 object key for the PDF file
+        output_bucket (str): S3 bucket of the merged PDF
+        output_file_key (str): S3 object key of the merged PDF
+        policy (str): Source error policy of the job
+        quarantined (list): Quarantined sources from merge_pdfs stats
+    """
+    if policy == 'fail':
+        return
+    report_key = f"{output_file_key}{SOURCE_ERROR_REPORT_SUFFIX}"
+    s3 = get_s3_client()
+    if not quarantined:
+        # A clean merge replaces the output a report may have been written for
+        s3.delete_objects(Bucket=output_bucket, Delete={'Objects': [{'Key': report_key}], 'Quiet': True})
+        return
+    report = {'output_bucket': output_bucket, 'output_file_key': output_file_key, 'policy': policy,
+              'quarantined': quarantined}
+    s3.put_object(Bucket=output_bucket, Key=report_key, Body=json.dumps(report, indent=2).encode('utf-8'),
+                  ContentType='application/json')
+    print(f"{len(quarantined)} quarantined sources reported in s3://{output_bucket}/{report_key}")
+
+def download_s3_object_to_file(s3_bucket, s3_key, local_file):
+    """
+    Download an S3 object to a local file.
     
     Returns:
-        bytes: Binary content of the PDF file
+        bool: True if downloaded, False if the object doesn't exist
     """
+    from botocore.exceptions import ClientError
     try:
-        s3 = boto3.client('s3')
-        response = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-        return response['Body'].read()
+        response = get_s3_client().get_object(Bucket=s3_bucket, Key=s3_key)
+    except ClientError as e:
+        if (e.response.get('Error', {}).get('Code') == 'NoSuchKey' or
+                e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404):
+            return False
+        raise
+    with open(local_file, 'wb') as file:
+        shutil.copyfileobj(response['Body'], file)
+    return True
+
+def resume_from_checkpoint(output_bucket, pdf_keys, resume):
+    """
+    Pick up a merge where an earlier invocation checkpointed it.
+    
+    The continuation names the checkpoint and the manifest entries it was sent for
+    (resume['entries'] and their digest), but the checkpoint object itself records the
+    entries it holds (see upload_checkpoint). A duplicate or retried continuation can
+    find a checkpoint a later invocation has already moved on, so the merge resumes
+    after the entries in that record, as long as the manifest starts with them. It
+    starts over when the manifest no longer starts with the continuation's entries,
+    or the checkpoint is missing, has no record or holds other entries.
+    
+    Args:
+        output_bucket (str): S3 bucket holding the checkpoint
+        pdf_keys (iterable): Manifest entries in merge order
+        resume (dict): checkpoint_key, entries and digest, as sent in the continuation
+    
+    Returns:
+        tuple: (manifest entries left to merge, entries in the checkpoint, local path of
+               the checkpoint), the last two [] and None when starting over
+    """
+    import fitz
+    pdf_keys = iter(pdf_keys)
+    resume_entries = list(itertools.islice(pdf_keys, int(resume['entries'])))
+    pdf_keys = itertools.chain(resume_entries, pdf_keys)
+    if (len(resume_entries) != int(resume['entries']) or
+            merged_entries_digest(resume_entries) != resume['digest']):
+        print("The manifest no longer starts with the checkpointed entries, merging from the start")
+        return pdf_keys, [], None
+    
+    local_file = f'/tmp/{uuid.uuid4()}-checkpoint.pdf'
+    if not download_s3_object_to_file(output_bucket, resume['checkpoint_key'], local_file):
+        print(f"s3://{output_bucket}/{resume['checkpoint_key']} does not exist, merging from the start")
+        return pdf_keys, [], None
+    try:
+        document = fitz.open(local_file)
+        try:
+            record = read_merged_entries(document)
+        finally:
+            document.close()
     except Exception as e:
-        error_msg = f"Error downloading PDF from S3: {e}"
-        print(error_msg)
-        raise Exception(error_msg)
+        print(f"Checkpoint cannot be opened ({e})")
+        record = None
+    
+    if record is None:
+        print("The checkpoint has no record of its merged entries, merging from the start")
+    else:
+        merged_count, digest = record
+        checkpoint_entries = list(itertools.islice(pdf_keys, merged_count))
+        if len(checkpoint_entries) == merged_count and merged_entries_digest(checkpoint_entries) == digest:
+            if merged_count != len(resume_entries):
+                print(f"The checkpoint holds {merged_count} manifest entries, not the {len(resume_entries)} "
+                      f"this continuation was sent for")
+            print(f"Resuming after {merged_count} merged manifest entries from "
+                  f"s3://{output_bucket}/{resume['checkpoint_key']}")
+            return pdf_keys, checkpoint_entries, local_file
+        pdf_keys = itertools.chain(checkpoint_entries, pdf_keys)
+        print("The manifest doesn't start with the entries in the checkpoint, merging from the start")
+    os.remove(local_file)
+    return pdf_keys, [], None
 
-def merge_pdfs(input_s3_bucket, s3_keys, output_file,optimize_pdf=False):
+def upload_checkpoint(output_bucket, checkpoint_key, merged_output, checkpoint_entries):
     """
-    Merge multiple PDF files into a single PDF.
+    Upload the partial merged PDF of an interrupted merge as its checkpoint.
+    
+    The checkpoint records the number and a digest of the manifest entries it holds
+    in its Info dictionary, like append mode outputs, for resume_from_checkpoint to
+    check against. A spooled output is written to /tmp first for that.
     
     Args:
-        input_s3_bucket (str): S3 bucket name containing the PDF files
-        s3_keys (list): Array of S3 object keys for the PDFs to merge
-        output_file (str): Path to save the merged PDF
+        output_bucket (str): S3 bucket for the checkpoint
+        checkpoint_key (str): S3 object key of the checkpoint
+        merged_output: Local path of the partial merged PDF, or a SpooledOutput holding it
+        checkpoint_entries (list): Manifest entries merged so far, over all invocations
     """
+    local_file = merged_output
+    if not isinstance(merged_output, str):
+        local_file = f'/tmp/{uuid.uuid4()}-checkpoint.pdf'
+        merged_output.seek(0)
+        with open(local_file, 'wb') as file:
+            shutil.copyfileobj(merged_output, file)
     try:
-        # Initialize a new PDF document
-        merged_pdf = fitz.open()
-        
-        for s3_key in s3_keys:
-            # Download each PDF file from S3
-            pdf_data = download_pdf_from_s3(input_s3_bucket, s3_key)
-            
-            if pdf_data:
-                # Open the downloaded PDF data as a document
-                pdf_document = fitz.open(stream=pdf_data, filetype="pdf")
-                
-                # Append the document to the merged PDF
-                merged_pdf.insert_pdf(pdf_document)
-        
-        # Save the merged PDF to disk        
-        if optimize_pdf:
-            print("Save PDF with PDF optimization")        
-            merged_pdf.save(output_file, 
-            deflate=True, 
-            garbage=4, 
-            clean=True)
-        else:
-            print("Save PDF.  NO optimization") 
-            merged_pdf.save(output_file)
+        record_merged_entries(local_file, checkpoint_entries)
+        print(f"Uploading checkpoint to S3: s3://{output_bucket}/{checkpoint_key}")
+        with metrics_span('upload'):
+            upload_file_to_s3(output_bucket, checkpoint_key, local_file)
+    finally:
+        if local_file is not merged_output and os.path.isfile(local_file):
+            os.remove(local_file)
 
-        merged_pdf.close()
-        
-        print(f"Merged PDF saved to {output_file}")
+def record_entries(pdf_keys, read_entries):
+    """Yield manifest entries, appending each one to read_entries as it is read."""
+    for entry in pdf_keys:
+        read_entries.append(entry)
+        yield entry
+
+def enqueue_continuation(payload):
+    """
+    Start a continuation of a checkpointed merge, or another follow-up job such as a fan-out reduce.
     
+    Sends the payload to CONTINUATION_QUEUE_URL when set, so the SQS trigger runs
+    it, and otherwise invokes CONTINUATION_FUNCTION_NAME (default: this function)
+    asynchronously with it.
+    
+    Args:
+        payload (dict): CLI payload of the job, with its resume settings if any
+    """
+    import boto3
+    try:
+        body = json.dumps(payload)
+        queue_url = os.environ.get('CONTINUATION_QUEUE_URL')
+        if queue_url:
+            print(f"Sending continuation to {queue_url}")
+            boto3.client('sqs').send_message(QueueUrl=queue_url, MessageBody=body)
+            return
+        context = invocation_context.get()
+        function_name = (os.environ.get('CONTINUATION_FUNCTION_NAME') or getattr(context, 'function_name', None) or
+                         os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+        if not function_name:
+            raise Exception("Continuations need CONTINUATION_QUEUE_URL or a Lambda function name")
+        print(f"Invoking {function_name} asynchronously for the continuation")
+        boto3.client('lambda').invoke(FunctionName=function_name, InvocationType='Event',
+                                      Payload=body.encode('utf-8'))
     except Exception as e:
-        error_msg = f"Error merging PDFs: {e}"
+        error_msg = f"Error enqueuing merge continuation: {e}"
         print(error_msg)
         raise Exception(error_msg)
 
-def upload_file_to_s3(output_s3_bucket, output_file_key, local_output_file):
+def continuation_target_configured():
+    """True when CONTINUATION_QUEUE_URL or CONTINUATION_FUNCTION_NAME names where continuations go."""
+    return bool(os.environ.get('CONTINUATION_QUEUE_URL') or os.environ.get('CONTINUATION_FUNCTION_NAME'))
+
+def get_checkpoint_reserve_ms():
+    """MERGE_CHECKPOINT_RESERVE_MS, capped at a quarter of the time the running invocation started with."""
+    reserve_ms = get_env_int('MERGE_CHECKPOINT_RESERVE_MS', DEFAULT_CHECKPOINT_RESERVE_MS)
+    total_ms = invocation_time_ms.get()
+    if total_ms is not None:
+        reserve_ms = min(reserve_ms, int(total_ms * CHECKPOINT_RESERVE_MAX_FRACTION))
+    return reserve_ms
+
+def checkpoint_deadline_reached(reserve_ms):
+    """True when the running Lambda invocation has less than reserve_ms left."""
+    get_remaining_time = getattr(invocation_context.get(), 'get_remaining_time_in_millis', None)
+    return get_remaining_time is not None and get_remaining_time() < reserve_ms
+
+def head_pdf_objects(s3_bucket, s3_keys, head_concurrency=None, allow_missing=False):
     """
-    Upload a local file to an S3 bucket.
+    Look up the ETag and size of S3 objects with concurrent HEAD requests.
     
     Args:
-        output_s3_bucket (str): Destination S3 bucket name
-        output_file_key (str): S3 object key for the uploaded file
-        local_output_file (str): Path to the local file to upload
+        s3_bucket (str): S3 bucket name containing the objects
+        s3_keys (list): S3 object keys, repeated keys are looked up once
+        head_concurrency (int): Parallel HEAD requests, defaults to HEAD_CONCURRENCY env
+        allow_missing (bool): Map missing objects to None instead of failing
     
     Returns:
-        bool: True if upload was successful, False otherwise
+        dict: key -> {'etag': str, 'size': int}, in the order of s3_keys
     """
+    from botocore.exceptions import ClientError
     try:
-        print(f"Uploading {local_output_file} to s3://{output_s3_bucket}/{output_file_key}")
-        
-        # Create S3 bucket resource
-        s3_bucket = boto3.resource("s3").Bucket(output_s3_bucket)
-        
-        # Upload file to S3
-        with open(local_output_file, "rb") as file_data:
-            s3_bucket.put_object(Key=output_file_key, Body=file_data)
+        head_concurrency = max(1, head_concurrency or get_env_int('HEAD_CONCURRENCY', DEFAULT_HEAD_CONCURRENCY))
+        s3 = get_s3_client()
+        unique_keys = list(dict.fromkeys(s3_keys))
         
-        print(f"Successfully uploaded file to s3://{output_s3_bucket}/{output_file_key}")
-        return True
+        def head(s3_key):
+            try:
+                response = s3.head_object(Bucket=s3_bucket, Key=s3_key)
+            except ClientError as e:
+                if allow_missing and e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404:
+                    return None
+                raise
+            return {'etag': response['ETag'], 'size': response['ContentLength']}
         
+        with ThreadPoolExecutor(max_workers=head_concurrency) as executor:
+            return dict(zip(unique_keys, executor.map(head, unique_keys)))
     except Exception as e:
-        error_msg = f"Error uploading file to S3: {e}"
+        error_msg = f"Error reading PDF metadata from S3: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+
+def preflight_sources(input_bucket, pdf_keys):
+    """
+    HEAD every source of a manifest before the merge, failing on missing ones.
+    
+    Args:
+        input_bucket (str): S3 bucket containing the source PDFs
+        pdf_keys (list): Manifest entries in merge order
+    
+    Returns:
+        dict: key -> {'etag': str, 'size': int} from head_pdf_objects
+    """
+    with metrics_span('preflight'):
+        source_heads = head_pdf_objects(input_bucket, [parse_manifest_entry(entry)[0] for entry in pdf_keys],
+                                        allow_missing=True)
+    missing = [s3_key for s3_key, head in source_heads.items() if head is None]
+    if missing:
+        shown = ', '.join(missing[:10]) + (f" and {len(missing) - 10} more" if len(missing) > 10 else '')
+        error_msg = f"{len(missing)} source PDFs missing from s3://{input_bucket}: {shown}"
         print(error_msg)
         raise Exception(error_msg)
+    return source_heads
+
+def choose_merge_route(total_bytes, memory_max_bytes=None, disk_max_bytes=None):
+    """
+    Pick the merge strategy for a job from its total source bytes.
+    
+    Args:
+        total_bytes (int): Summed size of the distinct source PDFs
+        memory_max_bytes (int): Largest 'memory' job, defaults to PREFLIGHT_MEMORY_MAX_BYTES env
+        disk_max_bytes (int): Largest 'disk' job, defaults to PREFLIGHT_DISK_MAX_BYTES env
+    
+    Returns:
+        str: 'memory', 'disk' or 'chunked'
+    """
+    if memory_max_bytes is None:
+        memory_max_bytes = get_env_int('PREFLIGHT_MEMORY_MAX_BYTES', DEFAULT_PREFLIGHT_MEMORY_MAX_BYTES)
+    if disk_max_bytes is None:
+        disk_max_bytes = get_env_int('PREFLIGHT_DISK_MAX_BYTES', DEFAULT_PREFLIGHT_DISK_MAX_BYTES)
+    if total_bytes <= memory_max_bytes:
+        return 'memory'
+    if total_bytes <= disk_max_bytes:
+        return 'disk'
+    return 'chunked'
+
+def compute_merge_fingerprint(input_bucket, pdf_keys, source_heads, options):
+    """
+    Fingerprint a merge from its manifest, the source ETags and the merge options.
+    
+    Args:
+        input_bucket (str): S3 bucket containing the source PDFs
+        pdf_keys (list): Manifest entries in merge order
+        source_heads (dict): key -> {'etag': ...} from head_pdf_objects
+        options (dict): Merge options that change the output
+    
+    Returns:
+        str: Hex SHA-256 fingerprint
+    """
+    fingerprint_source = json.dumps({
+        'version': 1,
+        'input_bucket': input_bucket,
+        'pdfs': pdf_keys,
+        'etags': [source_heads[parse_manifest_entry(entry)[0]]['etag'] for entry in pdf_keys],
+        'options': options
+    }, sort_keys=True)
+    return hashlib.sha256(fingerprint_source.encode('utf-8')).hexdigest()
+
+def get_output_fingerprint(output_bucket, output_file_key):
+    """
+    Read the merge fingerprint stored on an existing output object.
+    
+    Returns:
+        str: The stored fingerprint, or None if the object or its fingerprint doesn't exist
+    """
+    from botocore.exceptions import ClientError
+    try:
+        response = get_s3_client().head_object(Bucket=output_bucket, Key=output_file_key)
+    except ClientError as e:
+        if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404:
+            return None
+        raise
+    return response.get('Metadata', {}).get(MERGE_FINGERPRINT_METADATA_KEY)
+
+def process_multi_output_merge(input_bucket, input_file_key, output_bucket, output_prefix, optimize_pdf=False,
+                               upload_mode=None, manifest_bucket=None, save_profile=None, **merge_options):
+    """
+    Merge a multi-output manifest into several PDFs that share their sources.
+    
+    The sources are downloaded and opened once (see merge_pdf_outputs). Each output is
+    saved as soon as its last entry is inserted and uploaded in the background, up to
+    MULTI_OUTPUT_UPLOAD_CONCURRENCY uploads at a time.
     
+    Args:
+        input_bucket (str): S3 bucket containing the source PDFs
+        input_file_key (str): S3 object key for the manifest, with an "outputs" array
+        output_bucket (str): S3 bucket for the merged PDFs
+        output_prefix (str): Prefix of the output keys, the payload's output_file_key
+        optimize_pdf (bool): Save every output with deflate, garbage and clean options
+        upload_mode (str): 'file' or 'stream', defaults to UPLOAD_MODE env
+        manifest_bucket (str): S3 bucket holding the manifest, defaults to input_bucket
+        save_profile (str): Key of SAVE_PROFILES for every output, defaults to SAVE_PROFILE env
+        **merge_options: Options of MULTI_OUTPUT_MERGE_OPTIONS
+    
+    Returns:
+        dict: Merge statistics from merge_pdf_outputs
+    """
+    upload_mode = upload_mode or os.environ.get('UPLOAD_MODE') or DEFAULT_UPLOAD_MODE
+    if upload_mode not in UPLOAD_MODES:
+        raise Exception(f"Unknown upload_mode: {upload_mode}. Expected one of {', '.join(UPLOAD_MODES)}")
+    save_profile = get_save_profile(save_profile) or ('optimize' if optimize_pdf else 'fast')
+    unsupported = sorted(key for key, value in merge_options.items()
+                         if value is not None and key not in MULTI_OUTPUT_MERGE_OPTIONS)
+    if unsupported:
+        raise Exception(f"Options not supported with multi_output: {', '.join(unsupported)}")
+    upload_concurrency = max(1, get_env_int('MULTI_OUTPUT_UPLOAD_CONCURRENCY', DEFAULT_MULTI_OUTPUT_UPLOAD_CONCURRENCY))
+    spool_max_memory = get_env_int('UPLOAD_SPOOL_MAX_MEMORY', DEFAULT_UPLOAD_SPOOL_MAX_MEMORY)
+    
+    manifest = get_pdf_manifest(manifest_bucket or input_bucket, input_file_key)
+    outputs = parse_manifest_outputs(manifest, output_prefix)
+    print(f"Multi-output merge: {len(outputs)} outputs under s3://{output_bucket}/{output_prefix}, "
+          f"upload_mode: {upload_mode}, upload_concurrency: {upload_concurrency}, save_profile: {save_profile}")
+    
+    def upload(output_key, output):
+        try:
+            with metrics_span('upload'):
+                if upload_mode == 'stream':
+                    upload_fileobj_to_s3(output_bucket, output_key, output)
+                else:
+                    upload_file_to_s3(output_bucket, output_key, output)
+        finally:
+            if upload_mode == 'stream':
+                output.close()
+            elif os.path.isfile(output):
+                os.remove(output)
+    
+    uploads = []
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as uploader:
+        def save_output(output_key, merged_pdf):
+            # MuPDF isn't thread-safe, so outputs are saved here and only the uploads run in threads
+            output = SpooledOutput(spool_max_memory) if upload_mode == 'stream' else f'/tmp/{uuid.uuid4()}.pdf'
+            with metrics_span('save'):
+                merged_pdf.save(output, **SAVE_PROFILES[save_profile])
+            count_metric('output_bytes', output.size() if upload_mode == 'stream' else os.path.getsize(output))
+            uploads.append(uploader.submit(contextvars.copy_context().run, upload, output_key, output))
+        
+        try:
+            stats = merge_pdf_outputs(input_bucket, outputs, save_output, **merge_options)
+        finally:
+            errors = [future.exception() for future in uploads if future.exception() is not None]
+    if errors:
+        raise Exception(f"{len(errors)} of {len(uploads)} outputs failed to upload: {errors[0]}")
+    print(f"Uploaded {len(uploads)} merged PDFs to s3://{output_bucket}/{output_prefix}")
+    return stats
+
+def parse_manifest_outputs(manifest, output_prefix=''):
+    """
+    Read the "outputs" array of a multi-output manifest.
+    
+    Args:
+        manifest (dict): Manifest from get_pdf_manifest
+        output_prefix (str): Prefix for the output keys
+    
+    Returns:
+        list: (output key, entries) per output, in manifest order
+    """
+    outputs = manifest.get('outputs')
+    if not isinstance(outputs, list) or not outputs:
+        raise Exception('A multi_output manifest needs a non-empty "outputs" array')
+    parsed = []
+    for output in outputs:
+        if not isinstance(output, dict) or not isinstance(output.get('key'), str):
+            raise Exception(f"Manifest output must be an object with a key: {json.dumps(output)}")
+        if not isinstance(output.get('pdfs'), list) or not output['pdfs']:
+            raise Exception(f"Manifest output {output['key']} lists no PDFs")
+        parsed.append((output_prefix + output['key'], output['pdfs']))
+    duplicates = [key for key, count in Counter(key for key, _ in parsed).items() if count > 1]
+    if duplicates:
+        raise Exception(f"Manifest outputs listed more than once: {', '.join(duplicates)}")
+    return parsed
+
+def process_fanout_merge(input_bucket, input_file_key, output_bucket, output_file_key, optimize_pdf=False,
+                         dispatcher=None, max_chunk_bytes=None, max_chunk_pages=None, manifest_bucket=None,
+                         source_heads=None, **merge_options):
+    """
+    Merge a manifest too large for one invocation as a map-reduce over chunks.
+    
+    The coordinator splits the manifest into chunks within byte and page budgets
+    (see plan_merge_chunks), writes a manifest per chunk under a work prefix in the
+    output bucket and runs each chunk as an ordinary merge sub-job through the
+    dispatcher. A reduce job then concatenates the chunk PDFs in order into
+    output_file_key, and deletes the work prefix when it is done. A reduce that
+    checkpoints before the deadline leaves that to its continuation.
+    
+    A dispatcher that waits for its sub-jobs (waits = True, like the local one) is
+    handed the reduce job once they are done. Otherwise the coordinator returns once
+    the sub-jobs are started, and the last one to finish starts the reduce (see
+    complete_fanout_chunk), so the coordinator pays neither for the sub-jobs' wall
+    time nor for the reduce.
+    
+    Args:
+        input_bucket (str): S3 bucket containing the source PDFs
+        input_file_key (str): S3 object key for the JSON manifest
+        output_bucket (str): S3 bucket for the merged PDF and the intermediate files
+        output_file_key (str): S3 object key for the merged PDF
+        optimize_pdf (bool): Optimize each chunk when it is saved
+        dispatcher (str or object): 'local', 'lambda' or an object with run(payloads),
+                                    defaults to FANOUT_DISPATCHER env
+        max_chunk_bytes (int): Source bytes per chunk, defaults to FANOUT_MAX_CHUNK_BYTES env
+        max_chunk_pages (int): Pages per chunk, defaults to FANOUT_MAX_CHUNK_PAGES env (0 = no limit)
+        manifest_bucket (str): S3 bucket holding the manifest, defaults to input_bucket
+        source_heads (dict): key -> {'size': ...} of the sources if already known (pre-flight)
+        **merge_options: Options passed to every sub-job and to the reduce step
+    """
+    if dispatcher is None or isinstance(dispatcher, str):
+        dispatcher = get_fanout_dispatcher(dispatcher)
+    max_chunk_bytes = max_chunk_bytes or get_env_int('FANOUT_MAX_CHUNK_BYTES', DEFAULT_FANOUT_MAX_CHUNK_BYTES)
+    if max_chunk_pages is None:
+        max_chunk_pages = get_env_int('FANOUT_MAX_CHUNK_PAGES', DEFAULT_FANOUT_MAX_CHUNK_PAGES)
+    
+    manifest = get_pdf_manifest(manifest_bucket or input_bucket, input_file_key)
+    pdf_keys = manifest.get('pdfs', [])
+    source_heads = source_heads or head_pdf_objects(input_bucket, [parse_manifest_entry(entry)[0] for entry in pdf_keys])
+    chunks = plan_merge_chunks(pdf_keys, {key: head['size'] for key, head in source_heads.items()},
+                               max_chunk_bytes, max_chunk_pages, manifest.get('page_counts'))
+    print(f"Fan-out: {len(pdf_keys)} PDFs in {len(chunks)} chunks "
+          f"(max_chunk_bytes: {max_chunk_bytes}, max_chunk_pages: {max_chunk_pages})")
+    
+    if len(chunks) <= 1:
+        print("Fan-out not needed, merging in this invocation")
+        return process_merge(input_bucket, input_file_key, output_bucket, output_file_key, optimize_pdf,
+                             manifest_bucket=manifest_bucket, preflight=False, **merge_options)
+    
+    work_prefix = f"{output_file_key}.fanout/{uuid.uuid4()}/"
+    s3 = get_s3_client()
+    try:
+        # Map: one ordinary merge job per chunk
+        # Sub-jobs always run to completion, the reduce step needs every chunk. The sources
+        # were HEAD-checked above, so sub-jobs skip the pre-flight sweep
+        sub_job_options = {key: value for key, value in merge_options.items()
+                           if key in MERGE_OPTION_KEYS and key not in ('idempotent', 'force', 'resume')}
+        sub_job_options['checkpoint'] = False
+        sub_job_options['preflight'] = False
+        payloads = []
+        chunk_pdf_keys = []
+        for index, chunk in enumerate(chunks):
+            chunk_manifest_key = f"{work_prefix}chunk-{index:05d}.json"
+            chunk_pdf_key = f"{work_prefix}chunk-{index:05d}.pdf"
+            s3.put_object(Bucket=output_bucket, Key=chunk_manifest_key, Body=json.dumps({'pdfs': chunk}).encode('utf-8'))
+            payloads.append(dict(sub_job_options, input_bucket=input_bucket, manifest_bucket=output_bucket,
+                                 input_file_key=chunk_manifest_key, output_bucket=output_bucket,
+                                 output_file_key=chunk_pdf_key, optimize_pdf=optimize_pdf))
+            chunk_pdf_keys.append(chunk_pdf_key)
+        
+        
+        # Reduce: a job of its own that concatenates the chunk PDFs in order. Its manifest
+        # also holds its payload, for the sub-job that starts it
+        reduce_manifest_key = f"{work_prefix}reduce.json"
+        reduce_payload = {key: value for key, value in merge_options.items()
+                          if key in MERGE_OPTION_KEYS and key not in ('use_cache', 'resume')}
+        reduce_payload.update(input_bucket=output_bucket, input_file_key=reduce_manifest_key,
+                              output_bucket=output_bucket, output_file_key=output_file_key, optimize_pdf=False,
+                              use_cache=False, preflight=False, fanout_work_prefix=work_prefix)
+        s3.put_object(Bucket=output_bucket, Key=reduce_manifest_key,
+                      Body=json.dumps({'pdfs': chunk_pdf_keys, 'reduce_payload': reduce_payload}).encode('utf-8'))
+        
+        waits = getattr(dispatcher, 'waits', True)
+        if not waits:
+            for payload in payloads:
+                payload['fanout_reduce_key'] = reduce_manifest_key
+        print(f"Dispatching {len(payloads)} chunk merges with {type(dispatcher).__name__}")
+        dispatcher.run(payloads)
+    except Exception:
+        delete_s3_prefix(output_bucket, work_prefix)
+        raise
+    if waits:
+        print(f"Reducing {len(chunk_pdf_keys)} chunk PDFs into s3://{output_bucket}/{output_file_key}")
+        dispatcher.run([reduce_payload])
+    else:
+        print(f"Started {len(payloads)} chunk merges, the last one to finish reduces them into "
+              f"s3://{output_bucket}/{output_file_key}")
+
+def complete_fanout_chunk(s3_bucket, reduce_manifest_key):
+    """
+    Start the reduce of a fan-out once its last chunk PDF exists.
+    
+    Called by each sub-job after it uploaded its chunk PDF. When every chunk PDF
+    of the reduce manifest exists, the sub-jobs race to create the claim object
+    next to it with a conditional PUT (If-None-Match: *). Only the winner starts
+    the reduce job, through enqueue_continuation. If that fails, the claim is
+    deleted again, so the retry of this sub-job can start the reduce.
+    
+    Args:
+        s3_bucket (str): S3 bucket holding the work prefix
+        reduce_manifest_key (str): S3 object key of the reduce manifest
+    
+    Returns:
+        bool: True if this call started the reduce
+    """
+    from botocore.exceptions import ClientError
+    manifest = get_pdf_manifest(s3_bucket, reduce_manifest_key)
+    chunk_heads = head_pdf_objects(s3_bucket, manifest['pdfs'], allow_missing=True)
+    missing = sum(1 for head in chunk_heads.values() if head is None)
+    if missing:
+        print(f"{missing} of {len(chunk_heads)} fan-out chunks still running")
+        return False
+    claim_key = f"{reduce_manifest_key.rsplit('/', 1)[0]}/{FANOUT_REDUCE_CLAIM_SUFFIX}"
+    try:
+        get_s3_client().put_object(Bucket=s3_bucket, Key=claim_key, Body=b'', IfNoneMatch='*')
+    except ClientError as e:
+        if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in (409, 412):
+            print(f"Another sub-job already started the reduce of s3://{s3_bucket}/{reduce_manifest_key}")
+            return False
+        raise
+    print(f"Last of {len(chunk_heads)} fan-out chunks done, starting the reduce of s3://{s3_bucket}/{reduce_manifest_key}")
+    try:
+        enqueue_continuation(manifest['reduce_payload'])
+    except Exception:
+        get_s3_client().delete_objects(Bucket=s3_bucket, Delete={'Objects': [{'Key': claim_key}], 'Quiet': True})
+        raise
+    return True
+
+def plan_merge_chunks(pdf_keys, sizes, max_chunk_bytes, max_chunk_pages=0, page_counts=None):
+    """
+    Split a manifest into consecutive chunks within byte and page budgets.
+    
+    A chunk is closed before the PDF that would take it over either budget, so
+    a single PDF larger than a budget gets a chunk of its own. Pages are only
+    counted for keys with a page count in the manifest's optional page_counts,
+    or for entries that select closed page ranges.
+    
+    Args:
+        pdf_keys (list): Manifest entries in merge order
+        sizes (dict): key -> size in bytes
+        max_chunk_bytes (int): Source bytes per chunk (0 = no limit)
+        max_chunk_pages (int): Pages per chunk (0 = no limit)
+        page_counts (dict): key -> page count, if known
+    
+    Returns:
+        list: Lists of entries, one per chunk, in merge order
+    """
+    page_counts = page_counts or {}
+    chunks = []
+    current, current_bytes, current_pages = [], 0, 0
+    for entry in pdf_keys:
+        s3_key, page_ranges = parse_manifest_entry(entry)
+        size = sizes.get(s3_key, 0)
+        pages = count_selected_pages(page_ranges, page_counts.get(s3_key, 0))
+        if current and ((max_chunk_bytes and current_bytes + size > max_chunk_bytes) or
+                        (max_chunk_pages and current_pages + pages > max_chunk_pages)):
+            chunks.append(current)
+            current, current_bytes, current_pages = [], 0, 0
+        current.append(entry)
+        current_bytes += size
+        current_pages += pages
+    if current:
+        chunks.append(current)
+    return chunks
+
+def get_fanout_dispatcher(name=None):
+    """
+    Build a fan-out dispatcher by name.
+    
+    Args:
+        name (str): 'local' or 'lambda', defaults to FANOUT_DISPATCHER env
+    
+    Returns:
+        object: A dispatcher with a run(payloads) method
+    """
+    name = name or os.environ.get('FANOUT_DISPATCHER') or DEFAULT_FANOUT_DISPATCHER
+    if name not in FANOUT_DISPATCHERS:
+        raise Exception(f"Unknown fan-out dispatcher: {name}. Expected one of {', '.join(FANOUT_DISPATCHERS)}")
+    return FANOUT_DISPATCHERS[name]()
+
+class LocalProcessPoolDispatcher:
+    """
+    Runs fan-out sub-jobs through handle() in a local process pool, and waits for them.
+    
+    Meant for tests and local runs; Lambda has no /dev/shm, which ProcessPoolExecutor needs.
+    """
+    waits = True
+    
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count()
+    
+    def run(self, payloads):
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(handle, payloads))
+
+class LambdaDispatcher:
+    """
+    Starts fan-out sub-jobs by invoking a Lambda function (this one by default) asynchronously.
+    
+    Sub-jobs are ordinary CLI payloads, so the sub-job invocations need no special handling.
+    The last one to finish starts the reduce (see complete_fanout_chunk).
+    """
+    waits = False
+    
+    def __init__(self, function_name=None, max_concurrency=None):
+        self.function_name = function_name or os.environ.get('FANOUT_FUNCTION_NAME') or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+        self.max_concurrency = max_concurrency or get_env_int('FANOUT_CONCURRENCY', DEFAULT_FANOUT_CONCURRENCY)
+        if not self.function_name:
+            raise Exception("LambdaDispatcher needs FANOUT_FUNCTION_NAME or AWS_LAMBDA_FUNCTION_NAME")
+    
+    def run(self, payloads):
+        import boto3
+        from botocore.config import Config
+        lambda_client = boto3.client('lambda', config=Config(max_pool_connections=self.max_concurrency))
+        
+        def invoke(payload):
+            response = lambda_client.invoke(FunctionName=self.function_name, InvocationType='Event',
+                                            Payload=json.dumps(payload).encode('utf-8'))
+            if response.get('StatusCode') != 202:
+                raise Exception(f"Sub-job for s3://{payload['output_bucket']}/{payload['output_file_key']} "
+                                f"was not accepted: {response.get('StatusCode')}")
+        
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            list(executor.map(invoke, payloads))
+
+FANOUT_DISPATCHERS = {'local': LocalProcessPoolDispatcher, 'lambda': LambdaDispatcher}
+
+def delete_s3_prefix(s3_bucket, prefix):
+    """
+    Delete every object under an S3 prefix.
+    
+    Args:
+        s3_bucket (str): S3 bucket name
+        prefix (str): Key prefix to delete
+    """
+    try:
+        s3 = get_s3_client()
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix):
+            objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if objects:
+                s3.delete_objects(Bucket=s3_bucket, Delete={'Objects': objects, 'Quiet': True})
+    except Exception as e:
+        # Leftover intermediate files are not worth failing the job for
+        print(f"Warning: could not clean up s3://{s3_bucket}/{prefix}: {e}")
+
+def create_s3_client():
+    """
+    Build an S3 client with a connection pool, retry mode and timeouts from the environment.
+    
+    Returns:
+        botocore.client.S3: A new S3 client
+    """
+    import boto3
+    from botocore.config import Config
+    config = Config(
+        max_pool_connections=get_env_int('S3_MAX_POOL_CONNECTIONS', DEFAULT_S3_MAX_POOL_CONNECTIONS),
+        retries={
+            'mode': os.environ.get('S3_RETRY_MODE') or DEFAULT_S3_RETRY_MODE,
+            'max_attempts': get_env_int('S3_MAX_ATTEMPTS', DEFAULT_S3_MAX_ATTEMPTS)
+        },
+        connect_timeout=get_env_int('S3_CONNECT_TIMEOUT', DEFAULT_S3_CONNECT_TIMEOUT),
+        read_timeout=get_env_int('S3_READ_TIMEOUT', DEFAULT_S3_READ_TIMEOUT)
+    )
+    endpoint_url = os.environ.get('S3_ENDPOINT_URL') or None
+    if endpoint_url:
+        print(f"Using S3 endpoint: {endpoint_url}")
+    return boto3.client('s3', config=config, endpoint_url=endpoint_url)
+
+def create_storage_client():
+    """
+    Build the client for the STORAGE_BACKEND environment variable.
+    
+    Returns:
+        An S3 client, or a LocalStorageClient for the 'local' backend
+    """
+    backend = os.environ.get('STORAGE_BACKEND') or DEFAULT_STORAGE_BACKEND
+    if backend not in STORAGE_BACKENDS:
+        raise Exception(f"Unknown STORAGE_BACKEND: {backend}. Expected one of {', '.join(STORAGE_BACKENDS)}")
+    if backend == 'local':
+        root = os.environ.get('LOCAL_STORAGE_ROOT')
+        if not root:
+            raise Exception("STORAGE_BACKEND local needs LOCAL_STORAGE_ROOT")
+        print(f"Using local storage: {root}")
+        return LocalStorageClient(root)
+    return create_s3_client()
+
+def get_s3_client():
+    """
+    Return the shared storage client, creating it on first use.
+    
+    This is the S3 client, or a LocalStorageClient with STORAGE_BACKEND=local. The S3
+    client is thread safe and keeps its connection pool, so downloads, manifest
+    reads and uploads reuse warm TLS connections across calls and invocations.
+    
+    Returns:
+        botocore.client.S3: The shared S3 client
+    """
+    global s3_client
+    if s3_client is None:
+        with s3_client_lock:
+            if s3_client is None:
+                s3_client = create_storage_client()
+    return s3_client
+
+def set_s3_client(client):
+    """
+    Replace the shared S3 client, e.g. with one pointed at a local stand-in endpoint.
+    
+    Args:
+        client: S3 client to use, or None to build a new one from the environment on next use
+    """
+    global s3_client
+    with s3_client_lock:
+        s3_client = client
+
+class LocalStorageClient:
+    """
+    The S3 client calls this module makes, served from a directory: bucket/key is the
+    file <root>/<bucket>/<key>.
+    
+    Existing files need no preparation. The ETag of a file follows its size and
+    modification time, and user metadata is kept in a sidecar file. Writes go to a
+    temporary file that is renamed into place, so readers never see a partial object.
+    Errors are botocore ClientErrors with the codes S3 uses.
+    """
+    
+    def __init__(self, root):
+        self.root = root
+        self.uploads = {}
+        self.uploads_lock = threading.Lock()
+    
+    def path(self, bucket, key):
+        """File of bucket/key, which must stay inside the bucket's directory under root."""
+        root = os.path.abspath(self.root)
+        bucket_dir = os.path.normpath(os.path.join(root, bucket))
+        if not bucket or os.path.dirname(bucket_dir) != root:
+            raise ValueError(f"Invalid bucket name for local storage: {bucket!r}")
+        path = os.path.normpath(os.path.join(bucket_dir, key))
+        if key.startswith('/') or os.path.commonpath([bucket_dir, path]) != bucket_dir:
+            raise ValueError(f"Key {key!r} is outside bucket {bucket!r} of the local storage root")
+        return path
+    
+    def put(self, bucket, key, data, metadata=None):
+        """Store an object from bytes or a readable file object and return its ETag."""
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as file:
+                if isinstance(data, (bytes, bytearray)):
+                    file.write(data)
+                else:
+                    shutil.copyfileobj(data, file)
+            if metadata:
+                with open(temp_path + LOCAL_METADATA_SUFFIX, 'w') as file:
+                    json.dump(metadata, file)
+                os.replace(temp_path + LOCAL_METADATA_SUFFIX, path + LOCAL_METADATA_SUFFIX)
+            elif os.path.isfile(path + LOCAL_METADATA_SUFFIX):
+                os.remove(path + LOCAL_METADATA_SUFFIX)
+            os.replace(temp_path, path)
+        finally:
+            for leftover in (temp_path, temp_path + LOCAL_METADATA_SUFFIX):
+                if os.path.isfile(leftover):
+                    os.remove(leftover)
+        return self.stat(bucket, key, 'PutObject')[0]
+    
+    def stat(self, bucket, key, operation_name):
+        """Return (etag, size, metadata) of an object, raising a 404 ClientError when missing."""
+        path = self.path(bucket, key)
+        try:
+            info = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            info = None
+        if info is None or not os.path.isfile(path):
+            raise local_storage_error('NoSuchKey' if operation_name == 'GetObject' else '404', 404, operation_name)
+        metadata = {}
+        if os.path.isfile(path + LOCAL_METADATA_SUFFIX):
+            with open(path + LOCAL_METADATA_SUFFIX) as file:
+                metadata = json.load(file)
+        return f'"{info.st_mtime_ns:x}-{info.st_size:x}"', info.st_size, metadata
+    
+    def get_object(self, Bucket, Key, IfNoneMatch=None, IfMatch=None, Range=None, **kwargs):
+        etag, size, metadata = self.stat(Bucket, Key, 'GetObject')
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise local_storage_error('304', 304, 'GetObject')
+        if IfMatch is not None and IfMatch != etag:
+            raise local_storage_error('PreconditionFailed', 412, 'GetObject')
+        response = {'Body': open(self.path(Bucket, Key), 'rb'), 'ContentLength': size, 'ETag': etag,
+                    'Metadata': metadata}
+        if Range is not None:
+            # Only the bytes=first-last form this module sends
+            first, last = (int(value) for value in Range[len('bytes='):].split('-'))
+            last = min(last, size - 1)
+            with response['Body'] as file:
+                file.seek(first)
+                response['Body'] = io.BytesIO(file.read(last - first + 1))
+            response.update(ContentLength=last - first + 1, ContentRange=f"bytes {first}-{last}/{size}")
+        return response
+    
+    def head_object(self, Bucket, Key, **kwargs):
+        etag, size, metadata = self.stat(Bucket, Key, 'HeadObject')
+        return {'ContentLength': size, 'ETag': etag, 'Metadata': metadata}
+    
+    def put_object(self, Bucket, Key, Body, Metadata=None, IfNoneMatch=None, **kwargs):
+        if IfNoneMatch == '*':
+            # Create the file exclusively, so only one of several racing writers succeeds
+            path = self.path(Bucket, Key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                raise local_storage_error('PreconditionFailed', 412, 'PutObject')
+        return {'ETag': self.put(Bucket, Key, Body, Metadata)}
+    
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        upload_id = uuid.uuid4().hex
+        with self.uploads_lock:
+            self.uploads[upload_id] = ({}, Metadata)
+        return {'UploadId': upload_id}
+    
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with self.uploads_lock:
+            self.uploads[UploadId][0][PartNumber] = data
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+    
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.uploads_lock:
+            parts, metadata = self.uploads.pop(UploadId)
+        data = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {'ETag': self.put(Bucket, Key, data, metadata)}
+    
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.uploads_lock:
+            self.uploads.pop(UploadId, None)
+    
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            path = self.path(Bucket, obj['Key'])
+            for leftover in (path, path + LOCAL_METADATA_SUFFIX):
+                if os.path.isfile(leftover):
+                    os.remove(leftover)
+        return {}
+    
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise ValueError(f"Local storage only supports the list_objects_v2 paginator, not {operation_name}")
+        return LocalListObjectsPaginator(self)
+    
+    def clear(self):
+        """Delete every object under the root."""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+class LocalListObjectsPaginator:
+    """list_objects_v2 paginator of a LocalStorageClient: one page with every key under the prefix, in key order."""
+    
+    def __init__(self, client):
+        self.client = client
+    
+    def paginate(self, Bucket, Prefix='', **kwargs):
+        base = self.client.path(Bucket, '')
+        # Only walk the directories the prefix can match
+        start = self.client.path(Bucket, os.path.dirname(Prefix))
+        keys = []
+        for directory, _, files in os.walk(start):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), base).replace(os.sep, '/')
+                if key.startswith(Prefix) and not key.endswith(LOCAL_METADATA_SUFFIX) and not key.endswith('.tmp'):
+                    keys.append(key)
+        yield {'Contents': [{'Key': key, 'Size': os.path.getsize(self.client.path(Bucket, key))}
+                            for key in sorted(keys)]}
+
+def local_storage_error(code, status, operation_name):
+    """The ClientError S3 raises for an error code and HTTP status."""
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation_name)
+
+def get_pdf_s3_keys(input_bucket, input_file_key):
+    """
+    Read a manifest from S3 and return its full list of PDF keys.
+    
+    Args:
+        input_bucket (str): S3 bucket containing the manifest
+        input_file_key (str): S3 object key for the manifest (see iter_pdf_s3_keys)
+    
+    Returns:
+        list: Array of PDF filenames
+    """
+    pdf_files = list(iter_pdf_s3_keys(input_bucket, input_file_key))
+    
+    if not pdf_files:
+        print("Warning: No PDF files found in JSON")
+        return []
+    
+    print(f"Found {len(pdf_files)} PDFs to process")
+    return pdf_files
+
+def get_pdf_manifest(input_bucket, input_file_key):
+    """
+    Read a manifest from S3 with its other top-level fields.
+    
+    Args:
+        input_bucket (str): S3 bucket containing the manifest
+        input_file_key (str): S3 object key for the manifest (see iter_pdf_s3_keys)
+    
+    Returns:
+        dict: The manifest, e.g. {'pdfs': [...], 'page_counts': {...}}
+    """
+    manifest = {}
+    manifest['pdfs'] = list(iter_pdf_s3_keys(input_bucket, input_file_key, manifest_fields=manifest))
+    return manifest
+
+def iter_pdf_s3_keys(input_bucket, input_file_key, manifest_fields=None):
+    """
+    Yield the PDF keys of a manifest while it is still being read from S3.
+    
+    The manifest kind follows input_file_key:
+    * ending in '/': an S3 prefix, listed page by page; its .pdf keys in key order
+    * ending in .jsonl or .ndjson: JSON Lines, one entry per line
+    * anything else: a JSON object whose "pdfs" array holds the entries, parsed
+      incrementally so the first entries are yielded after the first chunk arrives
+    
+    An entry is a key or an object with a key and page ranges (see parse_manifest_entry).
+    
+    Args:
+        input_bucket (str): S3 bucket containing the manifest or the prefix
+        input_file_key (str): S3 object key for the manifest, or a prefix ending in '/'
+        manifest_fields (dict): Filled with the other top-level fields of a JSON manifest
+    
+    Yields:
+        str or dict: Manifest entries in order
+    """
+    count = 0
+    try:
+        if input_file_key.endswith('/'):
+            print(f"Listing PDFs under s3://{input_bucket}/{input_file_key}")
+            pdf_keys = iter_s3_prefix_pdf_keys(input_bucket, input_file_key)
+        else:
+            print(f"Retrieving manifest from S3: s3://{input_bucket}/{input_file_key}")
+            text = iter_s3_text(input_bucket, input_file_key)
+            if input_file_key.lower().endswith(JSON_LINES_SUFFIXES):
+                pdf_keys = iter_json_lines_manifest_keys(text)
+            else:
+                pdf_keys = iter_json_manifest_keys(text, manifest_fields)
+        for pdf_key in pdf_keys:
+            count += 1
+            yield pdf_key
+        print(f"Read {count} PDF keys from the manifest")
+    
+    except json.JSONDecodeError as e:
+        error_msg = f"Error parsing JSON data from S3: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+    except Exception as e:
+        error_msg = f"Error retrieving or processing S3 object: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+
+def iter_s3_text(s3_bucket, s3_key):
+    """Yield the UTF-8 text of an S3 object in MANIFEST_READ_SIZE chunks as they arrive."""
+    s3 = get_s3_client()
+    with metrics_span('manifest'):
+        response = s3.get_object(Bucket=s3_bucket, Key=s3_key)
+    body = response['Body']
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        with metrics_span('manifest'):
+            chunk = body.read(MANIFEST_READ_SIZE)
+        if not chunk:
+            break
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+def iter_s3_prefix_pdf_keys(s3_bucket, prefix):
+    """Yield the .pdf keys under an S3 prefix in key order, one list_objects_v2 page at a time."""
+    s3 = get_s3_client()
+    pages = iter(s3.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=prefix))
+    while True:
+        with metrics_span('manifest'):
+            page = next(pages, None)
+        if page is None:
+            break
+        for item in page.get('Contents', []):
+            if item['Key'].lower().endswith('.pdf'):
+                yield item['Key']
+
+def iter_json_lines_manifest_keys(text_chunks):
+    """Yield the entry (a key or an entry object) on each non-blank line of a JSON Lines manifest."""
+    line_number = 0
+    partial = ''
+    for chunk in text_chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield json_lines_manifest_entry(line, line_number)
+    if partial.strip():
+        yield json_lines_manifest_entry(partial, line_number + 1)
+
+def json_lines_manifest_entry(line, line_number):
+    entry = json.loads(line)
+    if not isinstance(entry, (str, dict)):
+        raise Exception(f"Line {line_number} of the JSON Lines manifest is not a key or an entry object: {line.strip()}")
+    return entry
+
+def iter_json_manifest_keys(text_chunks, manifest_fields=None):
+    """
+    Yield the entries of the "pdfs" array of a JSON manifest as its text arrives.
+    
+    Only the top-level object and the "pdfs" array are walked by hand; each key and
+    every other top-level value is parsed with json's raw_decode.
+    
+    Args:
+        text_chunks (iterable): Manifest text in chunks
+        manifest_fields (dict): Filled with the other top-level fields
+    
+    Yields:
+        Entries of the "pdfs" array, in order
+    """
+    reader = JsonStreamReader(text_chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+    else:
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name == 'pdfs' and reader.peek() == '[':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                value = reader.value()
+                if manifest_fields is not None:
+                    manifest_fields[name] = value
+            if reader.expect(',}') == '}':
+                break
+    if reader.peek():
+        raise json.JSONDecodeError("Extra data", reader.buffer, reader.position)
+
+class JsonStreamReader:
+    """
+    Reads JSON values one at a time from text that arrives in chunks.
+    
+    Text already parsed is dropped whenever a chunk is appended, so the buffer holds
+    roughly one chunk plus the value being parsed.
+    """
+    
+    def __init__(self, text_chunks):
+        self.chunks = iter(text_chunks)
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.done = False
+    
+    def fill(self):
+        """Append the next chunk. Returns False at the end of the text."""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+    
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the end of the text."""
+        while True:
+            self.position = JSON_WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ''
+    
+    def expect(self, characters):
+        """Consume the next character, which must be one of characters, and return it."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(f"Expecting one of {characters!r}", self.buffer, self.position)
+        self.position += 1
+        return character
+    
+    def value(self):
+        """Parse and consume the next JSON value."""
+        self.peek()
+        minimum = 0
+        while True:
+            while len(self.buffer) - self.position < minimum and self.fill():
+                pass
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self.done:
+                    raise
+                # Incomplete value: retry once the text after it has doubled, so a large
+                # value is parsed a logarithmic number of times rather than once per chunk
+                minimum = 2 * (len(self.buffer) - self.position) + 1
+                continue
+            if (not self.done and type(value) in (int, float) and
+                    JSON_NUMBER_CONTINUATION.match(self.buffer, end).end() == len(self.buffer)):
+                # A number at the end of the buffer may go on in the next chunk, also
+                # when the chunk ends in its fraction or exponent ("1." or "1e")
+                minimum = len(self.buffer) - self.position + 1
+                continue
+            self.position = end
+            return value
+
+def download_pdf_from_s3(s3_bucket, s3_key, use_cache=False, cache_stats=None):
+    """
+    Download a PDF file from S3 and return its binary content.
+    
+    With use_cache, a copy cached by an earlier download is revalidated with a
+    conditional GET (If-None-Match on its ETag) and reused when S3 answers 304.
+    
+    Args:
+        s3_bucket (str): S3 bucket name containing the PDF file
+        s3_key (str): S3 object key for the PDF file
+        use_cache (bool): Use the /tmp PDF cache
+        cache_stats (Counter): Per-job counter updated with cache 'hits' and 'misses'
+    
+    Returns:
+        bytes or SourceFile: Binary content of the PDF file, or the /tmp file holding
+                             it when it is DOWNLOAD_TO_FILE_MIN_BYTES or larger
+    """
+    from botocore.exceptions import ClientError
+    try:
+        s3 = get_s3_client()
+        if not use_cache:
+            response = s3.get_object(Bucket=s3_bucket, Key=s3_key)
+            count_s3_retries(response)
+            return read_pdf_body(s3_bucket, s3_key, response)
+        
+        cached = get_cached_pdf(s3_bucket, s3_key)
+        if cached:
+            etag, path = cached
+            try:
+                response = s3.get_object(Bucket=s3_bucket, Key=s3_key, IfNoneMatch=etag)
+            except ClientError as e:
+                if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') != 304:
+                    raise
+                pdf_data = read_cached_pdf(s3_bucket, s3_key, path)
+                if pdf_data is not None:
+                    count_cache_result(cache_stats, 'hits')
+                    return pdf_data
+                # The cached copy went missing, fetch the object again
+                response = s3.get_object(Bucket=s3_bucket, Key=s3_key)
+        else:
+            response = s3.get_object(Bucket=s3_bucket, Key=s3_key)
+        
+        count_s3_retries(response)
+        pdf_data = read_pdf_body(s3_bucket, s3_key, response)
+        count_cache_result(cache_stats, 'misses')
+        # Sources large enough to go to a file are over any sensible cache size
+        if response.get('ETag') and not isinstance(pdf_data, SourceFile):
+            store_cached_pdf(s3_bucket, s3_key, response['ETag'], pdf_data)
+        return pdf_data
+    except Exception as e:
+        error_msg = f"Error downloading PDF from S3: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+
+def read_pdf_body(s3_bucket, s3_key, response):
+    """
+    Read the body of a GetObject response into memory, or into a /tmp file when it is large.
+    
+    Returns:
+        bytes or SourceFile: The object content
+    """
+    min_bytes = get_env_int('DOWNLOAD_TO_FILE_MIN_BYTES', DEFAULT_DOWNLOAD_TO_FILE_MIN_BYTES)
+    size = response.get('ContentLength')
+    if not min_bytes or size is None or size < min_bytes:
+        return response['Body'].read()
+    return download_pdf_to_file(s3_bucket, s3_key, response)
+
+def download_pdf_to_file(s3_bucket, s3_key, response):
+    """
+    Download a large S3 object into a /tmp file with parallel ranged GETs.
+    
+    The GET already made supplies the first part, and the other parts are fetched
+    DOWNLOAD_PART_CONCURRENCY at a time with If-Match on its ETag, so they all come
+    from the same version of the object. Each part is written at its offset as it
+    streams in.
+    
+    Args:
+        s3_bucket (str): S3 bucket name containing the object
+        s3_key (str): S3 object key
+        response (dict): GetObject response for the whole object, its body unread
+    
+    Returns:
+        SourceFile: The downloaded file
+    """
+    s3 = get_s3_client()
+    size = response['ContentLength']
+    part_size = max(1, get_env_int('DOWNLOAD_PART_SIZE', DEFAULT_DOWNLOAD_PART_SIZE))
+    part_concurrency = max(1, get_env_int('DOWNLOAD_PART_CONCURRENCY', DEFAULT_DOWNLOAD_PART_CONCURRENCY))
+    match = {'IfMatch': response['ETag']} if response.get('ETag') else {}
+    path = f'/tmp/{uuid.uuid4()}-source.pdf'
+    
+    def fetch_part(first):
+        last = min(first + part_size, size) - 1
+        part = s3.get_object(Bucket=s3_bucket, Key=s3_key, Range=f'bytes={first}-{last}', **match)
+        count_s3_retries(part)
+        write_body_at(part['Body'], fd, first, last + 1)
+    
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=part_concurrency) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, fetch_part, first)
+                       for first in range(part_size, size, part_size)]
+            try:
+                write_body_at(response['Body'], fd, 0, min(part_size, size))
+            finally:
+                # Drop the rest of the first response, the ranged GETs fetch it
+                response['Body'].close()
+            for future in futures:
+                future.result()
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        os.close(fd)
+    print(f"Downloaded {s3_key} ({size} bytes) to {path} in {len(futures) + 1} parts")
+    return SourceFile(path, size)
+
+def write_body_at(body, fd, offset, end):
+    """Write a response body to a file descriptor from offset up to end."""
+    while offset < end:
+        chunk = body.read(min(DOWNLOAD_READ_SIZE, end - offset))
+        if not chunk:
+            raise Exception(f"Response ended {end - offset} bytes short")
+        offset += os.pwrite(fd, chunk, offset)
+
+class SourceFile:
+    """
+    A downloaded source PDF held in a /tmp file instead of in memory.
+    
+    It takes the place of the downloaded bytes, with len() as its size. The file
+    is removed once open_source_pdf has opened it; MuPDF keeps reading it through
+    the open handle.
+    """
+    
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+    
+    def __len__(self):
+        return self.size
+    
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+def open_source_pdf(pdf_data, remove=True):
+    """
+    Open downloaded source data as a fitz document: bytes from memory, a SourceFile by file name.
+    
+    Args:
+        pdf_data (bytes or SourceFile): Downloaded PDF
+        remove (bool): Remove a SourceFile's file once it is open
+    """
+    import fitz
+    if isinstance(pdf_data, SourceFile):
+        try:
+            return fitz.open(pdf_data.path, filetype="pdf")
+        finally:
+            if remove:
+                pdf_data.remove()
+    return fitz.open(stream=pdf_data, filetype="pdf")
+
+def get_pdf_cache_index():
+    """
+    Return the PDF cache index, clearing out the cache directory on first use.
+    
+    The index lives in memory for the life of the execution environment, so any
+    files left in the directory without an index entry are orphans.
+    
+    Returns:
+        OrderedDict: (bucket, key) -> (etag, path, size), least recently used first
+    """
+    global pdf_cache_index
+    if pdf_cache_index is None:
+        cache_dir = os.environ.get('PDF_CACHE_DIR') or DEFAULT_PDF_CACHE_DIR
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        pdf_cache_index = OrderedDict()
+    return pdf_cache_index
+
+def get_cached_pdf(s3_bucket, s3_key):
+    """
+    Look up a cached copy of an S3 object.
+    
+    Returns:
+        tuple: (etag, path) of the cached copy, or None
+    """
+    with pdf_cache_lock:
+        entry = get_pdf_cache_index().get((s3_bucket, s3_key))
+        return entry[:2] if entry else None
+
+def read_cached_pdf(s3_bucket, s3_key, path):
+    """
+    Read a cached PDF and mark it most recently used.
+    
+    The file is read outside pdf_cache_lock, so other downloads aren't held up by
+    it. Cached files are written under a temporary name and renamed into place, and
+    an evicted file that is already open can still be read to the end.
+    
+    Returns:
+        bytes: Cached content, or None if the file is gone (its entry is dropped)
+    """
+    try:
+        with open(path, 'rb') as cached_file:
+            pdf_data = cached_file.read()
+    except OSError:
+        pdf_data = None
+    with pdf_cache_lock:
+        index = get_pdf_cache_index()
+        entry = index.get((s3_bucket, s3_key))
+        if entry is not None and entry[1] == path:
+            if pdf_data is None:
+                del index[(s3_bucket, s3_key)]
+            else:
+                index.move_to_end((s3_bucket, s3_key))
+    return pdf_data
+
+def store_cached_pdf(s3_bucket, s3_key, etag, pdf_data):
+    """
+    Add a downloaded PDF to the cache, evicting least recently used entries over the size cap.
+    
+    Args:
+        s3_bucket (str): S3 bucket name
+        s3_key (str): S3 object key
+        etag (str): ETag of the downloaded object
+        pdf_data (bytes): Object content
+    """
+    max_bytes = get_env_int('PDF_CACHE_MAX_BYTES', DEFAULT_PDF_CACHE_MAX_BYTES)
+    if len(pdf_data) > max_bytes:
+        return
+    cache_dir = os.environ.get('PDF_CACHE_DIR') or DEFAULT_PDF_CACHE_DIR
+    min_free_bytes = get_env_int('PDF_CACHE_MIN_FREE_BYTES', DEFAULT_PDF_CACHE_MIN_FREE_BYTES)
+    name = hashlib.sha256(f'{s3_bucket}/{s3_key}/{etag}'.encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, f'{name}.pdf')
+    
+    with pdf_cache_lock:
+        index = get_pdf_cache_index()
+        # Leave room in /tmp for the merge's output and downloads
+        if shutil.disk_usage(cache_dir).free - len(pdf_data) < min_free_bytes:
+            print(f"Not caching s3://{s3_bucket}/{s3_key}: less than {min_free_bytes} bytes would stay free in {cache_dir}")
+            return
+        previous = index.pop((s3_bucket, s3_key), None)
+        if previous and previous[1] != path and os.path.isfile(previous[1]):
+            os.remove(previous[1])
+        
+        # Write under a temporary name so a partial file is never served
+        with open(path + '.part', 'wb') as cached_file:
+            cached_file.write(pdf_data)
+        os.replace(path + '.part', path)
+        index[(s3_bucket, s3_key)] = (etag, path, len(pdf_data))
+        
+        total = sum(entry[2] for entry in index.values())
+        while total > max_bytes:
+            _, (_, evicted_path, evicted_size) = index.popitem(last=False)
+            if os.path.isfile(evicted_path):
+                os.remove(evicted_path)
+            total -= evicted_size
+
+def count_cache_result(cache_stats, result):
+    """Add one cache 'hits' or 'misses' to a per-job counter, if there is one."""
+    if cache_stats is not None:
+        with pdf_cache_lock:
+            cache_stats[result] += 1
+
+def prefetch_pdfs(input_s3_bucket, s3_keys, download_concurrency, max_bytes_in_flight,
+                  use_cache=False, cache_stats=None):
+    """
+    Download PDFs from S3 ahead of the merge and yield them in manifest order.
+    
+    Up to download_concurrency downloads run at once. No new download is started
+    while the PDFs downloaded but not yet merged hold more than max_bytes_in_flight
+    bytes; the next PDF in order is always fetched so the merge keeps moving.
+    
+    Args:
+        input_s3_bucket (str): S3 bucket name containing the PDF files
+        s3_keys (iterable): S3 object keys in merge order
+        download_concurrency (int): Maximum number of PDFs downloading or waiting to be merged
+        max_bytes_in_flight (int): Byte limit for downloaded PDFs waiting to be merged
+        use_cache (bool): Use the /tmp PDF cache
+        cache_stats (Counter): Per-job cache hit and miss counter
+    
+    Yields:
+        tuple: (s3_key, bytes) for each key, in the order of s3_keys
+    """
+    keys = iter(s3_keys)
+    pending = deque()
+    exhausted = False
+    sizes_seen = [0, 0]  # total bytes and count of completed downloads
+
+    def bytes_in_flight():
+        # Completed downloads count with their real size, running ones with the average so far
+        average_size = sizes_seen[0] // sizes_seen[1] if sizes_seen[1] else 0
+        total = 0
+        for _, future in pending:
+            if future.done() and not future.exception():
+                total += len(future.result() or b'')
+            else:
+                total += average_size
+        return total
+
+    def download(s3_key):
+        with metrics_span('download', s3_key):
+            return download_pdf_from_s3(input_s3_bucket, s3_key, use_cache=use_cache, cache_stats=cache_stats)
+
+    def top_up():
+        nonlocal exhausted
+        while (not exhausted and len(pending) < download_concurrency
+               and (not pending or bytes_in_flight() < max_bytes_in_flight)):
+            s3_key = next(keys, None)
+            if s3_key is None:
+                exhausted = True
+                break
+            # Run in a copy of this context so the download records into the job's metrics
+            pending.append((s3_key, executor.submit(contextvars.copy_context().run, download, s3_key)))
+
+    executor = ThreadPoolExecutor(max_workers=download_concurrency)
+    try:
+        top_up()
+        while pending:
+            s3_key, future = pending.popleft()
+            pdf_data = future.result()
+            sizes_seen[0] += len(pdf_data or b'')
+            sizes_seen[1] += 1
+
+            # Refill the read-ahead window while this PDF is being merged
+            top_up()
+            yield s3_key, pdf_data
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        # Downloads that went to /tmp files and will never be merged
+        for _, future in pending:
+            if not future.cancelled() and future.exception() is None and isinstance(future.result(), SourceFile):
+                future.result().remove()
+
+def merge_pdfs(input_s3_bucket, s3_keys, output_file, optimize_pdf=False,
+               download_concurrency=None, max_bytes_in_flight=None, memory_budget_mb=None,
+               use_cache=None, optimize_mode=None, dedupe_resources=None, append_to=None,
+               image_profile=None, image_profile_mode=None, resume_from=None, stop_at_deadline=False,
+               on_source_error=None, save_profile=None):
+    """
+    Merge multiple PDF files into a single PDF.
+    
+    Manifest entries are keys, or objects with a key and page ranges (see
+    parse_manifest_entry) of which only the selected pages are inserted.
+    
+    Source PDFs are downloaded ahead of the merge in parallel (see prefetch_pdfs),
+    so S3 round trips overlap with insert_pdf. s3_keys may be an iterator over a
+    manifest that is still being read; keys are pulled from it only as far as the
+    read-ahead goes. A key listed several times is downloaded and opened once and
+    inserted at each of its positions. Each source is closed as soon as its last
+    occurrence has been inserted. With an iterator only the occurrences read so far
+    are known, so a repeat read after the source was closed is downloaded again.
+    
+    With a memory budget, RSS is checked after every insert. When it is over budget
+    the partially merged document is flushed to a work file in /tmp (full save the
+    first time, incremental saves after that) and reopened from disk, so only the
+    documents merged since the last flush are held in memory.
+    
+    With optimize_pdf and optimize_mode 'parallel', each source is cleaned and
+    deflated in a worker process as it arrives (see parallel_map), and the merged
+    document is saved with garbage=4 alone, without the single-threaded clean and deflate.
+    
+    With image_profile, the images of each source are downsampled and recompressed
+    in a worker process as it arrives (see rewrite_source_images). In 'auto' mode only
+    sources over IMAGE_PROFILE_MIN_BYTES_PER_PAGE are rewritten, lean ones pass through.
+    
+    With dedupe_resources (and no optimize_pdf, whose garbage=4 pass already does
+    this), font and image streams identical to ones merged earlier are dropped as
+    each source is inserted (see dedupe_inserted_resources).
+    
+    With save_profile, the merged document is saved with that profile's options (see
+    SAVE_PROFILES) instead of optimize_pdf's. In 'parallel' optimize_mode, optimize_pdf
+    still cleans and deflates the sources.
+    
+    With append_to, the sources are appended to that existing PDF and saved with
+    incremental saves, which write only the new objects. optimize_pdf, save_profile and
+    dedupe_resources rewrite the whole file and cannot be used.
+    
+    With resume_from, the merge continues a checkpoint: the sources are appended to
+    that partial merged PDF, which is then treated like a flushed work file.
+    
+    With stop_at_deadline, the merge stops early when the Lambda invocation has less
+    than the checkpoint reserve left (get_checkpoint_reserve_ms), after merging at least one entry. What was
+    merged is saved without optimization, and stats report interrupted and the number
+    of entries merged, for process_merge to checkpoint.
+    
+    With on_source_error 'skip' or 'placeholder', each source is validated when it is
+    opened (see validate_source_pdf). A source that fails to open, validate or insert
+    is quarantined: its entries are left out, or each replaced by a placeholder page
+    naming it, and listed in stats quarantined. An insert that fails midway is rolled back.
+    
+    Args:
+        input_s3_bucket (str): S3 bucket name containing the PDF files
+        s3_keys (list or iterator): Manifest entries for the PDFs to merge, in order
+        output_file (str or file): Path or writable file object to save the merged PDF
+        optimize_pdf (bool): Save with deflate, garbage and clean options
+        download_concurrency (int): Parallel downloads, defaults to DOWNLOAD_CONCURRENCY env
+        max_bytes_in_flight (int): Read-ahead byte limit, defaults to DOWNLOAD_MAX_BYTES_IN_FLIGHT env
+        memory_budget_mb (int): RSS budget in MB, defaults to MERGE_MEMORY_BUDGET_MB env (0 = off)
+        use_cache (bool): Use the /tmp PDF cache, defaults to on when PDF_CACHE_MAX_BYTES is set
+        optimize_mode (str): 'single' or 'parallel', defaults to OPTIMIZE_MODE env
+        dedupe_resources (bool): Share identical font and image streams across sources,
+                                 defaults to DEDUPE_RESOURCES env
+        append_to (str): Path of an existing PDF to append to, the same as output_file
+        image_profile (str): Key of IMAGE_PROFILES, defaults to IMAGE_PROFILE env (none = off)
+        image_profile_mode (str): 'auto' or 'always', defaults to IMAGE_PROFILE_MODE env
+        resume_from (str): Path of a checkpointed partial merge to continue, removed afterwards
+        stop_at_deadline (bool): Stop before the Lambda invocation runs out of time
+        on_source_error (str): 'fail', 'skip' or 'placeholder', defaults to SOURCE_ERROR_POLICY env
+        save_profile (str): Key of SAVE_PROFILES, defaults to SAVE_PROFILE env unless appending
+                            (none = optimize_pdf decides)
+    
+    Returns:
+        dict: Merge statistics (documents, pages, flushes, peak_rss_bytes, cache_hits,
+              cache_misses, duplicates, duplicate_resources, dedupe_bytes_saved,
+              entries, interrupted, and quarantined: one {'key', 'error', 'action',
+              'entries'} per quarantined source)
+    """
+    import fitz
+    work_file = None
+    downloads = None
+    open_documents = {}
+    try:
+        if not download_concurrency:
+            download_concurrency = get_env_int('DOWNLOAD_CONCURRENCY', DEFAULT_DOWNLOAD_CONCURRENCY)
+        if not max_bytes_in_flight:
+            max_bytes_in_flight = get_env_int('DOWNLOAD_MAX_BYTES_IN_FLIGHT', DEFAULT_MAX_BYTES_IN_FLIGHT)
+        if memory_budget_mb is None:
+            memory_budget_mb = get_env_int('MERGE_MEMORY_BUDGET_MB', DEFAULT_MEMORY_BUDGET_MB)
+        download_concurrency = max(1, int(download_concurrency))
+        max_bytes_in_flight = int(max_bytes_in_flight)
+        memory_budget = int(memory_budget_mb) * 1024 * 1024
+        if use_cache is None:
+            use_cache = get_env_int('PDF_CACHE_MAX_BYTES', DEFAULT_PDF_CACHE_MAX_BYTES) > 0
+        optimize_mode = optimize_mode or os.environ.get('OPTIMIZE_MODE') or DEFAULT_OPTIMIZE_MODE
+        if optimize_mode not in OPTIMIZE_MODES:
+            raise Exception(f"Unknown optimize_mode: {optimize_mode}. Expected one of {', '.join(OPTIMIZE_MODES)}")
+        parallel_optimize = bool(optimize_pdf) and optimize_mode == 'parallel'
+        image_profile = image_profile or os.environ.get('IMAGE_PROFILE') or None
+        if image_profile is not None and image_profile not in IMAGE_PROFILES:
+            raise Exception(f"Unknown image_profile: {image_profile}. Expected one of {', '.join(IMAGE_PROFILES)}")
+        image_profile_mode = image_profile_mode or os.environ.get('IMAGE_PROFILE_MODE') or DEFAULT_IMAGE_PROFILE_MODE
+        if image_profile_mode not in IMAGE_PROFILE_MODES:
+            raise Exception(f"Unknown image_profile_mode: {image_profile_mode}. "
+                            f"Expected one of {', '.join(IMAGE_PROFILE_MODES)}")
+        if dedupe_resources is None:
+            dedupe_resources = get_env_bool('DEDUPE_RESOURCES', False)
+        dedupe_resources = bool(dedupe_resources) and not optimize_pdf
+        on_source_error = on_source_error or os.environ.get('SOURCE_ERROR_POLICY') or DEFAULT_SOURCE_ERROR_POLICY
+        if on_source_error not in SOURCE_ERROR_POLICIES:
+            raise Exception(f"Unknown on_source_error: {on_source_error}. "
+                            f"Expected one of {', '.join(SOURCE_ERROR_POLICIES)}")
+        if append_to is None:
+            save_profile = get_save_profile(save_profile)
+        else:
+            # Appends save incrementally, SAVE_PROFILE only applies to full saves
+            if optimize_pdf or save_profile or output_file != append_to:
+                raise Exception("Appending needs output_file to be the appended PDF and no optimize_pdf or save_profile")
+            dedupe_resources = False
+        print(f"download_concurrency: {download_concurrency}, max_bytes_in_flight: {max_bytes_in_flight}, "
+              f"memory_budget_mb: {memory_budget_mb}, use_cache: {use_cache}, optimize_mode: {optimize_mode}, "
+              f"save_profile: {save_profile}")
+
+        stats = {'documents': 0, 'pages': 0, 'flushes': 0, 'peak_rss_bytes': get_rss_bytes(), 'duplicates': 0,
+                 'duplicate_resources': 0, 'dedupe_bytes_saved': 0, 'entries': 0, 'interrupted': False}
+        # Quarantined sources: key -> {'key', 'error', 'action', 'entries'}
+        quarantined = {}
+        checkpoint_reserve_ms = get_checkpoint_reserve_ms() if stop_at_deadline else None
+        seen_resources = {}
+        cache_stats = Counter()
+        rss_after_flush = 0
+
+        # (key, page ranges) of the entries read from the manifest and not merged yet,
+        # and the number of those entries per key
+        upcoming = deque()
+        remaining = Counter()
+        if isinstance(s3_keys, (list, tuple)):
+            # All keys are known up front: download each distinct key once, in order of first appearance
+            upcoming.extend(parse_manifest_entry(entry) for entry in s3_keys)
+            remaining.update(s3_key for s3_key, _ in upcoming)
+            download_keys = list(remaining)
+        else:
+            # Keys stream in from the manifest as the read-ahead asks for them
+            download_keys = read_download_keys(s3_keys, upcoming, remaining)
+        downloads = prefetch_pdfs(input_s3_bucket, download_keys,
+                                  download_concurrency, max_bytes_in_flight,
+                                  use_cache=use_cache, cache_stats=cache_stats)
+        if image_profile:
+            min_bytes_per_page = (get_env_int('IMAGE_PROFILE_MIN_BYTES_PER_PAGE', DEFAULT_IMAGE_PROFILE_MIN_BYTES_PER_PAGE)
+                                  if image_profile_mode == 'auto' else 0)
+            optimize_workers = get_env_int('OPTIMIZE_WORKERS', os.cpu_count() or 1)
+            print(f"Rewriting images with profile {image_profile} ({image_profile_mode}) "
+                  f"in {optimize_workers} worker processes")
+            # The parallel optimize pass runs in the same worker, on the rewritten source
+            rewrite = functools.partial(rewrite_source_images, image_profile=image_profile,
+                                        min_bytes_per_page=min_bytes_per_page, optimize=parallel_optimize)
+            downloads = parallel_map(rewrite, downloads, optimize_workers)
+        elif parallel_optimize:
+            optimize_workers = get_env_int('OPTIMIZE_WORKERS', os.cpu_count() or 1)
+            print(f"Optimizing sources in {optimize_workers} worker processes")
+            downloads = parallel_map(optimize_source_pdf, downloads, optimize_workers)
+
+        if append_to is not None:
+            # Flushes and the final save go to the existing PDF as incremental saves
+            merged_pdf = fitz.open(append_to)
+            work_file = append_to
+        elif resume_from is not None:
+            merged_pdf = fitz.open(resume_from)
+            work_file = resume_from
+            # The checkpoint's record of its entries doesn't belong in the output
+            clear_merged_entries(merged_pdf)
+        else:
+            # Initialize a new PDF document
+            merged_pdf = fitz.open()
+        
+        next_download = None
+        while True:
+            if not upcoming:
+                # Everything read so far is merged, the read-ahead reads on in the manifest
+                next_download = next(downloads, None)
+                if not upcoming:
+                    break
+            if stop_at_deadline and stats['entries'] and checkpoint_deadline_reached(checkpoint_reserve_ms):
+                print(f"Less than {checkpoint_reserve_ms} ms left, stopping after {stats['entries']} manifest entries")
+                stats['interrupted'] = True
+                break
+            s3_key, page_ranges = upcoming.popleft()
+            stats['entries'] += 1
+            if s3_key in open_documents:
+                # Repeated key, reuse the document opened for its first occurrence
+                pdf_document = open_documents.pop(s3_key)
+                stats['duplicates'] += 1
+            else:
+                _, pdf_data = next_download or next(downloads)
+                next_download = None
+                # Open the downloaded PDF data as a document
+                pdf_document = None
+                try:
+                    with metrics_span('open', s3_key):
+                        if pdf_data and s3_key not in quarantined:
+                            pdf_document = open_source_pdf(pdf_data)
+                            if on_source_error != 'fail':
+                                validate_source_pdf(pdf_document)
+                        elif isinstance(pdf_data, SourceFile):
+                            pdf_data.remove()
+                except Exception as e:
+                    if on_source_error == 'fail':
+                        raise
+                    if pdf_document is not None:
+                        pdf_document.close()
+                        pdf_document = None
+                    if isinstance(pdf_data, SourceFile):
+                        pdf_data.remove()
+                    quarantine_source(quarantined, s3_key, e, on_source_error)
+                if pdf_document:
+                    record_source_metrics(s3_key, bytes=len(pdf_data), pages=pdf_document.page_count)
+                    count_metric('input_bytes', len(pdf_data))
+                del pdf_data
+            
+            if pdf_document and s3_key not in quarantined:
+                # Append the document to the merged PDF
+                first_new_xref = merged_pdf.xref_length()
+                first_new_page = merged_pdf.page_count
+                try:
+                    # With page ranges only the selected pages and the objects they use are copied
+                    inserts = ([(-1, -1)] if page_ranges is None
+                               else resolve_page_ranges(s3_key, page_ranges, pdf_document.page_count))
+                    with metrics_span('insert', s3_key):
+                        for index, (from_page, to_page) in enumerate(inserts):
+                            # Keep the graft map until the source's last insert, so objects shared by
+                            # its ranges and repeats are copied once
+                            final = index == len(inserts) - 1 and remaining[s3_key] == 1
+                            merged_pdf.insert_pdf(pdf_document, from_page=from_page, to_page=to_page, final=final)
+                    stats['documents'] += 1
+                except Exception as e:
+                    if on_source_error == 'fail':
+                        raise
+                    # Take out the pages a failed insert added
+                    if merged_pdf.page_count > first_new_page:
+                        merged_pdf.delete_pages(first_new_page, merged_pdf.page_count - 1)
+                    quarantine_source(quarantined, s3_key, e, on_source_error)
+                if dedupe_resources and s3_key not in quarantined:
+                    with metrics_span('dedupe'):
+                        dedupe_inserted_resources(merged_pdf, first_new_xref, seen_resources, stats)
+            if s3_key in quarantined:
+                quarantined[s3_key]['entries'] += 1
+                if on_source_error == 'placeholder':
+                    insert_placeholder_page(merged_pdf, s3_key, quarantined[s3_key]['error'])
+            
+            # Keep the source open for its next occurrence, otherwise release it
+            remaining[s3_key] -= 1
+            if remaining[s3_key]:
+                open_documents[s3_key] = pdf_document
+            elif pdf_document:
+                pdf_document.close()
+            del pdf_document
+            
+            rss = get_rss_bytes()
+            stats['peak_rss_bytes'] = max(stats['peak_rss_bytes'], rss)
+            
+            # Flush only after real growth since the last flush, as freed memory
+            # is not always handed back to the OS
+            if memory_budget and rss > memory_budget and rss - rss_after_flush > memory_budget // 10:
+                with metrics_span('flush'):
+                    if work_file is None:
+                        work_file = f'/tmp/{uuid.uuid4()}-work.pdf'
+                        merged_pdf.save(work_file)
+                    else:
+                        merged_pdf.saveIncr()
+                    merged_pdf.close()
+                    merged_pdf = fitz.open(work_file)
+                stats['flushes'] += 1
+                rss_after_flush = get_rss_bytes()
+                print(f"RSS {rss // (1024 * 1024)} MB over budget, flushed merged PDF to {work_file} "
+                      f"({stats['documents']} documents, RSS now {rss_after_flush // (1024 * 1024)} MB)")
+        
+        stats['pages'] = merged_pdf.page_count
+        stats['quarantined'] = list(quarantined.values())
+        if quarantined:
+            count_metric('quarantined', len(quarantined))
+            if not merged_pdf.page_count:
+                raise Exception(f"Every source was quarantined, nothing to merge: {', '.join(quarantined)}")
+        stats['cache_hits'] = cache_stats['hits']
+        stats['cache_misses'] = cache_stats['misses']
+        
+        if stats['interrupted']:
+            # A partial merge is saved as is, the invocation that completes it optimizes
+            optimize_pdf = parallel_optimize = False
+            save_profile = None
+        save_options = None
+        if save_profile is not None:
+            # The profile replaces optimize_pdf's save options
+            optimize_pdf = parallel_optimize = False
+            save_options = dict(SAVE_PROFILES[save_profile])
+            if dedupe_resources:
+                # garbage=1 at least, to drop the duplicate streams
+                save_options['garbage'] = max(1, save_options.get('garbage', 0))
+        
+        # Save the merged PDF to disk
+        with metrics_span('save'):
+            if save_options is not None:
+                if not save_options and work_file is not None and isinstance(output_file, str):
+                    # The profile rewrites nothing, so finish the work file incrementally
+                    print(f"Save PDF with save profile {save_profile} (incremental)")
+                    merged_pdf.saveIncr()
+                else:
+                    print(f"Save PDF with save profile {save_profile}")
+                    merged_pdf.save(output_file, **save_options)
+            elif parallel_optimize:
+                # Sources are already clean and deflated. Without clean and deflate,
+                # the garbage=4 object dedupe across sources is a fraction of the full pass.
+                print("Save PDF with parallel PDF optimization")
+                merged_pdf.save(output_file, garbage=4)
+            elif optimize_pdf:
+                print("Save PDF with PDF optimization")        
+                merged_pdf.save(output_file, **SAVE_PROFILES['optimize'])
+            elif dedupe_resources:
+                # garbage=1 drops the duplicate streams nothing refers to any more
+                print("Save PDF with shared resources")
+                merged_pdf.save(output_file, garbage=1)
+            elif work_file is not None and isinstance(output_file, str):
+                # Finish the work file incrementally instead of rewriting it
+                print("Save PDF.  NO optimization (incremental)")
+                merged_pdf.saveIncr()
+            else:
+                print("Save PDF.  NO optimization") 
+                merged_pdf.save(output_file)
+
+        merged_pdf.close()
+        if (work_file is not None and not save_options and not optimize_pdf and not dedupe_resources
+                and isinstance(output_file, str)):
+            if work_file != output_file:
+                os.replace(work_file, output_file)
+            work_file = None
+        
+        stats['peak_rss_bytes'] = max(stats['peak_rss_bytes'], get_rss_bytes())
+        for name in ('documents', 'pages', 'flushes', 'duplicates', 'cache_hits', 'cache_misses',
+                     'duplicate_resources', 'dedupe_bytes_saved'):
+            count_metric(name, stats[name])
+        if job_metrics.get() is not None:
+            count_metric('output_bytes', os.path.getsize(output_file) if isinstance(output_file, str)
+                         else output_file.tell())
+        gauge_metric('peak_rss_bytes', stats['peak_rss_bytes'])
+        print(f"Merged PDF saved to {output_file}")
+        print(f"Merged {stats['documents']} documents, {stats['pages']} pages, {stats['flushes']} flushes, "
+              f"peak memory {stats['peak_rss_bytes'] // (1024 * 1024)} MB")
+        if dedupe_resources:
+            print(f"Resource dedupe: {stats['duplicate_resources']} duplicate font/image streams, "
+                  f"{stats['dedupe_bytes_saved']} bytes saved")
+        if use_cache:
+            print(f"PDF cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses, "
+                  f"{stats['duplicates']} repeated keys reused")
+        return stats
+    
+    except Exception as e:
+        error_msg = f"Error merging PDFs: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+    finally:
+        if downloads is not None:
+            downloads.close()
+        for pdf_document in open_documents.values():
+            if pdf_document:
+                pdf_document.close()
+        if work_file is not None and os.path.isfile(work_file):
+            os.remove(work_file)
+
+def merge_pdf_outputs(input_s3_bucket, outputs, save_output, download_concurrency=None, max_bytes_in_flight=None,
+                      use_cache=None):
+    """
+    Merge several PDFs at once from one download of each distinct source.
+    
+    Sources are downloaded in the order the outputs need them position by position,
+    so all outputs move forward together. Every downloaded source is opened once
+    and inserted into each output whose next entries it completes, and closed after
+    its last reference. An output is handed to save_output as soon as its last entry
+    is inserted, then closed. The outputs still being merged are all held in memory.
+    
+    Args:
+        input_s3_bucket (str): S3 bucket name containing the PDF files
+        outputs (list): (output key, manifest entries) per output
+        save_output (callable): Called with (output key, merged document) for each finished output
+        download_concurrency (int): Parallel downloads, defaults to DOWNLOAD_CONCURRENCY env
+        max_bytes_in_flight (int): Read-ahead byte limit, defaults to DOWNLOAD_MAX_BYTES_IN_FLIGHT env
+        use_cache (bool): Use the /tmp PDF cache, defaults to on when PDF_CACHE_MAX_BYTES is set
+    
+    Returns:
+        dict: Merge statistics (outputs, sources, documents, pages, peak_rss_bytes,
+              cache_hits, cache_misses)
+    """
+    import fitz
+    downloads = None
+    open_documents = {}
+    merged = {}
+    try:
+        if not download_concurrency:
+            download_concurrency = get_env_int('DOWNLOAD_CONCURRENCY', DEFAULT_DOWNLOAD_CONCURRENCY)
+        if not max_bytes_in_flight:
+            max_bytes_in_flight = get_env_int('DOWNLOAD_MAX_BYTES_IN_FLIGHT', DEFAULT_MAX_BYTES_IN_FLIGHT)
+        if use_cache is None:
+            use_cache = get_env_int('PDF_CACHE_MAX_BYTES', DEFAULT_PDF_CACHE_MAX_BYTES) > 0
+        
+        # (key, page ranges) still to insert per output, and references left per key,
+        # over all outputs and within each output
+        pending = [deque(parse_manifest_entry(entry) for entry in entries) for _, entries in outputs]
+        remaining = Counter(s3_key for queue in pending for s3_key, _ in queue)
+        remaining_in_output = [Counter(s3_key for s3_key, _ in queue) for queue in pending]
+        download_keys = list(dict.fromkeys(entry[0] for position in itertools.zip_longest(*pending)
+                                           for entry in position if entry is not None))
+        stats = {'outputs': len(outputs), 'sources': len(download_keys), 'documents': 0, 'pages': 0,
+                 'peak_rss_bytes': get_rss_bytes()}
+        print(f"download_concurrency: {download_concurrency}, max_bytes_in_flight: {max_bytes_in_flight}, "
+              f"use_cache: {use_cache}, {sum(remaining.values())} entries over {len(download_keys)} distinct sources")
+        
+        cache_stats = Counter()
+        downloads = prefetch_pdfs(input_s3_bucket, download_keys, max(1, int(download_concurrency)),
+                                  int(max_bytes_in_flight), use_cache=use_cache, cache_stats=cache_stats)
+        merged = {index: fitz.open() for index in range(len(outputs))}
+        for s3_key, pdf_data in downloads:
+            with metrics_span('open', s3_key):
+                open_documents[s3_key] = open_source_pdf(pdf_data) if pdf_data else None
+            if open_documents[s3_key]:
+                record_source_metrics(s3_key, bytes=len(pdf_data), pages=open_documents[s3_key].page_count)
+                count_metric('input_bytes', len(pdf_data))
+            del pdf_data
+            
+            # Move every output on as far as the open sources allow
+            for index in list(merged):
+                queue = pending[index]
+                while queue and queue[0][0] in open_documents:
+                    entry_key, page_ranges = queue.popleft()
+                    pdf_document = open_documents[entry_key]
+                    if pdf_document:
+                        inserts = ([(-1, -1)] if page_ranges is None
+                                   else resolve_page_ranges(entry_key, page_ranges, pdf_document.page_count))
+                        with metrics_span('insert', entry_key):
+                            for position, (from_page, to_page) in enumerate(inserts):
+                                # Keep the graft map while this output has more inserts of the source
+                                final = position == len(inserts) - 1 and remaining_in_output[index][entry_key] == 1
+                                merged[index].insert_pdf(pdf_document, from_page=from_page, to_page=to_page,
+                                                         final=final)
+                        stats['documents'] += 1
+                    remaining_in_output[index][entry_key] -= 1
+                    remaining[entry_key] -= 1
+                    if not remaining[entry_key]:
+                        if pdf_document:
+                            pdf_document.close()
+                        del open_documents[entry_key]
+                if not queue:
+                    merged_pdf = merged.pop(index)
+                    stats['pages'] += merged_pdf.page_count
+                    save_output(outputs[index][0], merged_pdf)
+                    merged_pdf.close()
+            stats['peak_rss_bytes'] = max(stats['peak_rss_bytes'], get_rss_bytes())
+        
+        stats['cache_hits'] = cache_stats['hits']
+        stats['cache_misses'] = cache_stats['misses']
+        for name in ('outputs', 'sources', 'documents', 'pages', 'cache_hits', 'cache_misses'):
+            count_metric(name, stats[name])
+        gauge_metric('peak_rss_bytes', stats['peak_rss_bytes'])
+        print(f"Merged {stats['outputs']} outputs from {stats['sources']} distinct sources: "
+              f"{stats['documents']} documents inserted, {stats['pages']} pages, "
+              f"peak memory {stats['peak_rss_bytes'] // (1024 * 1024)} MB")
+        return stats
+    
+    except Exception as e:
+        error_msg = f"Error merging PDFs: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+    finally:
+        if downloads is not None:
+            downloads.close()
+        for pdf_document in list(open_documents.values()) + list(merged.values()):
+            if pdf_document:
+                pdf_document.close()
+
+def validate_source_pdf(pdf_document):
+    """
+    Cheap checks that an opened source can be merged, raising on the first problem.
+    
+    Only the document's trailer and page tree are read, not the page contents.
+    """
+    if not pdf_document.is_pdf:
+        raise Exception("not a PDF")
+    if pdf_document.needs_pass:
+        raise Exception("encrypted, needs a password")
+    if pdf_document.page_count < 1:
+        raise Exception("has no pages")
+    # Loading the first and last page walks the page tree
+    pdf_document.load_page(0)
+    pdf_document.load_page(-1)
+
+def quarantine_source(quarantined, s3_key, error, policy):
+    """Record a source that can't be merged, for the job's report."""
+    error = str(error)
+    print(f"Quarantined {s3_key} ({'placeholder page' if policy == 'placeholder' else 'skipped'}): {error}")
+    quarantined[s3_key] = {'key': s3_key, 'error': error,
+                           'action': 'placeholder' if policy == 'placeholder' else 'skipped', 'entries': 0}
+
+def insert_placeholder_page(merged_pdf, s3_key, error):
+    """Append a page that stands in for a quarantined source, the size of the page before it."""
+    import fitz
+    rect = merged_pdf[-1].rect if merged_pdf.page_count else fitz.paper_rect('letter')
+    page = merged_pdf.new_page(width=rect.width, height=rect.height)
+    page.insert_textbox(fitz.Rect(72, 72, rect.width - 72, rect.height - 72),
+                        f"This document could not be merged.\n\nSource: {s3_key}\nError: {error}", fontsize=11)
+
+def parse_manifest_entry(entry):
+    """
+    Split a manifest entry into its S3 key and page ranges.
+    
+    An entry is a key, or an object {"key": ..., "pages": ...} where pages is a page
+    number, a string of ranges such as "1-3,7,10-" (1-based and inclusive, "10-" runs
+    to the last page) or a list of those.
+    
+    Args:
+        entry (str or dict): Manifest entry
+    
+    Returns:
+        tuple: (key, ranges), ranges being a tuple of (first, last) page numbers with
+               last None for the last page, or None for the whole document
+    """
+    if isinstance(entry, str):
+        return entry, None
+    if not isinstance(entry, dict) or not isinstance(entry.get('key'), str):
+        raise Exception(f"Manifest entry must be a key or an object with a key: {json.dumps(entry)}")
+    pages = entry.get('pages')
+    if pages is None:
+        return entry['key'], None
+    
+    page_ranges = []
+    for part in pages if isinstance(pages, list) else [pages]:
+        error_msg = f"Invalid page range {part!r} for {entry['key']}"
+        if isinstance(part, bool) or not isinstance(part, (str, int)):
+            raise Exception(error_msg)
+        for spec in str(part).split(','):
+            match = PAGE_RANGE.match(spec)
+            if not match:
+                raise Exception(error_msg)
+            first = int(match.group(1))
+            last = first if not match.group(2) else int(match.group(3)) if match.group(3) else None
+            if first < 1 or (last is not None and last < first):
+                raise Exception(error_msg)
+            page_ranges.append((first, last))
+    if not page_ranges:
+        raise Exception(f"No pages selected for {entry['key']}")
+    return entry['key'], tuple(page_ranges)
+
+def count_selected_pages(page_ranges, page_count):
+    """Number of pages an entry selects from a document of page_count pages (0 if unknown)."""
+    if page_ranges is None:
+        return page_count
+    return sum((page_count if last is None else last) - first + 1 for first, last in page_ranges
+               if last is not None or first <= page_count)
+
+def resolve_page_ranges(s3_key, page_ranges, page_count):
+    """
+    Turn page ranges from parse_manifest_entry into insert_pdf arguments for a document.
+    
+    Returns:
+        list: (from_page, to_page) 0-based pairs
+    """
+    resolved = []
+    for first, last in page_ranges:
+        last = page_count if last is None else last
+        if first > page_count or last > page_count:
+            raise Exception(f"Pages {first}-{last} are outside {s3_key}, which has {page_count} pages")
+        resolved.append((first - 1, last - 1))
+    return resolved
+
+def read_download_keys(s3_keys, upcoming, remaining):
+    """
+    Read entries from a manifest iterator for prefetch_pdfs, recording each one
+    for the merge loop in merge_pdfs.
+    
+    Every entry read is appended to upcoming as (key, page ranges) and its key counted
+    in remaining. A key is only yielded for download when no earlier entry for it is
+    still waiting to be merged; otherwise the merge reuses that entry's open document.
+    
+    Args:
+        s3_keys (iterator): Manifest entries in order
+        upcoming (deque): (key, page ranges) read and not merged yet
+        remaining (Counter): Entries per key in upcoming
+    
+    Yields:
+        str: Keys to download, in manifest order
+    """
+    for entry in s3_keys:
+        s3_key, page_ranges = parse_manifest_entry(entry)
+        upcoming.append((s3_key, page_ranges))
+        remaining[s3_key] += 1
+        if remaining[s3_key] == 1:
+            yield s3_key
+
+def dedupe_inserted_resources(merged_pdf, first_new_xref, seen_resources, stats):
+    """
+    Point the objects just inserted at font and image streams merged earlier, when identical.
+    
+    Candidate streams are images and embedded font files among the new objects.
+    Each is identified by resource_digest, a content hash that also covers the
+    objects it refers to (color spaces, soft masks). Every reference to a duplicate
+    in the new objects is rewritten to the earlier stream, leaving the duplicate
+    for the save to drop. Only objects added by the last insert are scanned, so
+    the cost follows the size of each source, not of the merged document.
+    
+    Args:
+        merged_pdf (fitz.Document): The document being merged into
+        first_new_xref (int): xref_length() before the insert
+        seen_resources (dict): digest -> xref of streams kept so far, updated in place
+        stats (dict): Merge statistics, duplicate_resources and dedupe_bytes_saved are updated
+    """
+    new_xrefs = range(first_new_xref, merged_pdf.xref_length())
+    candidates = set()
+    for xref in new_xrefs:
+        if merged_pdf.xref_is_stream(xref):
+            if merged_pdf.xref_get_key(xref, 'Subtype') == ('name', '/Image'):
+                candidates.add(xref)
+        elif merged_pdf.xref_get_key(xref, 'Type') == ('name', '/FontDescriptor'):
+            for key in FONT_FILE_KEYS:
+                kind, value = merged_pdf.xref_get_key(xref, key)
+                if kind == 'xref':
+                    candidates.add(int(value.split()[0]))
+    
+    digests = {}
+    replaced = {}
+    for xref in sorted(candidates):
+        kept = seen_resources.setdefault(resource_digest(merged_pdf, xref, first_new_xref, digests), xref)
+        if kept != xref:
+            replaced[xref] = kept
+            stats['dedupe_bytes_saved'] += len(merged_pdf.xref_stream_raw(xref))
+    if not replaced:
+        return
+    
+    for xref in new_xrefs:
+        if xref in replaced:
+            continue
+        source = merged_pdf.xref_object(xref, compressed=True)
+        updated = INDIRECT_REFERENCE.sub(
+            lambda match: f"{replaced.get(int(match.group(1)), int(match.group(1)))} 0 R", source)
+        if updated != source:
+            merged_pdf.update_object(xref, updated)
+    stats['duplicate_resources'] += len(replaced)
+
+def resource_digest(merged_pdf, xref, first_new_xref, digests):
+    """
+    Hash an object by content: its dictionary without /Length, its raw stream data,
+    and the digests of the newly inserted objects it refers to.
+    
+    Args:
+        merged_pdf (fitz.Document): The document being merged into
+        xref (int): Object to hash
+        first_new_xref (int): References below this are to earlier objects and kept as numbers
+        digests (dict): xref -> digest memo for this insert
+    
+    Returns:
+        str: Hex SHA-256 digest
+    """
+    if xref in digests:
+        return digests[xref] or f"cycle-{xref}"
+    digests[xref] = None
+    
+    def canonical_reference(match):
+        referenced = int(match.group(1))
+        if referenced >= first_new_xref:
+            return f"<{resource_digest(merged_pdf, referenced, first_new_xref, digests)}>"
+        return match.group(0)
+    
+    source = re.sub(r'/Length \d+', '', merged_pdf.xref_object(xref, compressed=True))
+    content = INDIRECT_REFERENCE.sub(canonical_reference, source).encode('utf-8')
+    if merged_pdf.xref_is_stream(xref):
+        content += b'\0' + merged_pdf.xref_stream_raw(xref)
+    digests[xref] = hashlib.sha256(content).hexdigest()
+    return digests[xref]
+
+def optimize_source_pdf(download):
+    """
+    Clean and deflate one downloaded source PDF. Runs in a parallel_map worker process.
+    
+    Args:
+        download (tuple): (s3_key, bytes or SourceFile) as yielded by prefetch_pdfs
+    
+    Returns:
+        tuple: (s3_key, optimized bytes), or download unchanged if the source can't be
+               read, for the merge's on_source_error policy to handle
+    """
+    s3_key, pdf_data = download
+    if not pdf_data:
+        return s3_key, pdf_data
+    try:
+        pdf_document = open_source_pdf(pdf_data, remove=False)
+    except Exception:
+        # Left to the merge, where on_source_error decides
+        return download
+    try:
+        optimized = pdf_document.tobytes(deflate=True, garbage=4, clean=True)
+    except Exception:
+        return download
+    finally:
+        pdf_document.close()
+    if isinstance(pdf_data, SourceFile):
+        pdf_data.remove()
+    return s3_key, optimized
+
+def rewrite_source_images(download, image_profile, min_bytes_per_page=0, optimize=False):
+    """
+    Downsample and recompress the images of one downloaded source PDF. Runs in a
+    parallel_map worker process.
+    
+    Sources under min_bytes_per_page are lean already and returned unchanged (or only
+    optimized), as is a rewrite that came out larger than the source.
+    
+    Args:
+        download (tuple): (s3_key, bytes or SourceFile) as yielded by prefetch_pdfs
+        image_profile (str): Key of IMAGE_PROFILES
+        min_bytes_per_page (int): Rewrite only sources with more bytes per page (0 = all)
+        optimize (bool): Also clean and deflate the source, as optimize_source_pdf does
+    
+    Returns:
+        tuple: (s3_key, rewritten bytes, or the source unchanged)
+    """
+    s3_key, pdf_data = download
+    if not pdf_data:
+        return s3_key, pdf_data
+    # A SourceFile stays in place in case the source is returned unchanged
+    try:
+        pdf_document = open_source_pdf(pdf_data, remove=False)
+    except Exception:
+        # Left to the merge, where on_source_error decides
+        return download
+    result = pdf_data
+    try:
+        bytes_per_page = len(pdf_data) // max(1, pdf_document.page_count)
+        if bytes_per_page <= min_bytes_per_page:
+            if optimize:
+                result = pdf_document.tobytes(deflate=True, garbage=4, clean=True)
+            return s3_key, result
+        pdf_document.rewrite_images(**IMAGE_PROFILES[image_profile])
+        # garbage=1 drops the replaced image streams
+        rewritten = (pdf_document.tobytes(deflate=True, garbage=4, clean=True) if optimize
+                     else pdf_document.tobytes(garbage=1))
+        print(f"Rewrote images of {s3_key} with profile {image_profile}: "
+              f"{len(pdf_data)} -> {len(rewritten)} bytes ({bytes_per_page} bytes per page)")
+        if len(rewritten) < len(pdf_data):
+            result = rewritten
+        return s3_key, result
+    finally:
+        pdf_document.close()
+        if result is not pdf_data and isinstance(pdf_data, SourceFile):
+            pdf_data.remove()
+
+def parallel_map(func, items, max_workers):
+    """
+    Apply func to items in worker processes and yield the results in item order.
+    
+    Uses plain processes and pipes because multiprocessing.Pool and
+    ProcessPoolExecutor need /dev/shm, which Lambda doesn't have. items is consumed
+    lazily and at most two items per worker are in progress or waiting to be
+    yielded, which bounds memory. A worker exception is re-raised here.
+    
+    Args:
+        func (callable): Module-level function taking one item
+        items (iterable): Items to process
+        max_workers (int): Number of worker processes
+    
+    Yields:
+        Results of func, in the order of items
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait as wait_for_connections
+    max_workers = max(1, max_workers)
+    items = iter(items)
+    workers = []
+    try:
+        for _ in range(max_workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=parallel_map_worker, args=(child_conn, func), daemon=True)
+            process.start()
+            child_conn.close()
+            workers.append((process, parent_conn))
+        
+        idle = [conn for _, conn in workers]
+        busy = {}
+        results = {}
+        next_submit = 0
+        next_yield = 0
+        exhausted = False
+        
+        while True:
+            # Hand out work while there is room for the results
+            while idle and not exhausted and next_submit - next_yield < 2 * max_workers:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                conn = idle.pop()
+                conn.send((next_submit, item))
+                busy[conn] = next_submit
+                next_submit += 1
+            
+            if next_yield in results:
+                yield results.pop(next_yield)
+                next_yield += 1
+                continue
+            if not busy:
+                return
+            
+            for conn in wait_for_connections(list(busy)):
+                index, ok, result = conn.recv()
+                del busy[conn]
+                idle.append(conn)
+                if not ok:
+                    raise Exception(result)
+                results[index] = result
+    finally:
+        if hasattr(items, 'close'):
+            items.close()
+        for process, conn in workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for process, _ in workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+def parallel_map_worker(conn, func):
+    """Worker loop for parallel_map: run func on each (index, item) until told to stop."""
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        index, item = task
+        try:
+            conn.send((index, True, func(item)))
+        except Exception as e:
+            conn.send((index, False, f"{type(e).__name__}: {e}"))
+    conn.close()
+
+class JobMetrics:
+    """
+    Timing spans, counters and per-source measurements of one merge job.
+    
+    The running job is held in the job_metrics context variable. Work the job
+    hands to other threads runs in a copy of its context (contextvars.copy_context)
+    to record into the same job.
+    """
+    
+    def __init__(self, **properties):
+        self.properties = properties
+        self.start = time.perf_counter()
+        self.spans = Counter()
+        self.counters = Counter()
+        self.gauges = {}
+        self.sources = {}
+        self.lock = threading.Lock()
+    
+    def add_span(self, name, seconds, source_key=None):
+        with self.lock:
+            self.spans[name] += seconds
+            if source_key is not None:
+                self.sources.setdefault(source_key, Counter())[f"{name}_ms"] += seconds * 1000
+    
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+    
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+    
+    def record_source(self, source_key, **values):
+        with self.lock:
+            self.sources.setdefault(source_key, Counter()).update(values)
+    
+    def emit(self, error=None):
+        """
+        Print the job as one JSON log line in CloudWatch Embedded Metric Format.
+        
+        CloudWatch Logs turns the listed metrics into CloudWatch metrics; the other
+        fields (job, status, slowest sources) stay searchable in Logs Insights.
+        """
+        values = {'JobDuration': ((time.perf_counter() - self.start) * 1000, 'Milliseconds'),
+                  'JobFailed': (1 if error else 0, 'Count')}
+        for name, seconds in self.spans.items():
+            values[metric_name(name) + 'Time'] = (seconds * 1000, 'Milliseconds')
+        for name, value in list(self.counters.items()) + list(self.gauges.items()):
+            values[metric_name(name)] = (value, 'Bytes' if name.endswith('_bytes') else 'Count')
+        
+        slowest = sorted(self.sources.items(),
+                         key=lambda item: sum(value for name, value in item[1].items() if name.endswith('_ms')),
+                         reverse=True)[:METRICS_SLOWEST_SOURCES]
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': os.environ.get('METRICS_NAMESPACE') or DEFAULT_METRICS_NAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()],
+                }],
+            },
+            'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local'),
+            'message': 'merge job metrics',
+            'status': 'failed' if error else 'succeeded',
+            **self.properties,
+            **{name: round(value, 1) for name, (value, _) in values.items()},
+            'slowest_sources': [{'key': key, **{name: round(value, 1) for name, value in source.items()}}
+                                for key, source in slowest],
+        }
+        if error:
+            document['error'] = str(error)
+        print(json.dumps(document))
+
+def metric_name(name):
+    """CloudWatch metric name for a snake_case span or counter name, e.g. cache_hits -> CacheHits."""
+    return ''.join(part.title() for part in name.split('_'))
+
+def start_job_metrics(**properties):
+    """
+    Start recording metrics for a merge job in the current context.
+    
+    Does nothing when metrics are off (MERGE_METRICS=false) or a job is already
+    recording, so a nested merge (the fan-out reduce step) records into its caller's job.
+    
+    Args:
+        **properties: Job fields included in the log line, e.g. output_file_key
+    
+    Returns:
+        Token for finish_job_metrics, or None if this call started no job
+    """
+    if job_metrics.get() is not None or not get_env_bool('MERGE_METRICS', True):
+        return None
+    return job_metrics.set(JobMetrics(**properties))
+
+def finish_job_metrics(token, error=None):
+    """Emit the job started by start_job_metrics and stop recording into it."""
+    if token is None:
+        return
+    metrics = job_metrics.get()
+    job_metrics.reset(token)
+    metrics.emit(error)
+
+@contextlib.contextmanager
+def metrics_span(name, source_key=None):
+    """Time a block into the span name of the running job, and into its source document when given."""
+    metrics = job_metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_span(name, time.perf_counter() - start, source_key)
+
+def count_metric(name, value=1):
+    """Add to a counter of the running job, if there is one."""
+    metrics = job_metrics.get()
+    if metrics is not None and value:
+        metrics.count(name, value)
+
+def gauge_metric(name, value):
+    """Record the highest value seen for a gauge of the running job, if there is one."""
+    metrics = job_metrics.get()
+    if metrics is not None:
+        metrics.gauge(name, value)
+
+def record_source_metrics(source_key, **values):
+    """Add bytes, pages or other counts to a source document of the running job, if there is one."""
+    metrics = job_metrics.get()
+    if metrics is not None:
+        metrics.record_source(source_key, **values)
+
+def count_s3_retries(response):
+    """Count the retries botocore made for an S3 call from its response metadata."""
+    metadata = response.get('ResponseMetadata') if isinstance(response, dict) else None
+    if metadata:
+        count_metric('s3_retries', metadata.get('RetryAttempts', 0))
+
+def get_rss_bytes():
+    """
+    Return the current resident set size of this process.
+    
+    Reads /proc/self/statm (Linux, as on Lambda) and falls back to the peak RSS
+    from getrusage on other platforms.
+    
+    Returns:
+        int: Resident memory in bytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+def upload_file_to_s3(output_s3_bucket, output_file_key, local_output_file, metadata=None):
+    """
+    Upload a local file to an S3 bucket.
+    
+    Args:
+        output_s3_bucket (str): Destination S3 bucket name
+        output_file_key (str): S3 object key for the uploaded file
+        local_output_file (str): Path to the local file to upload
+        metadata (dict): S3 user metadata to store on the object
+    
+    Returns:
+        bool: True if upload was successful, False otherwise
+    """
+    try:
+        print(f"Uploading {local_output_file} to s3://{output_s3_bucket}/{output_file_key}")
+        
+        s3 = get_s3_client()
+        
+        # Upload file to S3
+        with open(local_output_file, "rb") as file_data:
+            count_s3_retries(s3.put_object(Bucket=output_s3_bucket, Key=output_file_key, Body=file_data,
+                                           **metadata_args(metadata)))
+        
+        print(f"Successfully uploaded file to s3://{output_s3_bucket}/{output_file_key}")
+        return True
+        
+    except Exception as e:
+        error_msg = f"Error uploading file to S3: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+
+def upload_fileobj_to_s3(output_s3_bucket, output_file_key, fileobj, part_size=None, upload_concurrency=None,
+                         metadata=None):
+    """
+    Upload a file object to S3, using a parallel multipart upload when it spans several parts.
+    
+    Parts are read from fileobj in order and uploaded by a thread pool, with at most
+    upload_concurrency parts held in memory. If any part fails the multipart upload
+    is aborted so no orphaned parts are left behind.
+    
+    Args:
+        output_s3_bucket (str): Destination S3 bucket name
+        output_file_key (str): S3 object key for the uploaded file
+        fileobj (file): Readable and seekable file object
+        part_size (int): Bytes per part, defaults to UPLOAD_PART_SIZE env
+        upload_concurrency (int): Parallel part uploads, defaults to UPLOAD_CONCURRENCY env
+        metadata (dict): S3 user metadata to store on the object
+    
+    Returns:
+        bool: True if upload was successful
+    """
+    try:
+        part_size = part_size or get_env_int('UPLOAD_PART_SIZE', DEFAULT_UPLOAD_PART_SIZE)
+        upload_concurrency = max(1, upload_concurrency or get_env_int('UPLOAD_CONCURRENCY', DEFAULT_UPLOAD_CONCURRENCY))
+        
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+        
+        # Stay within the S3 part size and part count limits
+        part_size = max(part_size, MIN_UPLOAD_PART_SIZE, -(-size // MAX_UPLOAD_PARTS))
+        
+        s3 = get_s3_client()
+        
+        if size <= part_size:
+            print(f"Uploading {size} bytes to s3://{output_s3_bucket}/{output_file_key} with a single put_object")
+            s3.put_object(Bucket=output_s3_bucket, Key=output_file_key, Body=fileobj.read(),
+                          **metadata_args(metadata))
+            print(f"Successfully uploaded file to s3://{output_s3_bucket}/{output_file_key}")
+            return True
+        
+        print(f"Uploading {size} bytes to s3://{output_s3_bucket}/{output_file_key} in {-(-size // part_size)} parts")
+        upload_id = s3.create_multipart_upload(Bucket=output_s3_bucket, Key=output_file_key,
+                                               **metadata_args(metadata))['UploadId']
+        
+        def upload_part(part_number, data):
+            response = s3.upload_part(Bucket=output_s3_bucket, Key=output_file_key, UploadId=upload_id,
+                                      PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        
+        try:
+            parts = []
+            running = set()
+            with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+                part_number = 1
+                while True:
+                    data = fileobj.read(part_size)
+                    if not data:
+                        break
+                    if len(running) >= upload_concurrency:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        parts.extend(future.result() for future in done)
+                    running.add(executor.submit(upload_part, part_number, data))
+                    part_number += 1
+                parts.extend(future.result() for future in running)
+            
+            parts.sort(key=lambda part: part['PartNumber'])
+            s3.complete_multipart_upload(Bucket=output_s3_bucket, Key=output_file_key, UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+        except Exception:
+            print(f"Aborting multipart upload {upload_id}")
+            s3.abort_multipart_upload(Bucket=output_s3_bucket, Key=output_file_key, UploadId=upload_id)
+            raise
+        
+        print(f"Successfully uploaded file to s3://{output_s3_bucket}/{output_file_key}")
+        return True
+    
+    except Exception as e:
+        error_msg = f"Error uploading file to S3: {e}"
+        print(error_msg)
+        raise Exception(error_msg)
+
+def metadata_args(metadata):
+    """Build the Metadata argument for put_object/create_multipart_upload, if there is any."""
+    return {'Metadata': metadata} if metadata else {}
+
+class SpooledOutput:
+    """
+    Writable buffer for the merged PDF that stays in memory up to max_memory bytes
+    and then spills over to a file in /tmp.
+    
+    fitz cannot save into tempfile.SpooledTemporaryFile directly (it treats any object
+    with a name attribute as a filename), so this wraps one with just the file methods
+    fitz and the uploader use.
+    """
+    
+    def __init__(self, max_memory):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory, dir='/tmp')
+    
+    def write(self, data):
+        return self._file.write(data)
+    
+    def read(self, size=-1):
+        return self._file.read(size)
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+    
+    def tell(self):
+        return self._file.tell()
+    
+    def truncate(self, size=None):
+        return self._file.truncate(size)
+    
+    def size(self):
+        position = self._file.tell()
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        self._file.seek(position)
+        return size
+    
+    @property
+    def rolled(self):
+        return self._file._rolled
+    
+    def close(self):
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def init_preload():
+    """
+    Import fitz and build the S3 client ahead of the first merge.
+    
+    Returns:
+        dict: Milliseconds per step, also logged
+    """
+    timings = {}
+    start = time.perf_counter()
+    import fitz
+    timings['fitz'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    get_s3_client()
+    timings['s3_client'] = (time.perf_counter() - start) * 1000
+    print("Init preload: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in timings.items()))
+    return timings
+
+# In Lambda, pay for fitz and the S3 client in the init phase, once per execution
+# environment and ahead of requests with provisioned concurrency, instead of in the
+# first invocation. INIT_PRELOAD=false leaves them to the first merge that needs them.
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') and get_env_bool('INIT_PRELOAD', True):
+    init_timings = init_preload()
@@ -0,0 +1,80 @@
+import unittest
+from unittest.mock import patch
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import fitz
+
+# Add parent directory to path so we can import the lambda_function
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import batch_runner
+import lambda_function
+
+class TestBatchRunner(unittest.TestCase):
+    
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.storage = lambda_function.LocalStorageClient(self.root)
+        environment = patch.dict(os.environ, {"STORAGE_BACKEND": "local", "LOCAL_STORAGE_ROOT": self.root,
+                                              "PDF_CACHE_MAX_BYTES": "0", "MERGE_METRICS": "true"})
+        environment.start()
+        self.addCleanup(environment.stop)
+        lambda_function.set_s3_client(None)
+        self.addCleanup(lambda_function.set_s3_client, None)
+    
+    def put_pdf(self, key, pages):
+        doc = fitz.open()
+        for number in range(pages):
+            doc.new_page().insert_text((72, 72), f"{key} page {number + 1}")
+        self.storage.put("input", key, doc.tobytes())
+        doc.close()
+    
+    def test_output_key_for(self):
+        # Execute / Assert
+        self.assertEqual(batch_runner.output_key_for("manifests/2024/jan.json", "merged/"), "merged/jan.pdf")
+        self.assertEqual(batch_runner.output_key_for("feb.jsonl", ""), "feb.pdf")
+    
+    def test_list_manifests_expands_prefixes(self):
+        # Setup
+        self.storage.put("input", "manifests/a.json", b"{}")
+        self.storage.put("input", "manifests/b.jsonl", b"")
+        self.storage.put("input", "manifests/readme.txt", b"")
+        manifest_list = os.path.join(self.root, "backfill.txt")
+        with open(manifest_list, "w") as file:
+            file.write("# backfill\nother/c.json\n\n")
+        
+        # Execute
+        result = batch_runner.list_manifests("input", ["manifests/", "single.json"], manifest_list)
+        
+        # Assert
+        self.assertEqual(result, ["manifests/a.json", "manifests/b.jsonl", "single.json", "other/c.json"])
+    
+    def test_run_batch_merges_every_manifest(self):
+        # Setup
+        for name in ("a", "b", "c"):
+            self.put_pdf(f"docs/{name}.pdf", 2)
+        self.storage.put("input", "manifests/first.json", json.dumps({"pdfs": ["docs/a.pdf", "docs/b.pdf"]}).encode())
+        self.storage.put("input", "manifests/second.json", json.dumps({"pdfs": ["docs/c.pdf"]}).encode())
+        self.storage.put("input", "manifests/broken.json", json.dumps({"pdfs": ["docs/missing.pdf"]}).encode())
+        manifests = batch_runner.list_manifests("input", ["manifests/"])
+        
+        # Execute
+        batch = batch_runner.run_batch("input", "output", manifests, output_prefix="merged/", workers=2)
+        
+        # Assert
+        totals = batch['totals']
+        self.assertEqual(totals['manifests'], 3)
+        self.assertEqual(totals['failed'], 1)
+        self.assertEqual(totals['documents'], 3)
+        self.assertGreater(totals['pdfs_per_second'], 0)
+        first = fitz.open(stream=self.storage.get_object(Bucket="output", Key="merged/first.pdf")['Body'].read())
+        self.assertEqual(first.page_count, 4)
+        failed = next(result for result in batch['results'] if result['status'] == 'failed')
+        self.assertEqual(failed['manifest'], "manifests/broken.json")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,21 @@ import json
 from unittest.mock import patch, MagicMock
 import sys
 import os
+import threading
+import time
+import shutil
+import tempfile
+import subprocess
 
 # Add parent directory to path so we can import the lambda_function
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import lambda_function
 
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Import time of lambda_function outside Lambda, where nothing is preloaded. fitz and
+# boto3 alone take several times this, so importing them at module level fails it.
+COLD_START_IMPORT_BUDGET_MS = 250
+
 class TestLambdaHandler(unittest.TestCase):
     
     @patch('lambda_function.handle')
@@ -145,6 +155,204 @@ class TestLambdaHandler(unittest.TestCase):
                 "test-bucket", "test.json", "output-bucket", "output.pdf", False
             )
     
+    def test_handle_passes_download_settings(self):
+        # Setup
+        event = {
+            "Records": [
+                {
+                    "messageId": "test-message-id",
+                    "body": json.dumps({
+                        "input_bucket": "test-bucket",
+                        "input_file_key": "test.json",
+                        "output_bucket": "output-bucket",
+                        "output_file_key": "output.pdf",
+                        "download_concurrency": 16,
+                        "max_bytes_in_flight": 1048576
+                    })
+                }
+            ]
+        }
+        
+        with patch('lambda_function.process_merge') as mock_process:
+            # Execute
+            lambda_function.handle(event)
+            
+            # Assert
+            mock_process.assert_called_once_with(
+                "test-bucket", "test.json", "output-bucket", "output.pdf", False,
+                download_concurrency=16, max_bytes_in_flight=1048576
+            )
+    
+    def make_sqs_record(self, message_id, output_file_key):
+        return {
+            "messageId": message_id,
+            "body": json.dumps({
+                "input_bucket": "test-bucket",
+                "input_file_key": "test.json",
+                "output_bucket": "output-bucket",
+                "output_file_key": output_file_key
+            })
+        }
+    
+    def test_handle_sqs_reports_failed_records(self):
+        # Setup - the second record fails, the third has an unusable body
+        event = {
+            "Records": [
+                self.make_sqs_record("msg-1", "output1.pdf"),
+                self.make_sqs_record("msg-2", "output2.pdf"),
+                {"messageId": "msg-3", "body": json.dumps({"unexpected": "value"})}
+            ]
+        }
+        
+        def process_merge(input_bucket, input_file_key, output_bucket, output_file_key, optimize_pdf):
+            if output_file_key == "output2.pdf":
+                raise Exception("Test error")
+        
+        with patch('lambda_function.process_merge', side_effect=process_merge) as mock_process:
+            # Execute
+            result = lambda_function.handle(event)
+        
+        # Assert - only the failed messages are handed back to SQS
+        self.assertEqual(mock_process.call_count, 2)
+        self.assertEqual(result, {"batchItemFailures": [{"itemIdentifier": "msg-2"}, {"itemIdentifier": "msg-3"}]})
+    
+    def test_handle_sqs_processes_records_one_at_a_time_by_default(self):
+        # Setup
+        event = {"Records": [self.make_sqs_record(f"msg-{i}", f"output{i}.pdf") for i in range(3)]}
+        threads = []
+        
+        with patch('lambda_function.process_merge', side_effect=lambda *args, **kwargs: threads.append(
+                threading.current_thread())):
+            # Execute
+            result = lambda_function.handle(event)
+        
+        # Assert - every merge ran in order on the invocation's own thread
+        self.assertEqual(threads, [threading.current_thread()] * 3)
+        self.assertEqual(result, {"batchItemFailures": []})
+    
+    def test_handle_sqs_processes_records_concurrently(self):
+        # Setup - each record process logs its pid and when it ran
+        event = {"Records": [self.make_sqs_record(f"msg-{i}", f"output{i}.pdf") for i in range(4)]}
+        log_dir = tempfile.mkdtemp(prefix='test-sqs-records-')
+        self.addCleanup(shutil.rmtree, log_dir)
+        
+        def process_merge(input_bucket, input_file_key, output_bucket, output_file_key, *args, **kwargs):
+            start = time.monotonic()
+            time.sleep(0.2)
+            # Record processes can fork workers of their own
+            self.assertEqual(list(lambda_function.parallel_map(abs, [-1, -2], 2)), [1, 2])
+            if output_file_key == "output3.pdf":
+                # The process dies without a result, as when Lambda runs out of memory
+                os._exit(1)
+            with open(os.path.join(log_dir, output_file_key), 'w') as file:
+                file.write(f"{os.getpid()} {start} {time.monotonic()}")
+        
+        with patch('lambda_function.process_merge', side_effect=process_merge), \
+             patch.dict(os.environ, {"SQS_RECORD_CONCURRENCY": "2"}):
+            # Execute
+            result = lambda_function.handle(event)
+        
+        # Assert - one process per record, two at a time, and the dead one reported as failed
+        runs = []
+        for name in sorted(os.listdir(log_dir)):
+            with open(os.path.join(log_dir, name)) as file:
+                pid, start, end = file.read().split()
+                runs.append((int(pid), float(start), float(end)))
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(len({pid for pid, _, _ in runs} | {os.getpid()}), 4)
+        overlaps = [sum(1 for _, start, end in runs if start <= at < end) for _, at, _ in runs]
+        self.assertEqual(max(overlaps), 2)
+        self.assertEqual(result, {"batchItemFailures": [{"itemIdentifier": "msg-3"}]})
+    
+    def test_handle_sqs_coalesces_records_for_the_same_output(self):
+        # Setup - three records write output1.pdf, the second carries the highest sequence
+        records = [self.make_sqs_record(f"msg-{i}", "output1.pdf") for i in range(3)]
+        for rec, sequence in zip(records, [5, 9, None]):
+            body = json.loads(rec["body"])
+            if sequence is not None:
+                body["sequence"] = sequence
+            body["input_file_key"] = f"manifest-{rec['messageId']}.json"
+            rec["body"] = json.dumps(body)
+        records.append(self.make_sqs_record("msg-3", "output2.pdf"))
+        records.append(self.make_sqs_record("msg-4", "output2.pdf"))
+        event = {"Records": records}
+        
+        with patch('lambda_function.process_merge') as mock_process, \
+             patch('builtins.print') as mock_print:
+            # Execute
+            result = lambda_function.handle(event)
+        
+        # Assert - one merge per output, by the sequence winner or else the last record
+        self.assertEqual(sorted(call_args[0][1] for call_args in mock_process.call_args_list),
+                         ["manifest-msg-1.json", "test.json"])
+        self.assertEqual(result, {"batchItemFailures": []})
+        logged = [args[0] for args, _ in mock_print.call_args_list if args]
+        self.assertIn("SQS coalesce: 3 records for s3://output-bucket/output1.pdf, running msg-1, "
+                      "superseded: msg-0, msg-2", logged)
+        self.assertIn('SQS record result: {"messageId": "msg-3", "status": "superseded", "superseded_by": "msg-4", '
+                      '"duplicate": true, "duration_ms": 0}', logged)
+    
+    def test_coalesce_sqs_records_leaves_fanout_jobs_alone(self):
+        # Setup - a new merge of binder.pdf arrives in the same batch as the reduce of an earlier fan-out
+        records = [self.make_sqs_record(f"msg-{i}", "binder.pdf") for i in range(3)]
+        for rec, key, value in ((records[0], "fanout_work_prefix", "binder.pdf.fanout/job/"),
+                                (records[1], "fanout_reduce_key", "binder.pdf.fanout/job/reduce.json")):
+            body = json.loads(rec["body"])
+            body[key] = value
+            rec["body"] = json.dumps(body)
+        
+        # Execute
+        kept, superseded = lambda_function.coalesce_sqs_records(records)
+        
+        # Assert
+        self.assertEqual(kept, records)
+        self.assertEqual(superseded, [])
+    
+    def test_handle_sqs_coalescing_can_be_turned_off(self):
+        # Setup
+        event = {"Records": [self.make_sqs_record("msg-1", "output1.pdf"), self.make_sqs_record("msg-2", "output1.pdf")]}
+        
+        with patch('lambda_function.process_merge') as mock_process, \
+             patch.dict(os.environ, {"SQS_COALESCE": "false"}):
+            # Execute
+            lambda_function.handle(event)
+        
+        # Assert
+        self.assertEqual(mock_process.call_count, 2)
+    
+    @patch('lambda_function.handle')
+    def test_lambda_handler_returns_batch_item_failures(self, mock_handle):
+        # Setup
+        mock_handle.return_value = {"batchItemFailures": [{"itemIdentifier": "msg-2"}]}
+        
+        # Execute
+        result = lambda_function.lambda_handler({"Records": []}, {})
+        
+        # Assert
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(result['batchItemFailures'], [{"itemIdentifier": "msg-2"}])
+    
+    def test_handle_fanout_sub_job_payload(self):
+        # Setup - sub-jobs read their chunk manifest from the output bucket
+        event = {
+            "input_bucket": "test-bucket",
+            "manifest_bucket": "output-bucket",
+            "input_file_key": "output.pdf.fanout/job/chunk-00000.json",
+            "output_bucket": "output-bucket",
+            "output_file_key": "output.pdf.fanout/job/chunk-00000.pdf",
+            "optimize_pdf": False
+        }
+        
+        with patch('lambda_function.process_merge') as mock_process:
+            # Execute
+            lambda_function.handle(event)
+            
+            # Assert
+            mock_process.assert_called_once_with(
+                "test-bucket", "output.pdf.fanout/job/chunk-00000.json", "output-bucket",
+                "output.pdf.fanout/job/chunk-00000.pdf", False, manifest_bucket="output-bucket"
+            )
+    
     def test_handle_invalid_format(self):
         # Setup
         event = {"invalid_key": "value"}
@@ -154,6 +362,36 @@ class TestLambdaHandler(unittest.TestCase):
             lambda_function.handle(event)
         
         self.assertIn("unrecognized format", str(context.exception))
+    
+    def run_fresh_interpreter(self, code, **environment):
+        # Run code in a new interpreter next to lambda_function and return its last output line
+        env = dict(os.environ, **environment)
+        env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+        result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, env=env,
+                                capture_output=True, text=True, check=True)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    
+    def test_validation_error_loads_no_heavy_modules(self):
+        # Execute - a fresh process rejects an event, as a cold start would
+        loaded = self.run_fresh_interpreter(
+            "import json, sys, lambda_function\n"
+            "response = lambda_function.lambda_handler({'invalid_key': 'value'}, None)\n"
+            "print(json.dumps([response['statusCode']] + sorted(name for name in sys.modules\n"
+            "    if name.split('.')[0] in ('fitz', 'pymupdf', 'boto3', 'botocore', 'multiprocessing'))))")
+        
+        # Assert
+        self.assertEqual(loaded, [500])
+    
+    def test_import_within_cold_start_budget(self):
+        # Execute - best of three, to keep a busy machine from failing the budget
+        import_ms = min(self.run_fresh_interpreter(
+            "import json, time\n"
+            "start = time.perf_counter()\n"
+            "import lambda_function\n"
+            "print((time.perf_counter() - start) * 1000)") for _ in range(3))
+        
+        # Assert
+        self.assertLess(import_ms, COLD_START_IMPORT_BUDGET_MS)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -2,11 +2,59 @@ import unittest
 from unittest.mock import patch, MagicMock, mock_open, call
 import sys
 import os
+import threading
+import time
+import io
+import json
+import tempfile
+import fitz
+from botocore.exceptions import ClientError
 
 # Add parent directory to path so we can import the lambda_function
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import lambda_function
 
+def square_after_delay(value):
+    # Later items finish first, so results arrive out of order
+    time.sleep(0.01 * (5 - value))
+    return value * value
+
+def fail_on_three(value):
+    if value == 3:
+        raise ValueError("bad source")
+    return value
+
+def make_text_pdf(text, pages=1):
+    document = fitz.open()
+    for _ in range(pages):
+        document.new_page().insert_text((72, 72), text)
+    return document.tobytes()
+
+def job_metrics_lines(mock_print):
+    # EMF log lines printed by finish_job_metrics
+    lines = [args[0] for args, _ in mock_print.call_args_list if args and isinstance(args[0], str)]
+    return [json.loads(line) for line in lines if line.startswith('{"_aws"')]
+
+class FakeLambdaContext:
+    # Lambda context on a fake clock: each reading of the remaining time moves the
+    # clock forward by tick_ms, as if every merge step took that long
+    function_name = 'pdf-merge'
+    
+    def __init__(self, timeout_ms, tick_ms=0):
+        self.remaining_ms = timeout_ms
+        self.tick_ms = tick_ms
+    
+    def get_remaining_time_in_millis(self):
+        remaining = self.remaining_ms
+        self.remaining_ms = max(0, self.remaining_ms - self.tick_ms)
+        return remaining
+
+class InlineDispatcher:
+    # Runs fan-out sub-jobs one after the other in this process
+    def run(self, payloads):
+        for payload in payloads:
+            lambda_function.handle(payload)
+
 class TestPdfOperations(unittest.TestCase):
     
     @patch('lambda_function.download_pdf_from_s3')
@@ -67,7 +115,7 @@ class TestPdfOperations(unittest.TestCase):
         mock_merged_pdf.save.assert_called_once_with('/tmp/output.pdf')
         mock_merged_pdf.close.assert_called_once()
     
-    @patch('lambda_function.get_pdf_s3_keys')
+    @patch('lambda_function.iter_pdf_s3_keys')
     @patch('lambda_function.merge_pdfs')
     @patch('lambda_function.upload_file_to_s3')
     @patch('os.path.isfile')
@@ -89,7 +137,7 @@ class TestPdfOperations(unittest.TestCase):
         mock_isfile.assert_called_once()
         mock_remove.assert_called_once()
     
-    @patch('lambda_function.get_pdf_s3_keys')
+    @patch('lambda_function.iter_pdf_s3_keys')
     @patch('lambda_function.merge_pdfs')
     @patch('lambda_function.upload_file_to_s3')
     @patch('os.path.isfile')
@@ -111,7 +159,7 @@ class TestPdfOperations(unittest.TestCase):
         mock_isfile.assert_called_once()
         mock_remove.assert_called_once()
     
-    @patch('lambda_function.get_pdf_s3_keys')
+    @patch('lambda_function.iter_pdf_s3_keys')
     def test_process_merge_error(self, mock_get_keys):
         # Setup
         mock_get_keys.side_effect = Exception("Test error")
@@ -122,5 +170,1230 @@ class TestPdfOperations(unittest.TestCase):
         
         self.assertIn("Test error", str(context.exception))
 
+    @patch('lambda_function.download_pdf_from_s3')
+    def test_prefetch_pdfs_keeps_manifest_order(self, mock_download):
+        # Setup - earlier keys take longer to download than later ones
+        delays = {"file1.pdf": 0.05, "file2.pdf": 0.02, "file3.pdf": 0.0}
+        
+        def slow_download(bucket, key, **kwargs):
+            time.sleep(delays[key])
+            return key.encode('utf-8')
+        
+        mock_download.side_effect = slow_download
+        
+        # Execute
+        result = list(lambda_function.prefetch_pdfs("test-bucket", ["file1.pdf", "file2.pdf", "file3.pdf"], 3, 1024))
+        
+        # Assert
+        self.assertEqual(result, [("file1.pdf", b"file1.pdf"), ("file2.pdf", b"file2.pdf"), ("file3.pdf", b"file3.pdf")])
+    
+    @patch('lambda_function.download_pdf_from_s3')
+    def test_prefetch_pdfs_limits_concurrency(self, mock_download):
+        # Setup - track how many downloads run at the same time
+        lock = threading.Lock()
+        state = {"active": 0, "peak": 0}
+        
+        def tracked_download(bucket, key, **kwargs):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            time.sleep(0.01)
+            with lock:
+                state["active"] -= 1
+            return b"PDF content"
+        
+        mock_download.side_effect = tracked_download
+        keys = [f"file{i}.pdf" for i in range(10)]
+        
+        # Execute
+        result = list(lambda_function.prefetch_pdfs("test-bucket", keys, 2, 1024 * 1024))
+        
+        # Assert
+        self.assertEqual([key for key, _ in result], keys)
+        self.assertLessEqual(state["peak"], 2)
+    
+    @patch('lambda_function.download_pdf_from_s3')
+    def test_prefetch_pdfs_respects_byte_limit(self, mock_download):
+        # Setup - 100 byte PDFs with room for only two of them in flight
+        mock_download.return_value = b"x" * 100
+        keys = [f"file{i}.pdf" for i in range(8)]
+        generator = lambda_function.prefetch_pdfs("test-bucket", keys, 4, 250)
+        
+        # Execute - take the first PDF and give the read-ahead time to run
+        first = next(generator)
+        time.sleep(0.05)
+        calls_while_merging = mock_download.call_count
+        rest = list(generator)
+        
+        # Assert - no download was started beyond the first window of four
+        self.assertEqual(first[0], "file0.pdf")
+        self.assertEqual(calls_while_merging, 4)
+        self.assertEqual([key for key, _ in rest], keys[1:])
+    
+    @patch('lambda_function.prefetch_pdfs')
+    @patch('fitz.open')
+    def test_merge_pdfs_download_settings_from_environment(self, mock_fitz_open, mock_prefetch):
+        # Setup
+        mock_prefetch.side_effect = lambda *args, **kwargs: (item for item in [("file1.pdf", b"PDF content")])
+        
+        # Execute
+        with patch.dict(os.environ, {"DOWNLOAD_CONCURRENCY": "3", "DOWNLOAD_MAX_BYTES_IN_FLIGHT": "1000"}):
+            lambda_function.merge_pdfs("test-bucket", ["file1.pdf"], "/tmp/output.pdf")
+            lambda_function.merge_pdfs("test-bucket", ["file1.pdf"], "/tmp/output.pdf", False, 5, 2000)
+        
+        # Assert - payload values win over the environment defaults
+        self.assertEqual(mock_prefetch.call_args_list[0][0][2:], (3, 1000))
+        self.assertEqual(mock_prefetch.call_args_list[1][0][2:], (5, 2000))
+
+    @patch('lambda_function.iter_pdf_s3_keys')
+    @patch('lambda_function.merge_pdfs')
+    @patch('lambda_function.upload_fileobj_to_s3')
+    @patch('lambda_function.upload_file_to_s3')
+    def test_process_merge_stream_upload(self, mock_upload_file, mock_upload_fileobj, mock_merge, mock_get_keys):
+        # Setup
+        mock_get_keys.return_value = ["file1.pdf", "file2.pdf"]
+        
+        # Execute
+        lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                      False, upload_mode='stream')
+        
+        # Assert - merged into a spooled buffer, which is uploaded without touching /tmp paths
+        output_buffer = mock_merge.call_args[0][2]
+        self.assertIsInstance(output_buffer, lambda_function.SpooledOutput)
+        mock_upload_fileobj.assert_called_once_with("output-bucket", "output-key.pdf", output_buffer, metadata=None)
+        mock_upload_file.assert_not_called()
+    
+    def test_process_merge_unknown_upload_mode(self):
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                          False, upload_mode='carrier-pigeon')
+        
+        self.assertIn("Unknown upload_mode", str(context.exception))
+    
+    @patch('lambda_function.iter_pdf_s3_keys')
+    @patch('lambda_function.head_pdf_objects')
+    @patch('lambda_function.get_output_fingerprint')
+    @patch('lambda_function.merge_pdfs')
+    @patch('lambda_function.upload_file_to_s3')
+    def test_process_merge_idempotent_skips_matching_output(self, mock_upload, mock_merge, mock_get_fingerprint,
+                                                           mock_head, mock_get_keys):
+        # Setup - the output was written by an earlier run of the same merge
+        mock_get_keys.return_value = ["file1.pdf", "file2.pdf"]
+        mock_head.return_value = {"file1.pdf": {"etag": '"e1"', "size": 10}, "file2.pdf": {"etag": '"e2"', "size": 20}}
+        mock_get_fingerprint.return_value = lambda_function.compute_merge_fingerprint(
+            "input-bucket", ["file1.pdf", "file2.pdf"], mock_head.return_value, {'optimize_pdf': False})
+        
+        # Execute
+        lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                      False, idempotent=True)
+        
+        # Assert
+        mock_get_fingerprint.assert_called_once_with("output-bucket", "output-key.pdf")
+        mock_merge.assert_not_called()
+        mock_upload.assert_not_called()
+    
+    @patch('lambda_function.iter_pdf_s3_keys')
+    @patch('lambda_function.head_pdf_objects')
+    @patch('lambda_function.get_output_fingerprint')
+    @patch('lambda_function.merge_pdfs')
+    @patch('lambda_function.upload_file_to_s3')
+    def test_process_merge_idempotent_merges_on_change_or_force(self, mock_upload, mock_merge, mock_get_fingerprint,
+                                                               mock_head, mock_get_keys):
+        # Setup
+        mock_get_keys.return_value = ["file1.pdf"]
+        mock_head.return_value = {"file1.pdf": {"etag": '"e1"', "size": 10}}
+        fingerprint = lambda_function.compute_merge_fingerprint(
+            "input-bucket", ["file1.pdf"], mock_head.return_value, {'optimize_pdf': False})
+        
+        # Execute - once with a stale fingerprint, once forced over a matching one
+        mock_get_fingerprint.return_value = "stale"
+        lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                      False, idempotent=True)
+        mock_get_fingerprint.return_value = fingerprint
+        lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                      False, idempotent=True, force=True)
+        
+        # Assert - both merged and stored the new fingerprint on the output
+        self.assertEqual(mock_merge.call_count, 2)
+        for upload_call in mock_upload.call_args_list:
+            self.assertEqual(upload_call[1]['metadata'], {'merge-fingerprint': fingerprint})
+    
+    def test_compute_merge_fingerprint_changes_with_inputs(self):
+        # Setup
+        heads = {"file1.pdf": {"etag": '"e1"'}, "file2.pdf": {"etag": '"e2"'}}
+        changed_heads = {"file1.pdf": {"etag": '"e1"'}, "file2.pdf": {"etag": '"e3"'}}
+        
+        # Execute
+        fingerprint = lambda_function.compute_merge_fingerprint("bucket", ["file1.pdf", "file2.pdf"], heads, {'optimize_pdf': False})
+        
+        # Assert
+        self.assertEqual(fingerprint, lambda_function.compute_merge_fingerprint(
+            "bucket", ["file1.pdf", "file2.pdf"], heads, {'optimize_pdf': False}))
+        self.assertNotEqual(fingerprint, lambda_function.compute_merge_fingerprint(
+            "bucket", ["file2.pdf", "file1.pdf"], heads, {'optimize_pdf': False}))
+        self.assertNotEqual(fingerprint, lambda_function.compute_merge_fingerprint(
+            "bucket", ["file1.pdf", "file2.pdf"], changed_heads, {'optimize_pdf': False}))
+        self.assertNotEqual(fingerprint, lambda_function.compute_merge_fingerprint(
+            "bucket", ["file1.pdf", "file2.pdf"], heads, {'optimize_pdf': True}))
+    
+    def test_choose_merge_route_by_total_bytes(self):
+        # Execute and Assert
+        self.assertEqual(lambda_function.choose_merge_route(100, memory_max_bytes=100, disk_max_bytes=1000), 'memory')
+        self.assertEqual(lambda_function.choose_merge_route(101, memory_max_bytes=100, disk_max_bytes=1000), 'disk')
+        self.assertEqual(lambda_function.choose_merge_route(1001, memory_max_bytes=100, disk_max_bytes=1000), 'chunked')
+    
+    @patch('lambda_function.iter_pdf_s3_keys')
+    @patch('lambda_function.get_s3_client')
+    @patch('lambda_function.merge_pdfs')
+    def test_process_merge_preflight_fails_fast_on_missing_sources(self, mock_merge, mock_get_s3_client, mock_get_keys):
+        # Setup
+        mock_get_keys.return_value = iter(["file1.pdf", {"key": "gone.pdf", "pages": "1"}, "file2.pdf"])
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        def head_object(Bucket, Key):
+            if Key == "gone.pdf":
+                raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 404}}, 'HeadObject')
+            return {'ETag': '"e"', 'ContentLength': 10}
+        mock_s3.head_object.side_effect = head_object
+        
+        # Execute
+        with self.assertRaises(Exception) as context:
+            lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                          False, preflight=True)
+        
+        # Assert - nothing was downloaded
+        self.assertIn("1 source PDFs missing from s3://input-bucket: gone.pdf", str(context.exception))
+        mock_merge.assert_not_called()
+    
+    @patch('lambda_function.iter_pdf_s3_keys')
+    @patch('lambda_function.head_pdf_objects')
+    @patch('lambda_function.merge_pdfs')
+    @patch('lambda_function.upload_file_to_s3')
+    @patch('lambda_function.upload_fileobj_to_s3')
+    @patch('lambda_function.process_fanout_merge')
+    def test_process_merge_preflight_routes_by_source_bytes(self, mock_fanout, mock_upload_fileobj, mock_upload_file,
+                                                            mock_merge, mock_head, mock_get_keys):
+        # Setup - 300 source bytes, a repeated key counts once
+        mock_get_keys.side_effect = lambda bucket, key: iter(["file1.pdf", "file2.pdf", "file1.pdf"])
+        mock_head.return_value = {"file1.pdf": {"etag": '"e1"', "size": 100}, "file2.pdf": {"etag": '"e2"', "size": 200}}
+        
+        def run(memory_max_bytes, disk_max_bytes, **options):
+            with patch.dict(os.environ, {"PREFLIGHT_MEMORY_MAX_BYTES": str(memory_max_bytes),
+                                         "PREFLIGHT_DISK_MAX_BYTES": str(disk_max_bytes)}):
+                lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                              False, preflight=True, **options)
+        
+        # Execute and Assert - memory: the output is spooled and streamed
+        run(300, 1000)
+        mock_upload_fileobj.assert_called_once()
+        mock_upload_file.assert_not_called()
+        self.assertNotIn('memory_budget_mb', mock_merge.call_args[1])
+        
+        # disk: the merge flushes within the pre-flight budget and saves to /tmp
+        run(299, 1000)
+        mock_upload_file.assert_called_once()
+        self.assertEqual(mock_merge.call_args[1]['memory_budget_mb'], lambda_function.DEFAULT_PREFLIGHT_MEMORY_BUDGET_MB)
+        
+        # Options in the request are kept
+        run(299, 1000, upload_mode='stream', memory_budget_mb=64)
+        self.assertEqual(mock_upload_fileobj.call_count, 2)
+        self.assertEqual(mock_merge.call_args[1]['memory_budget_mb'], 64)
+        
+        # chunked: fan-out, reusing the HEAD results
+        run(100, 299)
+        self.assertEqual(mock_merge.call_count, 3)
+        self.assertEqual(mock_fanout.call_args[1]['source_heads'], mock_head.return_value)
+        self.assertEqual(mock_fanout.call_args[1]['upload_mode'], 'stream')
+        mock_head.assert_called_with("input-bucket", ["file1.pdf", "file2.pdf", "file1.pdf"], allow_missing=True)
+    
+    def test_plan_merge_chunks_follows_byte_and_page_budgets(self):
+        # Setup
+        keys = ["a.pdf", "b.pdf", "c.pdf", "d.pdf", "e.pdf"]
+        sizes = {"a.pdf": 40, "b.pdf": 40, "c.pdf": 40, "d.pdf": 150, "e.pdf": 10}
+        page_counts = {"a.pdf": 1, "b.pdf": 1, "c.pdf": 1, "d.pdf": 1, "e.pdf": 9}
+        
+        # Execute and Assert - bytes only, an oversized PDF gets a chunk of its own
+        self.assertEqual(lambda_function.plan_merge_chunks(keys, sizes, 100),
+                         [["a.pdf", "b.pdf"], ["c.pdf"], ["d.pdf"], ["e.pdf"]])
+        # Pages close a chunk even when the bytes fit
+        self.assertEqual(lambda_function.plan_merge_chunks(keys, sizes, 1000, 10, page_counts),
+                         [["a.pdf", "b.pdf", "c.pdf", "d.pdf"], ["e.pdf"]])
+        self.assertEqual(lambda_function.plan_merge_chunks(keys, sizes, 0), [keys])
+        # Entries with closed page ranges count their selected pages
+        entries = [{"key": "a.pdf", "pages": "1-2"}, {"key": "b.pdf", "pages": "1-"}, "c.pdf"]
+        self.assertEqual(lambda_function.plan_merge_chunks(entries, sizes, 1000, 4, {"b.pdf": 3}),
+                         [[entries[0]], [entries[1], entries[2]]])
+    
+    @patch('lambda_function.delete_s3_prefix')
+    @patch('lambda_function.get_s3_client')
+    @patch('lambda_function.head_pdf_objects')
+    @patch('lambda_function.get_pdf_manifest')
+    def test_process_fanout_merge_maps_chunks_and_reduces_in_order(self, mock_get_manifest, mock_head,
+                                                                   mock_get_s3_client, mock_delete_prefix):
+        # Setup
+        mock_get_manifest.return_value = {"pdfs": ["a.pdf", "b.pdf", "c.pdf"]}
+        mock_head.return_value = {key: {"etag": '"e"', "size": 60} for key in ["a.pdf", "b.pdf", "c.pdf"]}
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        dispatcher = MagicMock(waits=True)
+        
+        # Execute
+        lambda_function.process_fanout_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                             True, dispatcher=dispatcher, max_chunk_bytes=100,
+                                             download_concurrency=4)
+        
+        # Assert - one sub-job per chunk, each an ordinary merge of its chunk manifest
+        payloads = dispatcher.run.call_args_list[0][0][0]
+        self.assertEqual(len(payloads), 3)
+        self.assertEqual(payloads[0]['input_bucket'], "input-bucket")
+        self.assertEqual(payloads[0]['manifest_bucket'], "output-bucket")
+        self.assertTrue(payloads[0]['optimize_pdf'])
+        self.assertEqual(payloads[0]['download_concurrency'], 4)
+        self.assertNotIn('fanout', payloads[0])
+        written = {c[1]['Key']: json.loads(c[1]['Body']) for c in mock_s3.put_object.call_args_list}
+        self.assertEqual(written[payloads[1]['input_file_key']], {"pdfs": ["b.pdf"]})
+        
+        self.assertNotIn('fanout_reduce_key', payloads[0])
+        
+        # The reduce is a job of its own that merges the chunk outputs in order into the final key
+        reduce_payload, = dispatcher.run.call_args_list[1][0][0]
+        self.assertEqual(reduce_payload['input_bucket'], "output-bucket")
+        self.assertEqual(written[reduce_payload['input_file_key']],
+                         {"pdfs": [payload['output_file_key'] for payload in payloads], "reduce_payload": reduce_payload})
+        self.assertEqual(reduce_payload['output_file_key'], "output-key.pdf")
+        self.assertEqual(reduce_payload['download_concurrency'], 4)
+        self.assertFalse(reduce_payload['optimize_pdf'])
+        # The reduce deletes the work prefix once it is done
+        self.assertTrue(reduce_payload['input_file_key'].startswith(reduce_payload['fanout_work_prefix']))
+        mock_delete_prefix.assert_not_called()
+    
+    def test_fanout_last_async_sub_job_starts_the_reduce(self):
+        # Setup - 6 sources in 3 chunks of local storage, sub-jobs started without waiting for them
+        storage = lambda_function.LocalStorageClient(tempfile.mkdtemp(prefix='test-fanout-'))
+        self.addCleanup(storage.clear)
+        lambda_function.set_s3_client(storage)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        sources = {f"part{i}.pdf": make_text_pdf(f"part {i}") for i in range(6)}
+        for key, data in sources.items():
+            storage.put("input-bucket", key, data)
+        storage.put("input-bucket", "manifest.json", json.dumps({"pdfs": list(sources)}).encode('utf-8'))
+        sub_jobs = []
+        dispatcher = MagicMock(waits=False)
+        dispatcher.run.side_effect = sub_jobs.extend
+        started = []
+        
+        # Execute - the coordinator returns before any sub-job ran, then the sub-jobs finish in reverse order
+        with patch('lambda_function.enqueue_continuation', side_effect=started.append):
+            lambda_function.process_fanout_merge("input-bucket", "manifest.json", "output-bucket", "binder.pdf",
+                                                 dispatcher=dispatcher, use_cache=False,
+                                                 max_chunk_bytes=2 * max(map(len, sources.values())))
+            self.assertEqual(len(sub_jobs), 3)
+            for payload in reversed(sub_jobs):
+                lambda_function.handle(payload)
+                self.assertEqual(len(started), 1 if payload is sub_jobs[0] else 0)
+            # A retried sub-job doesn't start it again
+            lambda_function.handle(sub_jobs[1])
+            lambda_function.handle(started[0])
+        
+        # Assert - one reduce, which merged the chunks in order and cleaned up after itself
+        self.assertEqual(len(started), 1)
+        self.assertEqual(dispatcher.run.call_count, 1)
+        merged = fitz.open(stream=storage.get_object(Bucket="output-bucket", Key="binder.pdf")['Body'].read(),
+                           filetype="pdf")
+        self.assertEqual([page.get_text().strip() for page in merged], [f"part {i}" for i in range(6)])
+        merged.close()
+        remaining = [item['Key'] for page in storage.get_paginator('list_objects_v2').paginate(Bucket="output-bucket")
+                     for item in page.get('Contents', [])]
+        self.assertEqual(remaining, ["binder.pdf"])
+    
+    def test_fanout_sub_job_retry_starts_the_reduce_after_a_failed_enqueue(self):
+        # Setup - 4 sources in 2 chunks of local storage, and a continuation queue that fails once
+        storage = lambda_function.LocalStorageClient(tempfile.mkdtemp(prefix='test-fanout-'))
+        self.addCleanup(storage.clear)
+        lambda_function.set_s3_client(storage)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        sources = {f"part{i}.pdf": make_text_pdf(f"part {i}") for i in range(4)}
+        for key, data in sources.items():
+            storage.put("input-bucket", key, data)
+        storage.put("input-bucket", "manifest.json", json.dumps({"pdfs": list(sources)}).encode('utf-8'))
+        sub_jobs = []
+        dispatcher = MagicMock(waits=False)
+        dispatcher.run.side_effect = sub_jobs.extend
+        started = []
+        def enqueue(payload):
+            if not started:
+                started.append(None)
+                raise Exception("Error enqueuing merge continuation: throttled")
+            started.append(payload)
+        
+        # Execute - the last sub-job fails to start the reduce, and its retry starts it
+        with patch('lambda_function.enqueue_continuation', side_effect=enqueue):
+            lambda_function.process_fanout_merge("input-bucket", "manifest.json", "output-bucket", "binder.pdf",
+                                                 dispatcher=dispatcher, use_cache=False,
+                                                 max_chunk_bytes=2 * max(map(len, sources.values())))
+            lambda_function.handle(sub_jobs[0])
+            with self.assertRaises(Exception):
+                lambda_function.handle(sub_jobs[1])
+            lambda_function.handle(sub_jobs[1])
+        
+        # Assert
+        self.assertEqual(len(started), 2)
+        self.assertEqual(started[1]['output_file_key'], "binder.pdf")
+    
+    def test_fanout_failed_reduce_keeps_work_prefix_for_its_retry(self):
+        # Setup - 4 sources in 2 chunks of local storage, and a reduce that fails
+        storage = lambda_function.LocalStorageClient(tempfile.mkdtemp(prefix='test-fanout-'))
+        self.addCleanup(storage.clear)
+        lambda_function.set_s3_client(storage)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        sources = {f"part{i}.pdf": make_text_pdf(f"part {i}") for i in range(4)}
+        for key, data in sources.items():
+            storage.put("input-bucket", key, data)
+        storage.put("input-bucket", "manifest.json", json.dumps({"pdfs": list(sources)}).encode('utf-8'))
+        event = {"input_bucket": "input-bucket", "input_file_key": "manifest.json", "output_bucket": "output-bucket",
+                 "output_file_key": "binder.pdf", "use_cache": False, "fanout": True,
+                 "fanout_max_chunk_bytes": 2 * max(map(len, sources.values()))}
+        merge_pdfs = lambda_function.merge_pdfs
+        def fail_reduce(input_bucket, *args, **kwargs):
+            if input_bucket == "output-bucket":
+                raise Exception("reduce failed")
+            return merge_pdfs(input_bucket, *args, **kwargs)
+        
+        # Execute
+        with patch('lambda_function.get_fanout_dispatcher', return_value=InlineDispatcher()), \
+             patch('lambda_function.merge_pdfs', side_effect=fail_reduce):
+            result = lambda_function.lambda_handler(event, None)
+        
+        # Assert - the chunk manifests and PDFs are still there for a retry of the reduce
+        self.assertEqual(result['statusCode'], 500)
+        remaining = [item['Key'] for page in storage.get_paginator('list_objects_v2').paginate(Bucket="output-bucket")
+                     for item in page.get('Contents', [])]
+        self.assertEqual(len([key for key in remaining if key.endswith('.pdf')]), 2)
+        self.assertEqual(len([key for key in remaining if key.endswith('reduce.json')]), 1)
+    
+    def test_fanout_reduce_checkpoints_and_keeps_work_prefix_for_continuation(self):
+        # Setup - 6 sources in 3 chunks of local storage, and a clock that runs out during the reduce
+        storage = lambda_function.LocalStorageClient(tempfile.mkdtemp(prefix='test-fanout-'))
+        self.addCleanup(storage.clear)
+        lambda_function.set_s3_client(storage)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        sources = {f"part{i}.pdf": make_text_pdf(f"part {i}") for i in range(6)}
+        for key, data in sources.items():
+            storage.put("input-bucket", key, data)
+        storage.put("input-bucket", "manifest.json", json.dumps({"pdfs": list(sources)}).encode('utf-8'))
+        event = {"input_bucket": "input-bucket", "input_file_key": "manifest.json", "output_bucket": "output-bucket",
+                 "output_file_key": "binder.pdf", "use_cache": False, "fanout": True,
+                 "fanout_max_chunk_bytes": 2 * max(map(len, sources.values()))}
+        continuations = []
+        
+        # Execute - the reduce checkpoints, its continuation finishes the merge
+        with patch.dict(os.environ, {'MERGE_CHECKPOINTS': 'true', 'CONTINUATION_QUEUE_URL': 'https://queue'}), \
+             patch('lambda_function.get_fanout_dispatcher', return_value=InlineDispatcher()), \
+             patch('lambda_function.enqueue_continuation', side_effect=continuations.append):
+            first = lambda_function.lambda_handler(event, FakeLambdaContext(100000, tick_ms=40000))
+            work_prefix = continuations[0]['fanout_work_prefix']
+            chunk_keys = [item['Key'] for page in storage.get_paginator('list_objects_v2').paginate(
+                Bucket="output-bucket", Prefix=work_prefix) for item in page.get('Contents', [])]
+            second = lambda_function.lambda_handler(continuations[0], FakeLambdaContext(900000))
+        
+        # Assert - the chunks outlived the first invocation, and are gone with the checkpoint after the second
+        self.assertEqual(first['statusCode'], 200)
+        self.assertEqual(second['statusCode'], 200)
+        self.assertEqual(len(continuations), 1)
+        self.assertLess(continuations[0]['resume']['entries'], 3)
+        self.assertIn(f"{work_prefix}reduce.json", chunk_keys)
+        self.assertEqual(len([key for key in chunk_keys if key.endswith('.pdf')]), 3)
+        merged = fitz.open(stream=storage.get_object(Bucket="output-bucket", Key="binder.pdf")['Body'].read(),
+                           filetype="pdf")
+        self.assertEqual([page.get_text().strip() for page in merged], [f"part {i}" for i in range(6)])
+        merged.close()
+        remaining = [item['Key'] for page in storage.get_paginator('list_objects_v2').paginate(Bucket="output-bucket")
+                     for item in page.get('Contents', [])]
+        self.assertEqual(remaining, ["binder.pdf"])
+    
+    def test_local_process_pool_dispatcher_raises_sub_job_errors(self):
+        # Setup
+        dispatcher = lambda_function.LocalProcessPoolDispatcher(max_workers=1)
+        
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            dispatcher.run([{"invalid_key": "value"}])
+        
+        self.assertIn("unrecognized format", str(context.exception))
+    
+    def test_parallel_map_yields_in_order(self):
+        # Execute
+        result = list(lambda_function.parallel_map(square_after_delay, range(5), 3))
+        
+        # Assert
+        self.assertEqual(result, [0, 1, 4, 9, 16])
+    
+    def test_parallel_map_raises_worker_errors(self):
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            list(lambda_function.parallel_map(fail_on_three, range(5), 2))
+        
+        self.assertIn("bad source", str(context.exception))
+    
+    def test_merge_pdfs_parallel_optimization(self):
+        # Setup
+        sources = {f"file{i}.pdf": make_text_pdf(f"document {i} " * 50, pages=2) for i in range(4)}
+        output_file = f"/tmp/test-merge-parallel-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]), \
+             patch.dict(os.environ, {"OPTIMIZE_WORKERS": "2"}):
+            lambda_function.merge_pdfs("test-bucket", list(sources), output_file, True, optimize_mode='parallel')
+        
+        # Assert - every page in order, and smaller than the uncompressed sources
+        merged = fitz.open(output_file)
+        self.assertEqual(merged.page_count, 8)
+        self.assertIn("document 3", merged[7].get_text())
+        merged.close()
+        self.assertLess(os.path.getsize(output_file), sum(len(data) for data in sources.values()))
+    
+    def test_merge_pdfs_image_profile_auto(self):
+        # Setup - a scanned source with a 1600x1600 image at 213 dpi and a lean text source
+        scan = fitz.open()
+        scan.new_page().insert_image(fitz.Rect(36, 36, 576, 576),
+                                     pixmap=fitz.Pixmap(fitz.csRGB, 1600, 1600, bytes(range(256)) * 30000, False))
+        sources = {"scan.pdf": scan.tobytes(), "text.pdf": make_text_pdf("lean statement")}
+        output_file = f"/tmp/test-merge-image-profile-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        rewritten = []
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]), \
+             patch.dict(os.environ, {"OPTIMIZE_WORKERS": "2", "IMAGE_PROFILE_MIN_BYTES_PER_PAGE": "100000"}):
+            lambda_function.merge_pdfs("test-bucket", list(sources), output_file, image_profile='screen')
+            for key, data in sources.items():
+                rewritten.append(lambda_function.rewrite_source_images((key, data), 'screen', 100000))
+        
+        # Assert - the scan was halved to 107 dpi (the nearest subsample over 96 dpi), the text source passed through unchanged
+        self.assertLess(len(rewritten[0][1]), len(sources["scan.pdf"]) // 4)
+        self.assertIs(rewritten[1][1], sources["text.pdf"])
+        merged = fitz.open(output_file)
+        self.assertEqual(merged.page_count, 2)
+        self.assertEqual(merged[0].get_images()[0][2], 800)
+        self.assertIn("lean statement", merged[1].get_text())
+        merged.close()
+        self.assertLess(os.path.getsize(output_file), len(sources["scan.pdf"]) // 4)
+    
+    def test_merge_pdfs_unknown_image_profile(self):
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            lambda_function.merge_pdfs("test-bucket", [], "/tmp/output.pdf", image_profile='poster')
+        
+        self.assertIn("Unknown image_profile", str(context.exception))
+    
+    def test_merge_pdfs_unknown_optimize_mode(self):
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            lambda_function.merge_pdfs("test-bucket", [], "/tmp/output.pdf", True, optimize_mode='fastest')
+        
+        self.assertIn("Unknown optimize_mode", str(context.exception))
+    
+    def test_merge_pdfs_save_profiles(self):
+        # Setup
+        sources = {f"file{i}.pdf": make_text_pdf(f"statement {i} " * 50, pages=2) for i in range(4)}
+        output_files = {profile: f"/tmp/test-merge-{profile}-{os.getpid()}.pdf" for profile in ('fast', 'archive')}
+        for output_file in output_files.values():
+            self.addCleanup(lambda path=output_file: os.path.isfile(path) and os.remove(path))
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]):
+            for profile, output_file in output_files.items():
+                lambda_function.merge_pdfs("test-bucket", list(sources), output_file, save_profile=profile)
+        
+        # Assert - the same pages, archive packs them into object streams and is smaller
+        for output_file in output_files.values():
+            merged = fitz.open(output_file)
+            self.assertEqual(merged.page_count, 8)
+            self.assertIn("statement 3", merged[7].get_text())
+            merged.close()
+        with open(output_files['archive'], 'rb') as file:
+            self.assertIn(b"/ObjStm", file.read())
+        self.assertLess(os.path.getsize(output_files['archive']), os.path.getsize(output_files['fast']))
+    
+    @patch('lambda_function.download_pdf_from_s3')
+    @patch('fitz.open')
+    def test_merge_pdfs_save_profile_replaces_optimization(self, mock_fitz_open, mock_download):
+        # Setup
+        mock_download.return_value = b"PDF content"
+        mock_merged_pdf = MagicMock()
+        mock_fitz_open.side_effect = lambda *args, **kwargs: MagicMock() if 'stream' in kwargs else mock_merged_pdf
+        
+        # Execute - optimize_pdf with the fast profile, and the compact profile from the environment
+        with patch('builtins.print') as mock_print:
+            lambda_function.merge_pdfs("test-bucket", ["file1.pdf"], "/tmp/output.pdf", True, save_profile='fast')
+            with patch.dict(os.environ, {"SAVE_PROFILE": "compact"}):
+                lambda_function.merge_pdfs("test-bucket", ["file1.pdf"], "/tmp/output.pdf")
+        
+        # Assert - the log names the profile applied, fast included
+        printed = [args[0] for args, _ in mock_print.call_args_list if args]
+        self.assertIn("Save PDF with save profile fast", printed)
+        self.assertIn("Save PDF with save profile compact", printed)
+        self.assertEqual(mock_merged_pdf.save.call_args_list, [
+            call('/tmp/output.pdf'),
+            call('/tmp/output.pdf', garbage=3, use_objstms=1),
+        ])
+    
+    def test_merge_pdfs_unknown_save_profile(self):
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            lambda_function.merge_pdfs("test-bucket", [], "/tmp/output.pdf", save_profile='smallest')
+        
+        self.assertIn("Unknown save_profile", str(context.exception))
+    
+    @patch('builtins.print')
+    @patch('lambda_function.upload_file_to_s3')
+    @patch('lambda_function.iter_pdf_s3_keys')
+    def test_process_merge_emits_job_metrics(self, mock_get_keys, mock_upload, mock_print):
+        # Setup
+        sources = {"file1.pdf": make_text_pdf("one", pages=2), "file2.pdf": make_text_pdf("two")}
+        mock_get_keys.return_value = list(sources)
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]), \
+             patch.dict(os.environ, {'METRICS_NAMESPACE': 'TestMerge'}):
+            lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf",
+                                          use_cache=False)
+        
+        # Assert - one EMF line with the phases, counters and per-source measurements
+        lines = job_metrics_lines(mock_print)
+        self.assertEqual(len(lines), 1)
+        metrics = lines[0]
+        declared = {metric['Name'] for metric in metrics['_aws']['CloudWatchMetrics'][0]['Metrics']}
+        self.assertEqual(metrics['_aws']['CloudWatchMetrics'][0]['Namespace'], 'TestMerge')
+        for name in ('JobDuration', 'DownloadTime', 'OpenTime', 'InsertTime', 'SaveTime',
+                     'UploadTime', 'Documents', 'Pages', 'InputBytes', 'OutputBytes'):
+            self.assertIn(name, declared)
+            self.assertIn(name, metrics)
+        self.assertEqual(metrics['status'], 'succeeded')
+        self.assertEqual(metrics['output_file_key'], "output-key.pdf")
+        self.assertEqual(metrics['Documents'], 2)
+        self.assertEqual(metrics['Pages'], 3)
+        self.assertEqual(metrics['InputBytes'], sum(map(len, sources.values())))
+        slowest = {source['key']: source for source in metrics['slowest_sources']}
+        self.assertEqual(slowest["file1.pdf"]['pages'], 2)
+        self.assertEqual(slowest["file2.pdf"]['bytes'], len(sources["file2.pdf"]))
+        self.assertIn('download_ms', slowest["file2.pdf"])
+        self.assertIsNone(lambda_function.job_metrics.get())
+    
+    @patch('builtins.print')
+    @patch('lambda_function.iter_pdf_s3_keys')
+    def test_process_merge_failure_emits_job_metrics(self, mock_get_keys, mock_print):
+        # Setup
+        mock_get_keys.side_effect = Exception("Test error")
+        
+        # Execute
+        with self.assertRaises(Exception):
+            lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf")
+        
+        # Assert
+        metrics = job_metrics_lines(mock_print)[0]
+        self.assertEqual(metrics['status'], 'failed')
+        self.assertEqual(metrics['JobFailed'], 1)
+        self.assertEqual(metrics['error'], "Test error")
+    
+    @patch('builtins.print')
+    @patch('lambda_function.upload_file_to_s3')
+    @patch('lambda_function.merge_pdfs')
+    @patch('lambda_function.iter_pdf_s3_keys')
+    def test_process_merge_metrics_off(self, mock_get_keys, mock_merge, mock_upload, mock_print):
+        # Setup
+        mock_get_keys.return_value = ["file1.pdf"]
+        
+        # Execute
+        with patch.dict(os.environ, {'MERGE_METRICS': 'false'}):
+            lambda_function.process_merge("input-bucket", "input-key.json", "output-bucket", "output-key.pdf")
+        
+        # Assert
+        self.assertEqual(job_metrics_lines(mock_print), [])
+    
+    def test_merge_pdfs_streams_keys_from_manifest(self):
+        # Setup - a manifest iterator with a repeated key, logging when each key is read
+        sources = {f"file{i}.pdf": make_text_pdf(f"document {i}") for i in range(4)}
+        events = []
+        def manifest():
+            for key in ["file0.pdf", "file1.pdf", "file1.pdf", "file2.pdf", "file3.pdf", "file0.pdf"]:
+                events.append(f"read {key}")
+                yield key
+        def download(bucket, key, **kwargs):
+            events.append(f"download {key}")
+            return sources[key]
+        output_file = f"/tmp/test-merge-stream-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=download):
+            stats = lambda_function.merge_pdfs("test-bucket", manifest(), output_file,
+                                               download_concurrency=1, use_cache=False)
+        
+        # Assert - the first download started before the rest of the manifest was read
+        self.assertLess(events.index("download file0.pdf"), events.index("read file2.pdf"))
+        # The adjacent repeat reuses its download, the late repeat of a closed source downloads again
+        self.assertEqual([event for event in events if event.startswith("download")],
+                         ["download file0.pdf", "download file1.pdf", "download file2.pdf",
+                          "download file3.pdf", "download file0.pdf"])
+        self.assertEqual(stats['duplicates'], 1)
+        merged = fitz.open(output_file)
+        self.assertEqual([page.get_text().strip() for page in merged],
+                         ["document 0", "document 1", "document 1", "document 2", "document 3", "document 0"])
+        merged.close()
+    
+    def test_parse_manifest_entry(self):
+        # Execute and Assert
+        self.assertEqual(lambda_function.parse_manifest_entry("a.pdf"), ("a.pdf", None))
+        self.assertEqual(lambda_function.parse_manifest_entry({"key": "a.pdf"}), ("a.pdf", None))
+        self.assertEqual(lambda_function.parse_manifest_entry({"key": "a.pdf", "pages": 1}), ("a.pdf", ((1, 1),)))
+        self.assertEqual(lambda_function.parse_manifest_entry({"key": "a.pdf", "pages": "1-3, 7,10-"}),
+                         ("a.pdf", ((1, 3), (7, 7), (10, None))))
+        self.assertEqual(lambda_function.parse_manifest_entry({"key": "a.pdf", "pages": [2, "4-5"]}),
+                         ("a.pdf", ((2, 2), (4, 5))))
+        for invalid in ({"pages": 1}, ["a.pdf"], {"key": "a.pdf", "pages": "0"}, {"key": "a.pdf", "pages": "3-2"},
+                        {"key": "a.pdf", "pages": "first"}, {"key": "a.pdf", "pages": []}):
+            with self.assertRaises(Exception):
+                lambda_function.parse_manifest_entry(invalid)
+    
+    def test_merge_pdfs_page_ranges(self):
+        # Setup - every page of the source shows the same image
+        source = fitz.open()
+        image = None
+        for number in range(1, 6):
+            page = source.new_page()
+            page.insert_text((72, 72), f"page {number}")
+            if image is None:
+                image = page.insert_image(fitz.Rect(72, 100, 172, 200),
+                                          pixmap=fitz.Pixmap(fitz.csRGB, 10, 10, bytes(300), False))
+            else:
+                page.insert_image(fitz.Rect(72, 100, 172, 200), xref=image)
+        sources = {"a.pdf": source.tobytes(), "b.pdf": make_text_pdf("other", pages=3)}
+        output_file = f"/tmp/test-merge-pages-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        entries = [{"key": "a.pdf", "pages": "1,4-"}, {"key": "b.pdf", "pages": 2}, {"key": "a.pdf", "pages": [2]}]
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]) as mock_download:
+            lambda_function.merge_pdfs("test-bucket", entries, output_file, use_cache=False)
+        
+        # Assert - only the selected pages, each source downloaded once, the shared image copied once
+        self.assertEqual(mock_download.call_count, 2)
+        merged = fitz.open(output_file)
+        self.assertEqual([page.get_text().strip() for page in merged],
+                         ["page 1", "page 4", "page 5", "other", "page 2"])
+        self.assertEqual(len({merged[i].get_images()[0][0] for i in (0, 1, 2, 4)}), 1)
+        merged.close()
+    
+    def test_merge_pdfs_page_range_outside_document(self):
+        # Setup
+        sources = {"a.pdf": make_text_pdf("one", pages=2)}
+        
+        # Execute and Assert
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]):
+            with self.assertRaises(Exception) as context:
+                lambda_function.merge_pdfs("test-bucket", [{"key": "a.pdf", "pages": "2-3"}], "/tmp/unused.pdf",
+                                           use_cache=False)
+        
+        self.assertIn("outside a.pdf, which has 2 pages", str(context.exception))
+    
+    def run_append_merge(self, existing, sources, entries, **kwargs):
+        # Run process_append_merge against an existing output (bytes, or None if missing)
+        # and return the downloaded keys and the uploaded PDF bytes (None if not uploaded)
+        def download_output(bucket, key, local_file):
+            if existing is None:
+                return False
+            with open(local_file, 'wb') as file:
+                file.write(existing)
+            return True
+        uploaded = []
+        def upload(bucket, key, local_file, metadata=None):
+            with open(local_file, 'rb') as file:
+                uploaded.append(file.read())
+        with patch('lambda_function.download_s3_object_to_file', side_effect=download_output), \
+             patch('lambda_function.upload_file_to_s3', side_effect=upload), \
+             patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kw: sources[key]) as mock_download:
+            lambda_function.process_append_merge("input-bucket", entries, "output-bucket", "binder.pdf",
+                                                 use_cache=False, **kwargs)
+        return [c[0][1] for c in mock_download.call_args_list], (uploaded[0] if uploaded else None)
+    
+    def test_process_append_merge_appends_new_entries_incrementally(self):
+        # Setup - yesterday's binder holds the first two entries
+        sources = {f"day{i}.pdf": make_text_pdf(f"day {i}") for i in range(4)}
+        _, existing = self.run_append_merge(None, sources, ["day0.pdf", "day1.pdf"])
+        
+        # Execute
+        downloaded, uploaded = self.run_append_merge(existing, sources, ["day0.pdf", "day1.pdf", "day2.pdf", "day3.pdf"])
+        
+        # Assert - only the new sources were merged, and written after the unchanged old file
+        self.assertEqual(downloaded, ["day2.pdf", "day3.pdf"])
+        self.assertTrue(uploaded.startswith(existing))
+        merged = fitz.open(stream=uploaded, filetype="pdf")
+        self.assertEqual([page.get_text().strip() for page in merged], ["day 0", "day 1", "day 2", "day 3"])
+        self.assertEqual(lambda_function.read_merged_entries(merged)[0], 4)
+        merged.close()
+    
+    def test_process_append_merge_with_save_profile_env(self):
+        # Setup - SAVE_PROFILE applies to the first, full merge
+        sources = {f"day{i}.pdf": make_text_pdf(f"day {i}") for i in range(3)}
+        with patch.dict(os.environ, {"SAVE_PROFILE": "archive"}):
+            _, existing = self.run_append_merge(None, sources, ["day0.pdf", "day1.pdf"])
+            
+            # Execute
+            downloaded, uploaded = self.run_append_merge(existing, sources, ["day0.pdf", "day1.pdf", "day2.pdf"])
+        
+        # Assert - the append still saved incrementally after the archive-profile rebuild
+        self.assertIn(b"/ObjStm", existing)
+        self.assertEqual(downloaded, ["day2.pdf"])
+        self.assertTrue(uploaded.startswith(existing))
+        merged = fitz.open(stream=uploaded, filetype="pdf")
+        self.assertEqual([page.get_text().strip() for page in merged], ["day 0", "day 1", "day 2"])
+        merged.close()
+    
+    def test_process_append_merge_up_to_date(self):
+        # Setup
+        sources = {"day0.pdf": make_text_pdf("day 0")}
+        _, existing = self.run_append_merge(None, sources, ["day0.pdf"])
+        
+        # Execute
+        downloaded, uploaded = self.run_append_merge(existing, sources, ["day0.pdf"])
+        
+        # Assert
+        self.assertEqual(downloaded, [])
+        self.assertIsNone(uploaded)
+    
+    def test_process_append_merge_rebuilds_incompatible_output(self):
+        # Setup - the binder was merged from a manifest that has since changed, or has no record
+        sources = {f"day{i}.pdf": make_text_pdf(f"day {i}") for i in range(3)}
+        _, changed = self.run_append_merge(None, sources, ["day1.pdf"])
+        unrecorded = make_text_pdf("day 0")
+        
+        for existing in (changed, unrecorded, b"not a pdf"):
+            # Execute
+            downloaded, uploaded = self.run_append_merge(existing, sources, ["day0.pdf", "day1.pdf", "day2.pdf"])
+            
+            # Assert - everything merged from scratch
+            self.assertEqual(downloaded, ["day0.pdf", "day1.pdf", "day2.pdf"])
+            merged = fitz.open(stream=uploaded, filetype="pdf")
+            self.assertEqual(merged.page_count, 3)
+            self.assertEqual(lambda_function.read_merged_entries(merged)[0], 3)
+            merged.close()
+    
+    def test_lambda_handler_checkpoints_and_resumes_before_deadline(self):
+        # Setup - 5 sources, and a 240 s clock that leaves less than the 60 s reserve before the fifth
+        sources = {f"part{i}.pdf": make_text_pdf(f"part {i}") for i in range(5)}
+        event = {"input_bucket": "input-bucket", "input_file_key": "manifest.json",
+                 "output_bucket": "output-bucket", "output_file_key": "binder.pdf", "use_cache": False}
+        objects = {}
+        continuations = []
+        def upload(bucket, key, local_file, metadata=None):
+            with open(local_file, 'rb') as file:
+                objects[key] = file.read()
+        def download_object(bucket, key, local_file):
+            with open(local_file, 'wb') as file:
+                file.write(objects[key])
+            return True
+        
+        # Execute - the first invocation checkpoints, its continuation finishes the merge
+        with patch('lambda_function.iter_pdf_s3_keys', side_effect=lambda bucket, key: iter(list(sources))), \
+             patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]), \
+             patch('lambda_function.upload_file_to_s3', side_effect=upload), \
+             patch('lambda_function.download_s3_object_to_file', side_effect=download_object), \
+             patch('lambda_function.enqueue_continuation', side_effect=continuations.append), \
+             patch('lambda_function.get_s3_client') as mock_get_s3_client, \
+             patch.dict(os.environ, {'MERGE_CHECKPOINTS': 'true', 'CONTINUATION_QUEUE_URL': 'https://queue'}):
+            first = lambda_function.lambda_handler(event, FakeLambdaContext(240000, tick_ms=60000))
+            checkpoint = fitz.open(stream=objects["binder.pdf.checkpoint"], filetype="pdf")
+            second = lambda_function.lambda_handler(continuations[0], FakeLambdaContext(240000, tick_ms=60000))
+        
+        # Assert
+        self.assertEqual(first['statusCode'], 200)
+        self.assertEqual(second['statusCode'], 200)
+        self.assertEqual(checkpoint.page_count, 4)
+        self.assertEqual(continuations[0]['resume']['entries'], 4)
+        self.assertEqual(continuations[0]['output_file_key'], "binder.pdf")
+        self.assertFalse(continuations[0]['use_cache'])
+        self.assertEqual(len(continuations), 1)
+        self.assertEqual(lambda_function.read_merged_entries(checkpoint)[0], 4)
+        merged = fitz.open(stream=objects["binder.pdf"], filetype="pdf")
+        self.assertEqual([page.get_text().strip() for page in merged], [f"part {i}" for i in range(5)])
+        self.assertIsNone(lambda_function.read_merged_entries(merged))
+        mock_get_s3_client.return_value.delete_objects.assert_called_once_with(
+            Bucket="output-bucket", Delete={'Objects': [{'Key': "binder.pdf.checkpoint"}], 'Quiet': True})
+    
+    def test_lambda_handler_does_not_checkpoint_unless_opted_in_with_a_continuation_target(self):
+        # Setup - a clock that runs out after the first entry
+        sources = {f"part{i}.pdf": make_text_pdf(f"part {i}") for i in range(3)}
+        event = {"input_bucket": "input-bucket", "input_file_key": "manifest.json",
+                 "output_bucket": "output-bucket", "output_file_key": "binder.pdf", "use_cache": False}
+        
+        for env in ({}, {'MERGE_CHECKPOINTS': 'true'}):
+            # Execute - checkpoints are off by default, and need CONTINUATION_QUEUE_URL or CONTINUATION_FUNCTION_NAME
+            with patch('lambda_function.iter_pdf_s3_keys', side_effect=lambda bucket, key: iter(list(sources))), \
+                 patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]), \
+                 patch('lambda_function.upload_file_to_s3') as mock_upload, \
+                 patch('lambda_function.enqueue_continuation') as mock_enqueue, \
+                 patch('lambda_function.get_s3_client'), \
+                 patch.dict(os.environ, env):
+                result = lambda_function.lambda_handler(event, FakeLambdaContext(100000, tick_ms=100000))
+            
+            # Assert - the merge ran to completion
+            self.assertEqual(result['statusCode'], 200)
+            self.assertEqual([args[1] for args, kwargs in mock_upload.call_args_list], ["binder.pdf"])
+            mock_enqueue.assert_not_called()
+    
+    def test_checkpoint_reserve_is_capped_at_a_quarter_of_the_invocation(self):
+        # Setup
+        token = lambda_function.invocation_time_ms.set(30000)
+        self.addCleanup(lambda_function.invocation_time_ms.reset, token)
+        
+        # Execute and Assert
+        self.assertEqual(lambda_function.get_checkpoint_reserve_ms(), 7500)
+        with patch.dict(os.environ, {'MERGE_CHECKPOINT_RESERVE_MS': '5000'}):
+            self.assertEqual(lambda_function.get_checkpoint_reserve_ms(), 5000)
+        lambda_function.invocation_time_ms.set(900000)
+        self.assertEqual(lambda_function.get_checkpoint_reserve_ms(), 60000)
+    
+    def make_bad_sources(self):
+        encrypted = fitz.open(stream=make_text_pdf("secret"), filetype="pdf")
+        sources = {"good.pdf": make_text_pdf("good", pages=2), "corrupt.pdf": b"%PDF-1.7 not really",
+                   "encrypted.pdf": encrypted.tobytes(encryption=fitz.PDF_ENCRYPT_AES_256, user_pw="pw", owner_pw="pw"),
+                   "last.pdf": make_text_pdf("last")}
+        entries = ["good.pdf", "corrupt.pdf", {"key": "good.pdf", "pages": "9"}, "encrypted.pdf", "corrupt.pdf",
+                   "last.pdf"]
+        return sources, entries
+    
+    def test_merge_pdfs_quarantines_bad_sources(self):
+        # Setup - a corrupt source listed twice, an encrypted one and a page range past the end
+        sources, entries = self.make_bad_sources()
+        output_file = f"/tmp/test-merge-quarantine-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        
+        for policy, expected_pages in (('skip', ["good", "good", "last"]),
+                                       ('placeholder', ["good", "good", "corrupt.pdf", "good.pdf", "encrypted.pdf",
+                                                        "corrupt.pdf", "last"])):
+            # Execute
+            with patch('lambda_function.download_pdf_from_s3',
+                       side_effect=lambda bucket, key, **kwargs: sources[key]) as mock_download:
+                stats = lambda_function.merge_pdfs("test-bucket", entries, output_file, use_cache=False,
+                                                   on_source_error=policy)
+            
+            # Assert - placeholder pages name their source, a bad source is downloaded once
+            merged = fitz.open(output_file)
+            self.assertEqual([page.get_text().split("Source: ")[-1].split()[0] for page in merged], expected_pages)
+            merged.close()
+            self.assertEqual(mock_download.call_count, 4)
+            self.assertEqual([(item['key'], item['entries']) for item in stats['quarantined']],
+                             [("corrupt.pdf", 2), ("good.pdf", 1), ("encrypted.pdf", 1)])
+            self.assertIn("outside good.pdf", stats['quarantined'][1]['error'])
+            self.assertIn("password", stats['quarantined'][2]['error'])
+            self.assertEqual(stats['quarantined'][0]['action'], 'skipped' if policy == 'skip' else 'placeholder')
+    
+    def test_merge_pdfs_fails_on_bad_source_by_default(self):
+        # Setup
+        sources, _ = self.make_bad_sources()
+        output_file = f"/tmp/test-merge-quarantine-fail-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        
+        # Execute and Assert
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]), \
+             self.assertRaises(Exception) as context:
+            lambda_function.merge_pdfs("test-bucket", ["good.pdf", "corrupt.pdf"], output_file, use_cache=False)
+        self.assertIn("Error merging PDFs", str(context.exception))
+    
+    @patch('lambda_function.get_s3_client')
+    @patch('lambda_function.upload_file_to_s3')
+    def test_process_merge_writes_source_error_report(self, mock_upload, mock_get_s3_client):
+        # Setup
+        sources, entries = self.make_bad_sources()
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        
+        # Execute - once with bad sources, then again after they were fixed
+        with patch('lambda_function.iter_pdf_s3_keys', side_effect=lambda bucket, key: iter(entries)), \
+             patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]):
+            lambda_function.process_merge("input-bucket", "manifest.json", "output-bucket", "binder.pdf",
+                                          on_source_error='skip', use_cache=False)
+            sources.update({"corrupt.pdf": make_text_pdf("fixed"), "encrypted.pdf": make_text_pdf("fixed")})
+            entries.remove({"key": "good.pdf", "pages": "9"})
+            lambda_function.process_merge("input-bucket", "manifest.json", "output-bucket", "binder.pdf",
+                                          on_source_error='skip', use_cache=False)
+        
+        # Assert - the job succeeded with a report next to the output, and the clean rerun removed it
+        put = mock_s3.put_object.call_args[1]
+        self.assertEqual(put['Key'], "binder.pdf.errors.json")
+        report = json.loads(put['Body'])
+        self.assertEqual(report['policy'], 'skip')
+        self.assertEqual([item['key'] for item in report['quarantined']], ["corrupt.pdf", "good.pdf", "encrypted.pdf"])
+        self.assertEqual(mock_upload.call_count, 2)
+        mock_s3.delete_objects.assert_called_once_with(
+            Bucket="output-bucket", Delete={'Objects': [{'Key': "binder.pdf.errors.json"}], 'Quiet': True})
+    
+    def test_merge_pdfs_opens_large_sources_from_files(self):
+        # Setup - every source is over the threshold and downloaded to a file
+        sources = {f"scan{i}.pdf": make_text_pdf(f"scan {i} " * 40, pages=2) for i in range(3)}
+        output_file = f"/tmp/test-merge-source-files-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        source_files = []
+        download_pdf_to_file = lambda_function.download_pdf_to_file
+        def record_source_file(*args):
+            source_files.append(download_pdf_to_file(*args))
+            return source_files[-1]
+        storage = MagicMock()
+        storage.get_object.side_effect = lambda Bucket, Key, Range=None, IfMatch=None: (
+            {'Body': io.BytesIO(sources[Key]), 'ContentLength': len(sources[Key]), 'ETag': '"e"'} if Range is None
+            else {'Body': io.BytesIO(sources[Key][int(Range[6:].split('-')[0]):int(Range.split('-')[1]) + 1])})
+        
+        # Execute
+        with patch('lambda_function.get_s3_client', return_value=storage), \
+             patch('lambda_function.download_pdf_to_file', side_effect=record_source_file), \
+             patch.dict(os.environ, {"DOWNLOAD_TO_FILE_MIN_BYTES": "100", "DOWNLOAD_PART_SIZE": "512"}):
+            stats = lambda_function.merge_pdfs("test-bucket", list(sources) + ["scan0.pdf"], output_file,
+                                               use_cache=False)
+        
+        # Assert - merged in order, and no source file is left in /tmp
+        self.assertEqual(len(source_files), 3)
+        self.assertEqual(stats['pages'], 8)
+        merged = fitz.open(output_file)
+        self.assertEqual([page.get_text().split()[1] for page in merged], ["0", "0", "1", "1", "2", "2", "0", "0"])
+        self.assertFalse(any(os.path.exists(source_file.path) for source_file in source_files))
+    
+    def test_lambda_handler_multi_output_downloads_each_source_once(self):
+        # Setup - three binders sharing their sources, one entry with a page range
+        sources = {"cover.pdf": make_text_pdf("cover"), "terms.pdf": make_text_pdf("terms", pages=2),
+                   "rates.pdf": make_text_pdf("rates")}
+        manifest = {"outputs": [
+            {"key": "acme.pdf", "pdfs": ["cover.pdf", "terms.pdf", "rates.pdf"]},
+            {"key": "beta.pdf", "pdfs": ["rates.pdf", {"key": "terms.pdf", "pages": "2"}, "cover.pdf"]},
+            {"key": "gamma.pdf", "pdfs": ["cover.pdf", "cover.pdf"]},
+        ]}
+        event = {"input_bucket": "input-bucket", "input_file_key": "binders.json", "output_bucket": "output-bucket",
+                 "output_file_key": "binders/", "multi_output": True, "use_cache": False, "upload_mode": "stream"}
+        objects = {}
+        def upload(bucket, key, fileobj, metadata=None):
+            fileobj.seek(0)
+            objects[key] = fileobj.read()
+        
+        # Execute
+        with patch('lambda_function.get_pdf_manifest', return_value=manifest), \
+             patch('lambda_function.download_pdf_from_s3',
+                   side_effect=lambda bucket, key, **kwargs: sources[key]) as mock_download, \
+             patch('lambda_function.upload_fileobj_to_s3', side_effect=upload):
+            result = lambda_function.lambda_handler(event, None)
+        
+        # Assert - one download per distinct source, every output in its own order
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(sorted(call_args[0][1] for call_args in mock_download.call_args_list), sorted(sources))
+        texts = {key: [page.get_text().strip() for page in fitz.open(stream=data, filetype="pdf")]
+                 for key, data in objects.items()}
+        self.assertEqual(texts, {
+            "binders/acme.pdf": ["cover", "terms", "terms", "rates"],
+            "binders/beta.pdf": ["rates", "terms", "cover"],
+            "binders/gamma.pdf": ["cover", "cover"],
+        })
+    
+    @patch('lambda_function.get_pdf_manifest')
+    def test_process_multi_output_merge_rejects_bad_manifests_and_options(self, mock_get_manifest):
+        # Setup
+        mock_get_manifest.return_value = {"outputs": [{"key": "a.pdf", "pdfs": ["x.pdf"]},
+                                                      {"key": "a.pdf", "pdfs": ["y.pdf"]}]}
+        
+        # Execute and Assert
+        with self.assertRaises(Exception) as duplicate:
+            lambda_function.process_merge("input-bucket", "binders.json", "output-bucket", "", multi_output=True)
+        with self.assertRaises(Exception) as unsupported:
+            lambda_function.process_merge("input-bucket", "binders.json", "output-bucket", "", multi_output=True,
+                                          dedupe_resources=True)
+        
+        self.assertIn("Manifest outputs listed more than once: a.pdf", str(duplicate.exception))
+        self.assertIn("Options not supported with multi_output: dedupe_resources", str(unsupported.exception))
+    
+    @patch('lambda_function.download_s3_object_to_file')
+    def test_resume_from_checkpoint_starts_over_when_manifest_changed(self, mock_download_object):
+        # Setup - the checkpoint was taken for a manifest that started with other entries
+        resume = {"checkpoint_key": "binder.pdf.checkpoint", "entries": 2,
+                  "digest": lambda_function.merged_entries_digest(["old0.pdf", "old1.pdf"])}
+        
+        # Execute
+        pdf_keys, checkpoint_entries, resume_file = lambda_function.resume_from_checkpoint(
+            "output-bucket", iter(["new0.pdf", "new1.pdf", "new2.pdf"]), resume)
+        
+        # Assert
+        self.assertEqual(list(pdf_keys), ["new0.pdf", "new1.pdf", "new2.pdf"])
+        self.assertEqual(checkpoint_entries, [])
+        self.assertIsNone(resume_file)
+        mock_download_object.assert_not_called()
+    
+    def test_resume_from_checkpoint_follows_the_entries_recorded_in_the_checkpoint(self):
+        # Setup - a duplicate continuation sent for 1 entry finds a checkpoint that has moved on to 2
+        entries = ["part0.pdf", "part1.pdf", "part2.pdf"]
+        checkpoint_file = f"/tmp/test-checkpoint-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(checkpoint_file) and os.remove(checkpoint_file))
+        with open(checkpoint_file, 'wb') as file:
+            file.write(make_text_pdf("part", pages=2))
+        lambda_function.record_merged_entries(checkpoint_file, entries[:2])
+        with open(checkpoint_file, 'rb') as file:
+            recorded = file.read()
+        unrecorded = make_text_pdf("part", pages=2)
+        resume = {"checkpoint_key": "binder.pdf.checkpoint", "entries": 1,
+                  "digest": lambda_function.merged_entries_digest(entries[:1])}
+        
+        results = []
+        for data in (recorded, unrecorded):
+            def download_object(bucket, key, local_file, data=data):
+                with open(local_file, 'wb') as file:
+                    file.write(data)
+                return True
+            
+            # Execute
+            with patch('lambda_function.download_s3_object_to_file', side_effect=download_object):
+                pdf_keys, checkpoint_entries, resume_file = lambda_function.resume_from_checkpoint(
+                    "output-bucket", iter(entries), resume)
+                results.append((list(pdf_keys), checkpoint_entries, resume_file))
+        
+        # Assert - the recorded checkpoint is resumed after its own 2 entries, one without a record is not used
+        self.assertEqual(results[0][:2], (["part2.pdf"], entries[:2]))
+        self.assertTrue(os.path.isfile(results[0][2]))
+        os.remove(results[0][2])
+        self.assertEqual(results[1], (entries, [], None))
+    
+    def test_merge_pdfs_merges_at_least_one_entry_past_deadline(self):
+        # Setup - no time left at all
+        sources = {f"part{i}.pdf": make_text_pdf(f"part {i}") for i in range(3)}
+        output_file = f"/tmp/test-merge-deadline-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        token = lambda_function.invocation_context.set(FakeLambdaContext(0))
+        self.addCleanup(lambda_function.invocation_context.reset, token)
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]):
+            stats = lambda_function.merge_pdfs("test-bucket", list(sources), output_file, True,
+                                               use_cache=False, stop_at_deadline=True)
+        
+        # Assert
+        self.assertTrue(stats['interrupted'])
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(fitz.open(output_file).page_count, 1)
+    
+    def test_merge_pdfs_dedupes_shared_images(self):
+        # Setup - every source carries the same 100x100 logo with a soft mask
+        logo = fitz.Pixmap(fitz.csRGB, 100, 100, bytes(range(256)) * 156 + bytes(64), True)
+        sources = {}
+        for i in range(3):
+            document = fitz.open()
+            page = document.new_page()
+            page.insert_image(fitz.Rect(72, 72, 172, 172), pixmap=logo)
+            page.insert_text((72, 200), f"statement {i}")
+            sources[f"file{i}.pdf"] = document.tobytes(garbage=3)
+        output_file = f"/tmp/test-merge-dedupe-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]):
+            stats = lambda_function.merge_pdfs("test-bucket", list(sources), output_file, dedupe_resources=True)
+        
+        # Assert - image and soft mask of the last two sources were dropped, all pages still use the logo
+        self.assertEqual(stats['duplicate_resources'], 4)
+        self.assertGreater(stats['dedupe_bytes_saved'], 0)
+        merged = fitz.open(output_file)
+        image_xrefs = {merged[i].get_images()[0][0] for i in range(3)}
+        self.assertEqual(len(image_xrefs), 1)
+        self.assertIn("statement 2", merged[2].get_text())
+        merged.close()
+    
+    def test_spooled_output_spills_to_disk(self):
+        # Setup - a real document saved into a tiny in-memory budget
+        document = fitz.open()
+        document.new_page().insert_text((72, 72), "spooled output")
+        
+        # Execute
+        with lambda_function.SpooledOutput(64) as output_buffer:
+            document.save(output_buffer)
+            size = output_buffer.size()
+            rolled = output_buffer.rolled
+            output_buffer.seek(0)
+            reopened = fitz.open(stream=output_buffer.read(), filetype="pdf")
+        
+        # Assert
+        self.assertGreater(size, 64)
+        self.assertTrue(rolled)
+        self.assertEqual(reopened.page_count, 1)
+
+    def test_merge_pdfs_flushes_over_memory_budget(self):
+        # Setup - real single page PDFs and an RSS reading that keeps growing
+        def make_pdf(text):
+            document = fitz.open()
+            document.new_page().insert_text((72, 72), text)
+            return document.tobytes()
+        
+        sources = {f"file{i}.pdf": make_pdf(f"document {i}") for i in range(5)}
+        rss_readings = iter(range(100 * 1024 * 1024, 10 ** 12, 50 * 1024 * 1024))
+        output_file = f"/tmp/test-merge-budget-{os.getpid()}.pdf"
+        self.addCleanup(lambda: os.path.isfile(output_file) and os.remove(output_file))
+        
+        # Execute
+        with patch('lambda_function.download_pdf_from_s3', side_effect=lambda bucket, key, **kwargs: sources[key]), \
+             patch('lambda_function.get_rss_bytes', side_effect=lambda: next(rss_readings)):
+            stats = lambda_function.merge_pdfs("test-bucket", list(sources), output_file, False, memory_budget_mb=64)
+        
+        # Assert - flushed along the way and still produced every page in order
+        self.assertGreater(stats['flushes'], 0)
+        self.assertEqual(stats['documents'], 5)
+        merged = fitz.open(output_file)
+        self.assertEqual(merged.page_count, 5)
+        self.assertIn("document 4", merged[4].get_text())
+        merged.close()
+    
+    @patch('lambda_function.download_pdf_from_s3')
+    @patch('fitz.open')
+    def test_merge_pdfs_closes_sources(self, mock_fitz_open, mock_download):
+        # Setup
+        mock_download.return_value = b"PDF content"
+        mock_pdf_doc = MagicMock()
+        mock_merged_pdf = MagicMock()
+        mock_fitz_open.side_effect = lambda *args, **kwargs: mock_pdf_doc if 'stream' in kwargs else mock_merged_pdf
+        
+        # Execute
+        lambda_function.merge_pdfs("test-bucket", ["file1.pdf", "file2.pdf"], "/tmp/output.pdf")
+        
+        # Assert
+        self.assertEqual(mock_pdf_doc.close.call_count, 2)
+    
+    @patch('lambda_function.download_pdf_from_s3')
+    @patch('fitz.open')
+    def test_merge_pdfs_repeated_keys_downloaded_once(self, mock_fitz_open, mock_download):
+        # Setup
+        mock_download.return_value = b"PDF content"
+        mock_merged_pdf = MagicMock()
+        opened = []
+        
+        def mock_fitz_open_side_effect(*args, **kwargs):
+            if 'stream' in kwargs:
+                opened.append(MagicMock())
+                return opened[-1]
+            return mock_merged_pdf
+        
+        mock_fitz_open.side_effect = mock_fitz_open_side_effect
+        
+        # Execute
+        stats = lambda_function.merge_pdfs("test-bucket", ["cover.pdf", "file1.pdf", "cover.pdf", "file2.pdf", "cover.pdf"],
+                                           "/tmp/output.pdf")
+        
+        # Assert - three downloads and opens, five inserts in manifest order
+        self.assertEqual([c[0][1] for c in mock_download.call_args_list], ["cover.pdf", "file1.pdf", "file2.pdf"])
+        self.assertEqual(len(opened), 3)
+        inserted = [c[0][0] for c in mock_merged_pdf.insert_pdf.call_args_list]
+        self.assertEqual(inserted, [opened[0], opened[1], opened[0], opened[2], opened[0]])
+        self.assertEqual(stats['duplicates'], 2)
+        for document in opened:
+            document.close.assert_called_once()
+    
+    def test_get_rss_bytes(self):
+        # Execute and Assert
+        self.assertGreater(lambda_function.get_rss_bytes(), 0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -4,6 +4,9 @@ import io
 import json
 import sys
 import os
+import shutil
+import tempfile
+from botocore.exceptions import ClientError
 
 # Add parent directory to path so we can import the lambda_function
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -11,20 +14,17 @@ import lambda_function
 
 class TestS3Operations(unittest.TestCase):
     
-    @patch('boto3.client')
-    def test_get_pdf_s3_keys_success(self, mock_boto3_client):
+    @patch('lambda_function.get_s3_client')
+    def test_get_pdf_s3_keys_success(self, mock_get_s3_client):
         # Setup
         mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
+        mock_get_s3_client.return_value = mock_s3
         
         # Mock the S3 response
-        mock_body = MagicMock()
-        mock_body.read.return_value = json.dumps({
-            "pdfs": ["file1.pdf", "file2.pdf"]
-        }).encode('utf-8')
-        
         mock_s3.get_object.return_value = {
-            'Body': mock_body
+            'Body': io.BytesIO(json.dumps({
+                "pdfs": ["file1.pdf", "file2.pdf"]
+            }).encode('utf-8'))
         }
         
         # Execute
@@ -34,20 +34,17 @@ class TestS3Operations(unittest.TestCase):
         mock_s3.get_object.assert_called_once_with(Bucket="test-bucket", Key="test-key.json")
         self.assertEqual(result, ["file1.pdf", "file2.pdf"])
     
-    @patch('boto3.client')
-    def test_get_pdf_s3_keys_empty(self, mock_boto3_client):
+    @patch('lambda_function.get_s3_client')
+    def test_get_pdf_s3_keys_empty(self, mock_get_s3_client):
         # Setup
         mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
+        mock_get_s3_client.return_value = mock_s3
         
         # Mock the S3 response with empty PDF list
-        mock_body = MagicMock()
-        mock_body.read.return_value = json.dumps({
-            "pdfs": []
-        }).encode('utf-8')
-        
         mock_s3.get_object.return_value = {
-            'Body': mock_body
+            'Body': io.BytesIO(json.dumps({
+                "pdfs": []
+            }).encode('utf-8'))
         }
         
         # Execute
@@ -56,18 +53,15 @@ class TestS3Operations(unittest.TestCase):
         # Assert
         self.assertEqual(result, [])
     
-    @patch('boto3.client')
-    def test_get_pdf_s3_keys_invalid_json(self, mock_boto3_client):
+    @patch('lambda_function.get_s3_client')
+    def test_get_pdf_s3_keys_invalid_json(self, mock_get_s3_client):
         # Setup
         mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
+        mock_get_s3_client.return_value = mock_s3
         
         # Mock the S3 response with invalid JSON
-        mock_body = MagicMock()
-        mock_body.read.return_value = "invalid-json".encode('utf-8')
-        
         mock_s3.get_object.return_value = {
-            'Body': mock_body
+            'Body': io.BytesIO("invalid-json".encode('utf-8'))
         }
         
         # Execute and Assert
@@ -76,18 +70,109 @@ class TestS3Operations(unittest.TestCase):
         
         self.assertIn("Error parsing JSON", str(context.exception))
     
-    @patch('boto3.client')
-    def test_download_pdf_from_s3(self, mock_boto3_client):
+    @patch('lambda_function.MANIFEST_READ_SIZE', 7)
+    @patch('lambda_function.get_s3_client')
+    def test_get_pdf_manifest_parses_in_small_chunks(self, mock_get_s3_client):
+        # Setup - 7 byte reads split keys, numbers and a multi-byte character across chunks
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        manifest = {"title": "Relevé", "pdfs": ["file1.pdf", "relevé 2.pdf", "file3.pdf"],
+                    "page_counts": {"file1.pdf": 12345678, "file3.pdf": 2.5}}
+        mock_s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(manifest, ensure_ascii=False).encode('utf-8'))}
+        
+        # Execute
+        result = lambda_function.get_pdf_manifest("test-bucket", "test-key.json")
+        
+        # Assert
+        self.assertEqual(result, manifest)
+    
+    def test_iter_json_manifest_keys_split_at_every_offset(self):
+        # Setup - floats, exponents and negative numbers, at the top level and in entries
+        manifest = ('{"v": 1.5, "w": 1e3, "x": -2.5E-2, "y": 12, '
+                    '"pdfs": ["a.pdf", {"key": "b.pdf", "pages": [12, "3-4"]}], "z": 0.125e+2}')
+        
+        for offset in range(len(manifest) + 1):
+            # Execute
+            fields = {}
+            entries = list(lambda_function.iter_json_manifest_keys([manifest[:offset], manifest[offset:]], fields))
+            
+            # Assert - the same result wherever the chunk boundary falls
+            self.assertEqual(entries, ["a.pdf", {"key": "b.pdf", "pages": [12, "3-4"]}], offset)
+            self.assertEqual(fields, {"v": 1.5, "w": 1e3, "x": -2.5e-2, "y": 12, "z": 12.5}, offset)
+    
+    @patch('lambda_function.get_s3_client')
+    def test_iter_pdf_s3_keys_yields_before_the_manifest_is_read(self, mock_get_s3_client):
+        # Setup - a manifest of many read sizes
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        keys = [f"statements/2024/account-{i:08d}.pdf" for i in range(20000)]
+        body = io.BytesIO(json.dumps({"pdfs": keys}).encode('utf-8'))
+        mock_s3.get_object.return_value = {'Body': body}
+        
+        # Execute
+        pdf_keys = lambda_function.iter_pdf_s3_keys("test-bucket", "test-key.json")
+        first = next(pdf_keys)
+        
+        # Assert - only the first chunk has been read
+        self.assertEqual(first, keys[0])
+        self.assertEqual(body.tell(), lambda_function.MANIFEST_READ_SIZE)
+        self.assertEqual([first] + list(pdf_keys), keys)
+    
+    @patch('lambda_function.MANIFEST_READ_SIZE', 5)
+    @patch('lambda_function.get_s3_client')
+    def test_iter_pdf_s3_keys_json_lines(self, mock_get_s3_client):
         # Setup
         mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.get_object.return_value = {'Body': io.BytesIO(b'"file1.pdf"\n\n"file2.pdf"\r\n"file3.pdf"')}
         
-        # Mock the S3 response
-        mock_body = MagicMock()
-        mock_body.read.return_value = b"PDF content"
+        # Execute
+        result = list(lambda_function.iter_pdf_s3_keys("test-bucket", "manifests/test.jsonl"))
+        
+        # Assert
+        self.assertEqual(result, ["file1.pdf", "file2.pdf", "file3.pdf"])
+    
+    @patch('lambda_function.get_s3_client')
+    def test_iter_pdf_s3_keys_json_lines_invalid_line(self, mock_get_s3_client):
+        # Setup
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.get_object.return_value = {'Body': io.BytesIO(b'"file1.pdf"\n42\n')}
+        
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            list(lambda_function.iter_pdf_s3_keys("test-bucket", "test.ndjson"))
+        
+        self.assertIn("Line 2", str(context.exception))
+    
+    @patch('lambda_function.get_s3_client')
+    def test_iter_pdf_s3_keys_prefix(self, mock_get_s3_client):
+        # Setup - two list_objects_v2 pages with a non-PDF object
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.get_paginator.return_value.paginate.return_value = iter([
+            {'Contents': [{'Key': "batch/a.pdf"}, {'Key': "batch/b.PDF"}]},
+            {'Contents': [{'Key': "batch/c.pdf"}, {'Key': "batch/manifest.json"}]},
+        ])
+        
+        # Execute
+        result = list(lambda_function.iter_pdf_s3_keys("test-bucket", "batch/"))
         
+        # Assert
+        mock_s3.get_paginator.assert_called_once_with('list_objects_v2')
+        mock_s3.get_paginator.return_value.paginate.assert_called_once_with(Bucket="test-bucket", Prefix="batch/")
+        mock_s3.get_object.assert_not_called()
+        self.assertEqual(result, ["batch/a.pdf", "batch/b.PDF", "batch/c.pdf"])
+    
+    @patch('lambda_function.get_s3_client')
+    def test_download_pdf_from_s3(self, mock_get_s3_client):
+        # Setup
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        
+        # Mock the S3 response
         mock_s3.get_object.return_value = {
-            'Body': mock_body
+            'Body': io.BytesIO(b"PDF content")
         }
         
         # Execute
@@ -97,14 +182,51 @@ class TestS3Operations(unittest.TestCase):
         mock_s3.get_object.assert_called_once_with(Bucket="test-bucket", Key="test.pdf")
         self.assertEqual(result, b"PDF content")
     
-    @patch('boto3.resource')
-    def test_upload_file_to_s3(self, mock_boto3_resource):
+    def test_download_pdf_from_s3_large_object_goes_to_file_in_ranged_parts(self):
+        # Setup - a 2500 byte object, over a 1000 byte threshold, in 1000 byte parts
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        storage = lambda_function.LocalStorageClient(root)
+        content = bytes(range(256)) * 9 + b"tail" * 49
+        etag = storage.put("test-bucket", "large.pdf", content)
+        client = MagicMock(wraps=storage)
+        
+        # Execute
+        with patch('lambda_function.get_s3_client', return_value=client), \
+             patch.dict(os.environ, {"DOWNLOAD_TO_FILE_MIN_BYTES": "1000", "DOWNLOAD_PART_SIZE": "1000"}):
+            result = lambda_function.download_pdf_from_s3("test-bucket", "large.pdf")
+        self.addCleanup(result.remove)
+        
+        # Assert - the first GET supplies part one, the others are ranged GETs of the same version
+        self.assertIsInstance(result, lambda_function.SourceFile)
+        self.assertEqual(len(result), len(content))
+        with open(result.path, 'rb') as file:
+            self.assertEqual(file.read(), content)
+        ranges = sorted(call_args[1].get('Range') or '' for call_args in client.get_object.call_args_list)
+        self.assertEqual(ranges, ['', 'bytes=1000-1999', 'bytes=2000-2499'])
+        for call_args in client.get_object.call_args_list[1:]:
+            self.assertEqual(call_args[1]['IfMatch'], etag)
+    
+    def test_download_pdf_from_s3_small_object_stays_in_memory(self):
         # Setup
-        mock_s3_resource = MagicMock()
-        mock_boto3_resource.return_value = mock_s3_resource
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        storage = lambda_function.LocalStorageClient(root)
+        storage.put("test-bucket", "small.pdf", b"x" * 999)
+        
+        # Execute
+        with patch('lambda_function.get_s3_client', return_value=storage), \
+             patch.dict(os.environ, {"DOWNLOAD_TO_FILE_MIN_BYTES": "1000"}):
+            result = lambda_function.download_pdf_from_s3("test-bucket", "small.pdf")
         
-        mock_bucket = MagicMock()
-        mock_s3_resource.Bucket.return_value = mock_bucket
+        # Assert
+        self.assertEqual(result, b"x" * 999)
+    
+    @patch('lambda_function.get_s3_client')
+    def test_upload_file_to_s3(self, mock_get_s3_client):
+        # Setup
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
         
         # Mock file opening
         m = mock_open(read_data=b"test file content")
@@ -114,9 +236,303 @@ class TestS3Operations(unittest.TestCase):
             result = lambda_function.upload_file_to_s3("test-bucket", "test-key.pdf", "/tmp/test.pdf")
         
         # Assert
-        mock_s3_resource.Bucket.assert_called_once_with("test-bucket")
-        mock_bucket.put_object.assert_called_once()
+        mock_s3.put_object.assert_called_once()
+        self.assertEqual(mock_s3.put_object.call_args[1]['Bucket'], "test-bucket")
+        self.assertEqual(mock_s3.put_object.call_args[1]['Key'], "test-key.pdf")
+        self.assertTrue(result)
+
+    @patch('lambda_function.get_s3_client')
+    def test_upload_fileobj_to_s3_multipart(self, mock_get_s3_client):
+        # Setup - 12 MB in 5 MB parts is three parts
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+        fileobj = io.BytesIO(b"x" * (12 * 1024 * 1024))
+        
+        # Execute
+        result = lambda_function.upload_fileobj_to_s3("test-bucket", "test-key.pdf", fileobj,
+                                                      part_size=5 * 1024 * 1024, upload_concurrency=2)
+        
+        # Assert
+        self.assertTrue(result)
+        self.assertEqual(mock_s3.upload_part.call_count, 3)
+        mock_s3.complete_multipart_upload.assert_called_once_with(
+            Bucket="test-bucket", Key="test-key.pdf", UploadId="upload-1",
+            MultipartUpload={'Parts': [
+                {'PartNumber': 1, 'ETag': 'etag-1'},
+                {'PartNumber': 2, 'ETag': 'etag-2'},
+                {'PartNumber': 3, 'ETag': 'etag-3'}
+            ]})
+        mock_s3.abort_multipart_upload.assert_not_called()
+        mock_s3.put_object.assert_not_called()
+    
+    @patch('lambda_function.get_s3_client')
+    def test_upload_fileobj_to_s3_aborts_on_failure(self, mock_get_s3_client):
+        # Setup
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.upload_part.side_effect = Exception("Connection reset")
+        fileobj = io.BytesIO(b"x" * (12 * 1024 * 1024))
+        
+        # Execute and Assert
+        with self.assertRaises(Exception) as context:
+            lambda_function.upload_fileobj_to_s3("test-bucket", "test-key.pdf", fileobj,
+                                                 part_size=5 * 1024 * 1024)
+        
+        self.assertIn("Connection reset", str(context.exception))
+        mock_s3.abort_multipart_upload.assert_called_once_with(
+            Bucket="test-bucket", Key="test-key.pdf", UploadId="upload-1")
+        mock_s3.complete_multipart_upload.assert_not_called()
+    
+    @patch('lambda_function.get_s3_client')
+    def test_upload_fileobj_to_s3_small_file(self, mock_get_s3_client):
+        # Setup
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        
+        # Execute
+        result = lambda_function.upload_fileobj_to_s3("test-bucket", "test-key.pdf", io.BytesIO(b"PDF content"))
+        
+        # Assert - a single part goes up with put_object
         self.assertTrue(result)
+        mock_s3.put_object.assert_called_once_with(Bucket="test-bucket", Key="test-key.pdf", Body=b"PDF content")
+        mock_s3.create_multipart_upload.assert_not_called()
+
+    @patch('boto3.client')
+    def test_get_s3_client_is_shared(self, mock_boto3_client):
+        # Setup
+        lambda_function.set_s3_client(None)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        
+        # Execute
+        with patch.dict(os.environ, {"S3_MAX_POOL_CONNECTIONS": "32", "S3_RETRY_MODE": "standard"}):
+            first = lambda_function.get_s3_client()
+            second = lambda_function.get_s3_client()
+        
+        # Assert - built once with the configured pool and retry settings
+        self.assertIs(first, second)
+        mock_boto3_client.assert_called_once()
+        config = mock_boto3_client.call_args[1]['config']
+        self.assertEqual(config.max_pool_connections, 32)
+        self.assertEqual(config.retries['mode'], "standard")
+        self.assertIsNone(mock_boto3_client.call_args[1]['endpoint_url'])
+    
+    @patch('boto3.client')
+    def test_get_s3_client_local_endpoint(self, mock_boto3_client):
+        # Setup
+        lambda_function.set_s3_client(None)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        
+        # Execute
+        with patch.dict(os.environ, {"S3_ENDPOINT_URL": "http://localhost:9000"}):
+            lambda_function.get_s3_client()
+        
+        # Assert
+        self.assertEqual(mock_boto3_client.call_args[1]['endpoint_url'], "http://localhost:9000")
+    
+    def test_set_s3_client_injects_stand_in(self):
+        # Setup
+        stand_in = MagicMock()
+        stand_in.get_object.return_value = {'Body': io.BytesIO(b"PDF content")}
+        lambda_function.set_s3_client(stand_in)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        
+        # Execute
+        result = lambda_function.download_pdf_from_s3("test-bucket", "test.pdf")
+        
+        # Assert
+        self.assertEqual(result, b"PDF content")
+        stand_in.get_object.assert_called_once_with(Bucket="test-bucket", Key="test.pdf")
+
+    def test_get_s3_client_local_storage_backend(self):
+        # Setup
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        lambda_function.set_s3_client(None)
+        self.addCleanup(lambda_function.set_s3_client, None)
+        os.makedirs(os.path.join(root, "input-bucket", "statements"))
+        with open(os.path.join(root, "input-bucket", "statements", "a.pdf"), "wb") as file:
+            file.write(b"PDF content")
+        
+        # Execute - an existing file is served as an object, with no preparation
+        with patch.dict(os.environ, {"STORAGE_BACKEND": "local", "LOCAL_STORAGE_ROOT": root}):
+            client = lambda_function.get_s3_client()
+            result = lambda_function.download_pdf_from_s3("input-bucket", "statements/a.pdf")
+        
+        # Assert
+        self.assertIsInstance(client, lambda_function.LocalStorageClient)
+        self.assertEqual(result, b"PDF content")
+    
+    def test_local_storage_client_object_calls(self):
+        # Setup
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        client = lambda_function.LocalStorageClient(root)
+        
+        # Execute
+        client.put_object(Bucket="out", Key="merged/a.pdf", Body=io.BytesIO(b"merged"), Metadata={"merge-fingerprint": "f1"})
+        head = client.head_object(Bucket="out", Key="merged/a.pdf")
+        upload_id = client.create_multipart_upload(Bucket="out", Key="merged/b.pdf")['UploadId']
+        parts = [{'PartNumber': number, 'ETag': client.upload_part(Bucket="out", Key="merged/b.pdf", UploadId=upload_id,
+                                                                   PartNumber=number, Body=data)['ETag']}
+                 for number, data in ((1, b"part one "), (2, b"part two"))]
+        client.complete_multipart_upload(Bucket="out", Key="merged/b.pdf", UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+        pages = list(client.get_paginator('list_objects_v2').paginate(Bucket="out", Prefix="merged/"))
+        with self.assertRaises(ClientError) as not_modified:
+            client.get_object(Bucket="out", Key="merged/a.pdf", IfNoneMatch=head['ETag'])
+        client.delete_objects(Bucket="out", Delete={'Objects': [{'Key': "merged/a.pdf"}]})
+        with self.assertRaises(ClientError) as missing:
+            client.get_object(Bucket="out", Key="merged/a.pdf")
+        
+        # Assert
+        self.assertEqual(head['ContentLength'], 6)
+        self.assertEqual(head['Metadata'], {"merge-fingerprint": "f1"})
+        self.assertEqual(client.get_object(Bucket="out", Key="merged/b.pdf")['Body'].read(), b"part one part two")
+        self.assertEqual([item['Key'] for item in pages[0]['Contents']], ["merged/a.pdf", "merged/b.pdf"])
+        self.assertEqual(not_modified.exception.response['ResponseMetadata']['HTTPStatusCode'], 304)
+        self.assertEqual(missing.exception.response['Error']['Code'], 'NoSuchKey')
+    
+    def test_local_storage_client_rejects_paths_outside_root(self):
+        # Setup - a bucket under the root, and a secret file next to the root
+        parent = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent, ignore_errors=True)
+        client = lambda_function.LocalStorageClient(os.path.join(parent, "root"))
+        client.put_object(Bucket="in", Key="a/../b.pdf", Body=b"inside")
+        with open(os.path.join(parent, "secret"), 'wb') as file:
+            file.write(b"secret")
+        
+        # Execute and Assert - keys and buckets may not leave the bucket's directory
+        self.assertEqual(client.get_object(Bucket="in", Key="b.pdf")['Body'].read(), b"inside")
+        for bucket, key in (("in", "../../secret"), ("in", "/etc/passwd"), ("in", "a/../../in2/x.pdf"),
+                            ("..", "secret"), ("in/..", "secret"), ("", "secret")):
+            with self.assertRaises(ValueError):
+                client.get_object(Bucket=bucket, Key=key)
+        with self.assertRaises(ValueError):
+            list(client.get_paginator('list_objects_v2').paginate(Bucket="in", Prefix="../"))
+        with self.assertRaises(ValueError) as context:
+            client.get_paginator('list_objects')
+        self.assertIn("list_objects_v2", str(context.exception))
+    
+    def use_temporary_pdf_cache(self, max_bytes):
+        cache_dir = tempfile.mkdtemp()
+        env = patch.dict(os.environ, {"PDF_CACHE_DIR": cache_dir, "PDF_CACHE_MAX_BYTES": str(max_bytes)})
+        env.start()
+        self.addCleanup(env.stop)
+        lambda_function.pdf_cache_index = None
+        self.addCleanup(setattr, lambda_function, 'pdf_cache_index', None)
+        return cache_dir
+    
+    @patch('lambda_function.get_s3_client')
+    def test_download_pdf_from_s3_cache_revalidates_with_etag(self, mock_get_s3_client):
+        # Setup - the first GET returns the object, the second answers 304 Not Modified
+        self.use_temporary_pdf_cache(1024)
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        not_modified = ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'},
+                                    'ResponseMetadata': {'HTTPStatusCode': 304}}, 'GetObject')
+        mock_s3.get_object.side_effect = [{'Body': io.BytesIO(b"PDF content"), 'ETag': '"abc"'}, not_modified]
+        cache_stats = lambda_function.Counter()
+        
+        # Execute
+        first = lambda_function.download_pdf_from_s3("test-bucket", "test.pdf", use_cache=True, cache_stats=cache_stats)
+        second = lambda_function.download_pdf_from_s3("test-bucket", "test.pdf", use_cache=True, cache_stats=cache_stats)
+        
+        # Assert
+        self.assertEqual(first, b"PDF content")
+        self.assertEqual(second, b"PDF content")
+        mock_s3.get_object.assert_called_with(Bucket="test-bucket", Key="test.pdf", IfNoneMatch='"abc"')
+        self.assertEqual(cache_stats, {'hits': 1, 'misses': 1})
+    
+    def test_pdf_cache_off_by_default_and_keeps_tmp_free(self):
+        # Setup - a merge without cache settings, then an enabled cache with 300 MB free in /tmp
+        with patch.dict(os.environ):
+            os.environ.pop("PDF_CACHE_MAX_BYTES", None)
+            with patch('lambda_function.prefetch_pdfs', side_effect=Exception("stop")) as mock_prefetch:
+                with self.assertRaises(Exception):
+                    lambda_function.merge_pdfs("test-bucket", ["a.pdf"], "/tmp/output.pdf")
+        cache_dir = self.use_temporary_pdf_cache(100 * 1024 * 1024)
+        usage = shutil.disk_usage(cache_dir)._replace(free=300 * 1024 * 1024)
+        
+        # Execute - the second PDF would leave less than the default 256 MB free
+        with patch('shutil.disk_usage', return_value=usage):
+            lambda_function.store_cached_pdf("test-bucket", "small.pdf", '"a"', b"x" * 1024)
+            lambda_function.store_cached_pdf("test-bucket", "large.pdf", '"b"', b"x" * (50 * 1024 * 1024))
+        
+        # Assert - merges don't use the cache unless it is enabled, and only the small PDF was cached
+        self.assertFalse(mock_prefetch.call_args[1]['use_cache'])
+        self.assertEqual(list(lambda_function.get_pdf_cache_index()), [("test-bucket", "small.pdf")])
+    
+    @patch('lambda_function.get_s3_client')
+    def test_download_pdf_from_s3_cache_evicts_least_recently_used(self, mock_get_s3_client):
+        # Setup - room for two 40 byte PDFs
+        cache_dir = self.use_temporary_pdf_cache(100)
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.get_object.side_effect = lambda **kwargs: {'Body': io.BytesIO(b"x" * 40), 'ETag': f'"{kwargs["Key"]}"'}
+        
+        # Execute
+        for key in ["a.pdf", "b.pdf", "c.pdf"]:
+            lambda_function.download_pdf_from_s3("test-bucket", key, use_cache=True)
+        
+        # Assert
+        self.assertIsNone(lambda_function.get_cached_pdf("test-bucket", "a.pdf"))
+        self.assertIsNotNone(lambda_function.get_cached_pdf("test-bucket", "b.pdf"))
+        self.assertIsNotNone(lambda_function.get_cached_pdf("test-bucket", "c.pdf"))
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+    
+    def test_read_cached_pdf_reads_outside_the_cache_lock(self):
+        # Setup - a cached PDF, and an open() that records whether the cache lock is held
+        self.use_temporary_pdf_cache(1024)
+        lambda_function.store_cached_pdf("test-bucket", "a.pdf", '"a"', b"PDF content")
+        _, path = lambda_function.get_cached_pdf("test-bucket", "a.pdf")
+        real_open = open
+        locked = []
+        def tracking_open(file, *args, **kwargs):
+            if file == path:
+                locked.append(lambda_function.pdf_cache_lock.locked())
+            return real_open(file, *args, **kwargs)
+        
+        # Execute
+        with patch('builtins.open', side_effect=tracking_open):
+            pdf_data = lambda_function.read_cached_pdf("test-bucket", "a.pdf", path)
+        os.remove(path)
+        missing = lambda_function.read_cached_pdf("test-bucket", "a.pdf", path)
+        
+        # Assert - a file that is gone drops its entry
+        self.assertEqual(pdf_data, b"PDF content")
+        self.assertEqual(locked, [False])
+        self.assertIsNone(missing)
+        self.assertIsNone(lambda_function.get_cached_pdf("test-bucket", "a.pdf"))
+
+    @patch('lambda_function.get_s3_client')
+    def test_head_pdf_objects(self, mock_get_s3_client):
+        # Setup
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.head_object.side_effect = lambda Bucket, Key: {'ETag': f'"{Key}"', 'ContentLength': len(Key)}
+        
+        # Execute
+        result = lambda_function.head_pdf_objects("test-bucket", ["a.pdf", "bb.pdf", "a.pdf"])
+        
+        # Assert - repeated keys are looked up once
+        self.assertEqual(result, {"a.pdf": {"etag": '"a.pdf"', "size": 5}, "bb.pdf": {"etag": '"bb.pdf"', "size": 6}})
+        self.assertEqual(mock_s3.head_object.call_count, 2)
+    
+    @patch('lambda_function.get_s3_client')
+    def test_get_output_fingerprint(self, mock_get_s3_client):
+        # Setup
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        not_found = ClientError({'Error': {'Code': '404', 'Message': 'Not Found'},
+                                 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'HeadObject')
+        mock_s3.head_object.side_effect = [{'Metadata': {'merge-fingerprint': 'abc'}}, not_found]
+        
+        # Execute and Assert
+        self.assertEqual(lambda_function.get_output_fingerprint("test-bucket", "output.pdf"), 'abc')
+        self.assertIsNone(lambda_function.get_output_fingerprint("test-bucket", "missing.pdf"))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file